@@ -1,17 +1,25 @@
-from sqlalchemy.orm import Session
-from database import SessionLocal, engine
-from models import User,UserRole
+import argparse
+import sys
 
+from database import SessionLocal
+from export import EXPORT_TABLES, FORMATS, stream_table
 
-# Create a session
-db = SessionLocal()
 
-# Query all rows from the 'users' table
-users = db.query(User).all()
+def main():
+    parser = argparse.ArgumentParser(description="Dump a table as NDJSON or CSV.")
+    parser.add_argument("table", choices=sorted(EXPORT_TABLES))
+    parser.add_argument("--format", choices=sorted(FORMATS), default="ndjson")
+    args = parser.parse_args()
 
-# Print the rows
-for user in users:
-    print(f"ID: {user.id}, user_id: {user.user_id}, role_id: {user.role_id}, date: {user.assigned_at}")
+    # Create a session
+    db = SessionLocal()
+    try:
+        # Stream the rows in chunks instead of loading the whole table
+        for chunk in stream_table(db, args.table, args.format):
+            sys.stdout.write(chunk)
+    finally:
+        db.close()
 
 
-# Git test
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""role member counts
+
+Revision ID: 718d5266e7c2
+Revises: cb1428de84fb
+Create Date: 2026-10-17 04:36:09.606884
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '718d5266e7c2'
+down_revision: Union[str, None] = 'cb1428de84fb'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+SQLITE_TRIGGERS = (
+    """
+    CREATE TRIGGER user_roles_insert_count_member AFTER INSERT ON user_roles
+    BEGIN
+        INSERT INTO role_member_counts (role_id, users) VALUES (NEW.role_id, 1)
+        ON CONFLICT (role_id) DO UPDATE SET users = users + 1;
+    END;
+    """,
+    """
+    CREATE TRIGGER user_roles_delete_count_member AFTER DELETE ON user_roles
+    BEGIN
+        UPDATE role_member_counts SET users = users - 1 WHERE role_id = OLD.role_id;
+    END;
+    """,
+    """
+    CREATE TRIGGER user_roles_update_count_member AFTER UPDATE OF role_id ON user_roles
+    WHEN OLD.role_id != NEW.role_id
+    BEGIN
+        UPDATE role_member_counts SET users = users - 1 WHERE role_id = OLD.role_id;
+        INSERT INTO role_member_counts (role_id, users) VALUES (NEW.role_id, 1)
+        ON CONFLICT (role_id) DO UPDATE SET users = users + 1;
+    END;
+    """,
+)
+
+POSTGRES_TRIGGERS = (
+    """
+    CREATE FUNCTION count_role_members() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            UPDATE role_member_counts SET users = users - 1 WHERE role_id = OLD.role_id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO role_member_counts (role_id, users) VALUES (NEW.role_id, 1)
+            ON CONFLICT (role_id) DO UPDATE SET users = role_member_counts.users + 1;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """,
+    """
+    CREATE TRIGGER user_roles_insert_count_member AFTER INSERT ON user_roles
+    FOR EACH ROW EXECUTE FUNCTION count_role_members();
+    """,
+    """
+    CREATE TRIGGER user_roles_delete_count_member AFTER DELETE ON user_roles
+    FOR EACH ROW EXECUTE FUNCTION count_role_members();
+    """,
+    """
+    CREATE TRIGGER user_roles_update_count_member AFTER UPDATE OF role_id ON user_roles
+    FOR EACH ROW WHEN (OLD.role_id IS DISTINCT FROM NEW.role_id) EXECUTE FUNCTION count_role_members();
+    """,
+)
+
+TRIGGERS = {"sqlite": SQLITE_TRIGGERS, "postgresql": POSTGRES_TRIGGERS}
+
+
+def upgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect not in TRIGGERS:
+        # /roles/stats?source=counter would read counts that never move
+        raise NotImplementedError(f"member count triggers are not defined for {dialect}")
+
+    # Members per role, kept current by triggers on user_roles so /roles/stats
+    # can read counts without a COUNT over the assignments
+    op.create_table('role_member_counts',
+    sa.Column('role_id', sa.Integer(), nullable=False),
+    sa.Column('users', sa.Integer(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('role_id')
+    )
+    op.execute(
+        """
+        INSERT INTO role_member_counts (role_id, users)
+        SELECT role_id, COUNT(*) FROM user_roles GROUP BY role_id;
+        """
+    )
+    for statement in TRIGGERS[dialect]:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    for event in ("insert", "delete", "update"):
+        op.execute(f"DROP TRIGGER IF EXISTS user_roles_{event}_count_member" + (" ON user_roles" if dialect == "postgresql" else ""))
+    if dialect == "postgresql":
+        op.execute("DROP FUNCTION IF EXISTS count_role_members()")
+    op.drop_table('role_member_counts')
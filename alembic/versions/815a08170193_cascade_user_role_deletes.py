@@ -0,0 +1,73 @@
+"""cascade user role deletes
+
+Revision ID: 815a08170193
+Revises: bec8a5ffca1d
+Create Date: 2026-10-17 04:49:30.629282
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '815a08170193'
+down_revision: Union[str, None] = 'bec8a5ffca1d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _user_roles(ondelete):
+    return sa.Table(
+        'user_roles', sa.MetaData(),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('role_id', sa.Integer(), nullable=False),
+        sa.Column('assigned_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['role_id'], ['roles.id'], ondelete=ondelete),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete=ondelete),
+        sa.PrimaryKeyConstraint('id'),
+        sa.Index('ix_user_roles_id', 'id'),
+        sa.Index('ix_user_roles_user_id_role_id', 'user_id', 'role_id', unique=True),
+        sa.Index('ix_user_roles_role_id_user_id', 'role_id', 'user_id'),
+    )
+
+
+def _recreate_user_roles(ondelete):
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        # Elsewhere the foreign keys are altered in place, which keeps the
+        # table's triggers. Names are the Postgres defaults from the initial
+        # revision's unnamed constraints.
+        for column, target in (('user_id', 'users'), ('role_id', 'roles')):
+            name = f'user_roles_{column}_fkey'
+            op.drop_constraint(name, 'user_roles', type_='foreignkey')
+            op.create_foreign_key(name, 'user_roles', target, [column], ['id'], ondelete=ondelete)
+        return
+    # SQLite cannot alter a foreign key, so the table is rebuilt. Dropping it
+    # drops its triggers too; put back whatever was there.
+    triggers = bind.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'user_roles'"
+    ).scalars().all()
+    with op.batch_alter_table('user_roles', copy_from=_user_roles(ondelete), recreate='always'):
+        pass
+    for trigger in triggers:
+        op.execute(trigger)
+
+
+def upgrade() -> None:
+    # Rows left behind by earlier deletes would fail the constraint checks
+    # once they are enforced. Deleting them fires the member count triggers.
+    op.execute(
+        """
+        DELETE FROM user_roles
+        WHERE user_id NOT IN (SELECT id FROM users) OR role_id NOT IN (SELECT id FROM roles);
+        """
+    )
+    # Deleting a user or role removes its assignments in the same statement
+    _recreate_user_roles('CASCADE')
+
+
+def downgrade() -> None:
+    _recreate_user_roles(None)
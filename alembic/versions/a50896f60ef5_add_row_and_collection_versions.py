@@ -0,0 +1,89 @@
+"""add row and collection versions
+
+Revision ID: a50896f60ef5
+Revises: e3d394384464
+Create Date: 2026-10-17 04:27:40.401893
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a50896f60ef5'
+down_revision: Union[str, None] = 'e3d394384464'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+VERSIONED_COLLECTIONS = ("users", "roles", "user_roles")
+
+# Every write to a table updates the same collection_versions row, so
+# writers to one table queue on that row's lock until they commit. On
+# Postgres the trigger fires once per statement rather than once per row,
+# which keeps bulk writes to one bump.
+POSTGRES_BUMP_FUNCTION = """
+CREATE FUNCTION bump_collection_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE collection_versions SET version = version + 1 WHERE name = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def _create_trigger(dialect, table, event):
+    name = f"{table}_{event.lower()}_bump_version"
+    if dialect == "sqlite":
+        return f"""
+            CREATE TRIGGER {name} AFTER {event} ON {table}
+            BEGIN
+                UPDATE collection_versions SET version = version + 1 WHERE name = '{table}';
+            END;
+            """
+    return f"""
+        CREATE TRIGGER {name} AFTER {event} ON {table}
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_collection_version();
+        """
+
+
+def upgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect not in ("sqlite", "postgresql"):
+        # Without the triggers the ETags of list endpoints would never change
+        raise NotImplementedError(f"collection version triggers are not defined for {dialect}")
+
+    # Row versions back the ETag of single-row reads
+    op.add_column('users', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('roles', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+    # One counter per table, bumped by triggers on every write, so list
+    # endpoints can answer If-None-Match without scanning the table
+    op.create_table('collection_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), server_default='1', nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    if dialect == "postgresql":
+        op.execute(POSTGRES_BUMP_FUNCTION)
+    for table in VERSIONED_COLLECTIONS:
+        op.execute(f"INSERT INTO collection_versions (name, version) VALUES ('{table}', 1)")
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            op.execute(_create_trigger(dialect, table, event))
+
+
+def downgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    for table in VERSIONED_COLLECTIONS:
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            name = f"{table}_{event.lower()}_bump_version"
+            op.execute(f"DROP TRIGGER IF EXISTS {name}" + (f" ON {table}" if dialect == "postgresql" else ""))
+    if dialect == "postgresql":
+        op.execute("DROP FUNCTION IF EXISTS bump_collection_version()")
+    op.drop_table('collection_versions')
+    with op.batch_alter_table('roles') as batch_op:
+        batch_op.drop_column('version')
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('version')
@@ -0,0 +1,81 @@
+"""full text search
+
+Revision ID: bec8a5ffca1d
+Revises: 718d5266e7c2
+Create Date: 2026-10-17 04:37:19.974589
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'bec8a5ffca1d'
+down_revision: Union[str, None] = '718d5266e7c2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# content table -> indexed column. The FTS tables only hold the index and
+# read the text back from the content table by rowid.
+SEARCH_INDEXES = {"users": "name", "locations": "location"}
+
+
+def _has_fts5(bind):
+    if bind.dialect.name != "sqlite":
+        return False
+    options = {row[0] for row in bind.exec_driver_sql("PRAGMA compile_options")}
+    return "ENABLE_FTS5" in options
+
+
+def upgrade() -> None:
+    # Without FTS5 the search endpoints fall back to LIKE
+    if not _has_fts5(op.get_bind()):
+        return
+    for table, column in SEARCH_INDEXES.items():
+        # Prefix indexes of 2 and 3 characters keep type-ahead queries off
+        # full index scans
+        op.execute(
+            f"""
+            CREATE VIRTUAL TABLE {table}_fts USING fts5(
+                {column}, content='{table}', content_rowid='id', prefix='2 3'
+            );
+            """
+        )
+        op.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+        op.execute(
+            f"""
+            CREATE TRIGGER {table}_insert_fts AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO {table}_fts (rowid, {column}) VALUES (NEW.id, NEW.{column});
+            END;
+            """
+        )
+        op.execute(
+            f"""
+            CREATE TRIGGER {table}_delete_fts AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, {column}) VALUES ('delete', OLD.id, OLD.{column});
+            END;
+            """
+        )
+        op.execute(
+            f"""
+            CREATE TRIGGER {table}_update_fts AFTER UPDATE OF {column} ON {table}
+            BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, {column}) VALUES ('delete', OLD.id, OLD.{column});
+                INSERT INTO {table}_fts (rowid, {column}) VALUES (NEW.id, NEW.{column});
+            END;
+            """
+        )
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    for table in SEARCH_INDEXES:
+        for event in ("insert", "delete", "update"):
+            op.execute(f"DROP TRIGGER IF EXISTS {table}_{event}_fts")
+        op.execute(f"DROP TABLE IF EXISTS {table}_fts")
@@ -0,0 +1,38 @@
+"""unique user role assignments
+
+Revision ID: cb1428de84fb
+Revises: a50896f60ef5
+Create Date: 2026-10-17 04:34:01.365402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'cb1428de84fb'
+down_revision: Union[str, None] = 'a50896f60ef5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Keep the oldest row of every duplicated (user_id, role_id) pair so the
+    # unique index can be built
+    op.execute(
+        """
+        DELETE FROM user_roles
+        WHERE id NOT IN (SELECT MIN(id) FROM user_roles GROUP BY user_id, role_id);
+        """
+    )
+    # Serves the per-user lookups and enforces one assignment per pair
+    op.create_index('ix_user_roles_user_id_role_id', 'user_roles', ['user_id', 'role_id'], unique=True)
+    # Serves the reverse role -> users lookups, already ordered by user_id
+    op.create_index('ix_user_roles_role_id_user_id', 'user_roles', ['role_id', 'user_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_user_roles_role_id_user_id', table_name='user_roles')
+    op.drop_index('ix_user_roles_user_id_role_id', table_name='user_roles')
@@ -0,0 +1,34 @@
+"""data migration checkpoints
+
+Revision ID: ccb4d6a3f90a
+Revises: d7e33202efc8
+Create Date: 2026-10-17 04:56:44.750973
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'ccb4d6a3f90a'
+down_revision: Union[str, None] = 'd7e33202efc8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Progress of the chunked backfills in backfill.py, so an interrupted
+    # run picks up after the last committed chunk
+    op.create_table('data_migration_checkpoints',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('last_key', sa.Integer(), nullable=True),
+    sa.Column('rows', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('data_migration_checkpoints')
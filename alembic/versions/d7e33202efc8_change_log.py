@@ -0,0 +1,121 @@
+"""change log
+
+Revision ID: d7e33202efc8
+Revises: 815a08170193
+Create Date: 2026-10-17 04:53:22.346539
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd7e33202efc8'
+down_revision: Union[str, None] = '815a08170193'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# table -> columns copied into the log entry of inserts and updates
+LOGGED_TABLES = {
+    "users": ("id", "name", "email", "age", "version"),
+    "roles": ("id", "name", "version"),
+    "user_roles": ("id", "user_id", "role_id", "assigned_at"),
+    "locations": ("id", "location"),
+}
+# SQLite stores these as 'YYYY-MM-DD HH:MM:SS.ffffff' text; the log carries
+# the ISO 8601 form that Postgres' json_build_object and the API both use
+DATETIME_COLUMNS = {"assigned_at"}
+
+
+def _sqlite_value(column):
+    if column in DATETIME_COLUMNS:
+        return f"replace(NEW.{column}, ' ', 'T')"
+    return f"NEW.{column}"
+
+
+def _sqlite_triggers(table, columns):
+    row = ", ".join(f"'{column}', {_sqlite_value(column)}" for column in columns)
+    for event in ("INSERT", "UPDATE"):
+        yield f"""
+            CREATE TRIGGER {table}_{event.lower()}_log_change AFTER {event} ON {table}
+            BEGIN
+                INSERT INTO changes (table_name, row_id, op, data)
+                VALUES ('{table}', NEW.id, '{event.lower()}', json_object({row}));
+            END;
+            """
+    yield f"""
+        CREATE TRIGGER {table}_delete_log_change AFTER DELETE ON {table}
+        BEGIN
+            INSERT INTO changes (table_name, row_id, op) VALUES ('{table}', OLD.id, 'delete');
+        END;
+        """
+
+
+def _postgres_triggers(table, columns):
+    # One function per table; the triggers keep the SQLite names. Sequence
+    # values are handed out before commit, so two writers could commit seq
+    # N+1 before seq N and a reader polling in between would skip N for
+    # good. The transaction-scoped lock makes logging writers take their
+    # seqs one transaction at a time and hold them until commit, as SQLite's
+    # single write lock already does.
+    row = ", ".join(f"'{column}', NEW.{column}" for column in columns)
+    yield f"""
+        CREATE FUNCTION {table}_log_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_advisory_xact_lock('changes'::regclass::oid::bigint);
+            IF TG_OP = 'DELETE' THEN
+                INSERT INTO changes (table_name, row_id, op) VALUES ('{table}', OLD.id, 'delete');
+            ELSE
+                INSERT INTO changes (table_name, row_id, op, data)
+                VALUES ('{table}', NEW.id, lower(TG_OP), json_build_object({row}));
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        yield f"""
+            CREATE TRIGGER {table}_{event.lower()}_log_change AFTER {event} ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {table}_log_change();
+            """
+
+
+TRIGGERS = {"sqlite": _sqlite_triggers, "postgresql": _postgres_triggers}
+
+
+def upgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect not in TRIGGERS:
+        # Without the triggers the log would silently miss every change
+        raise NotImplementedError(f"change log triggers are not defined for {dialect}")
+
+    # AUTOINCREMENT so a sequence number is never reused, even if old
+    # entries are pruned later
+    op.create_table('changes',
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('op', sa.String(), nullable=False),
+    sa.Column('data', sa.JSON(), nullable=True),
+    sa.Column('changed_at', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+    sa.PrimaryKeyConstraint('seq'),
+    sqlite_autoincrement=True,
+    )
+    # Triggers write the log in the transaction of the change itself, bulk
+    # endpoints and cascaded deletes included
+    for table, columns in LOGGED_TABLES.items():
+        for statement in TRIGGERS[dialect](table, columns):
+            op.execute(statement)
+
+
+def downgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    for table in LOGGED_TABLES:
+        for event in ("insert", "update", "delete"):
+            op.execute(f"DROP TRIGGER IF EXISTS {table}_{event}_log_change" + (f" ON {table}" if dialect == "postgresql" else ""))
+        if dialect == "postgresql":
+            op.execute(f"DROP FUNCTION IF EXISTS {table}_log_change()")
+    op.drop_table('changes')
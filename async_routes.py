@@ -0,0 +1,254 @@
+from typing import Literal
+
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import bulk
+import services
+from database import get_async_db, get_async_sessionmaker
+from models import User, Location
+from schemas import (
+    UserCreate, UserResponse, RoleCreate, RoleResponse, UserRoleCreate,
+    UserRoleResponse, UserRoleResponsejoin, RoleCheck, RoleStats,
+    LocationCreate, LocationResponse, ImportResponse, BulkResponse, ChangesResponse,
+)
+from pagination import Page, PageParams
+from export import EXPORT_TABLES, FORMATS, stream_table_async
+from importer import import_locations, insert_locations
+from search import DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT
+from metrics import InstrumentedRoute
+from cache import cache, user_key, role_key, roles_page_key, user_roles_key
+from etag import make_etag, is_not_modified, not_modified
+from serialization import FAST_SERIALIZATION, FastJSONResponse
+from changes import DEFAULT_CHANGES_LIMIT, MAX_CHANGES_LIMIT, load_changes_async, last_event_id, stream_changes
+
+# Async versions of the handlers in main.py. They replace the sync ones
+# when DB_MODE=async. Both call the same functions in services.py; here they
+# run on the AsyncSession's connection through run_sync.
+router = APIRouter(route_class=InstrumentedRoute)
+
+
+def cached_load(sessions, fn, *args):
+    """Cache load running ``fn`` on a session of its own: the single flight
+    shares the load with other requests, and it may outlive the request that
+    started it."""
+    async def load():
+        async with sessions() as db:
+            return await db.run_sync(fn, *args)
+    return load
+
+
+@router.post("/users", response_model=UserResponse)
+async def create_user(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.create_user, user)
+
+@router.post("/users/bulk", response_model=BulkResponse)
+async def bulk_upsert_users(users: list[UserCreate], db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.upsert_users, users)
+
+@router.put("/users/{user_id}", response_model=UserResponse)
+async def update_user(user_id: int, user: UserCreate, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.update_user, user_id, user)
+
+@router.delete("/users/{user_id}")
+async def delete_user(user_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.delete_user, user_id)
+
+@router.get("/users", response_model=Page[UserResponse])
+async def get_users(
+    request: Request, response: Response, page: PageParams = Depends(), db: AsyncSession = Depends(get_async_db)
+):
+    etag = await db.run_sync(services.collection_etag, "users", page)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return await db.run_sync(services.list_page, User, UserResponse, page, headers={"ETag": etag})
+
+@router.get("/users/search", response_model=list[UserResponse])
+async def search_users(
+    q: str = Query(min_length=1),
+    limit: int = Query(DEFAULT_SEARCH_LIMIT, ge=1, le=MAX_SEARCH_LIMIT),
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await db.run_sync(services.search, "users", q, limit)
+
+@router.get("/users/{user_id}", response_model=UserResponse)
+async def get_user(user_id: int, request: Request, response: Response, sessions=Depends(get_async_sessionmaker)):
+    entry = await cache.get_or_load_async(user_key(user_id), cached_load(sessions, services.load_user, user_id))
+    if is_not_modified(request, entry["etag"]):
+        return not_modified(entry["etag"])
+    response.headers["ETag"] = entry["etag"]
+    return entry["body"]
+
+@router.get("/users/{user_id}/has_role/{role_id}", response_model=RoleCheck)
+async def has_role(user_id: int, role_id: int, db: AsyncSession = Depends(get_async_db)):
+    [check] = await db.run_sync(services.check_roles, [(user_id, role_id)])
+    return check
+
+
+@router.post("/roles", response_model=RoleResponse)
+async def post_role(role: RoleCreate, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.create_role, role)
+
+@router.post("/roles/bulk", response_model=BulkResponse)
+async def bulk_create_roles(roles: list[RoleCreate], db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.create_roles, roles)
+
+@router.get("/roles", response_model=Page[RoleResponse])
+async def get_roles(
+    request: Request,
+    response: Response,
+    page: PageParams = Depends(),
+    db: AsyncSession = Depends(get_async_db),
+    sessions=Depends(get_async_sessionmaker),
+):
+    version = await db.run_sync(services.roles_version)
+    etag = make_etag("roles", version, page.cursor, page.limit)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    result = await cache.get_or_load_async(
+        roles_page_key(version, page.cursor, page.limit), cached_load(sessions, services.load_roles_page, page)
+    )
+    if FAST_SERIALIZATION:
+        return FastJSONResponse(result, headers={"ETag": etag})
+    return result
+
+@router.get("/roles/stats", response_model=list[RoleStats])
+async def get_role_stats(
+    request: Request,
+    response: Response,
+    source: Literal["aggregate", "counter"] = "aggregate",
+    db: AsyncSession = Depends(get_async_db),
+):
+    etag = await db.run_sync(services.role_stats_etag, source)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return await db.run_sync(services.role_stats, source)
+
+@router.get("/roles/{role_id}", response_model=RoleResponse)
+async def get_role(role_id: int, sessions=Depends(get_async_sessionmaker)):
+    return await cache.get_or_load_async(role_key(role_id), cached_load(sessions, services.load_role, role_id))
+
+@router.get("/roles/{role_id}/users", response_model=Page[UserResponse])
+async def get_role_users(role_id: int, page: PageParams = Depends(), db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.role_users, role_id, page)
+
+@router.put("/roles/{role_id}", response_model=RoleResponse)
+async def update_role(role_id: int, role: RoleCreate, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.update_role, role_id, role)
+
+@router.delete("/roles/{role_id}")
+async def delete_role(role_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.delete_role, role_id)
+
+
+@router.post("/user_roles", response_model=UserRoleResponse)
+async def assign_role_to_user(user_role: UserRoleCreate, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.assign_role, user_role.user_id, user_role.role_id)
+
+@router.post("/user_roles/bulk", response_model=BulkResponse)
+async def bulk_assign_roles(user_roles: list[UserRoleCreate], db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.assign_roles, user_roles)
+
+@router.get("/user_roles", response_model=Page[UserRoleResponse])
+async def get_user_roles(
+    request: Request, response: Response, page: PageParams = Depends(), db: AsyncSession = Depends(get_async_db)
+):
+    etag = await db.run_sync(services.collection_etag, "user_roles", page)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return await db.run_sync(services.list_assignments, page, headers={"ETag": etag})
+
+@router.get("/user_roles/{user_id}", response_model=list[UserRoleResponsejoin])
+async def get_roles_for_user(
+    user_id: int,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
+    sessions=Depends(get_async_sessionmaker),
+):
+    etag = await db.run_sync(services.user_roles_etag, user_id)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return await cache.get_or_load_async(user_roles_key(user_id, etag), cached_load(sessions, services.load_user_roles, user_id))
+
+
+@router.delete("/user_roles/{user_id}/{role_id}")
+async def unassign_role(user_id: int, role_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.unassign_role, user_id, role_id)
+
+@router.post("/user_roles/check", response_model=list[RoleCheck])
+async def check_roles(checks: list[UserRoleCreate], db: AsyncSession = Depends(get_async_db)):
+    bulk.check_size(checks)
+    return await db.run_sync(services.check_roles, [(check.user_id, check.role_id) for check in checks])
+
+
+@router.post("/locations", response_model=LocationResponse)
+async def create_location(location: LocationCreate, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.create_location, location)
+
+@router.post("/locations/import", response_model=ImportResponse)
+async def import_locations_upload(
+    request: Request, format: Literal["ndjson", "csv"] = "ndjson", db: AsyncSession = Depends(get_async_db)
+):
+    async def insert_batch(names):
+        return await db.run_sync(insert_locations, names)
+    return await import_locations(request.stream(), format, insert_batch)
+
+@router.get("/locations", response_model=Page[LocationResponse])
+async def get_locations(page: PageParams = Depends(), db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.list_page, Location, LocationResponse, page)
+
+@router.get("/locations/search", response_model=list[LocationResponse])
+async def search_locations(
+    q: str = Query(min_length=1),
+    limit: int = Query(DEFAULT_SEARCH_LIMIT, ge=1, le=MAX_SEARCH_LIMIT),
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await db.run_sync(services.search, "locations", q, limit)
+
+@router.get("/locations/{location_id}", response_model=LocationResponse)
+async def get_location(location_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.get_location, location_id)
+
+@router.put("/locations/{location_id}", response_model=LocationResponse)
+async def update_location(location_id: int, location: LocationCreate, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.update_location, location_id, location)
+
+@router.delete("/locations/{location_id}")
+async def delete_location(location_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(services.delete_location, location_id)
+
+
+@router.get("/export/{table}")
+async def export_table(table: str, format: Literal["ndjson", "csv"] = "ndjson", db: AsyncSession = Depends(get_async_db)):
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail="Table not found")
+    return StreamingResponse(
+        stream_table_async(db, table, format),
+        media_type=FORMATS[format].media_type,
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'},
+    )
+
+
+@router.get("/changes", response_model=ChangesResponse)
+async def get_changes(
+    since: int = Query(0, ge=0),
+    limit: int = Query(DEFAULT_CHANGES_LIMIT, ge=1, le=MAX_CHANGES_LIMIT),
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await db.run_sync(services.list_changes, since, limit)
+
+@router.get("/changes/stream")
+async def stream_change_feed(request: Request, since: int = Query(0, ge=0)):
+    since = last_event_id(request.headers.get("last-event-id"), since)
+    return StreamingResponse(
+        stream_changes(load_changes_async, since, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
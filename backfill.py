@@ -0,0 +1,120 @@
+"""Chunked, resumable data migrations for Alembic revisions.
+
+Instead of one ``op.execute`` over the whole table, a revision calls::
+
+    from backfill import backfill
+
+    def upgrade():
+        backfill(
+            "users_lowercase_email", "users",
+            "UPDATE users SET email = lower(email) WHERE id > :lower AND id <= :upper",
+        )
+
+The statement runs once per chunk of keys, with ``:lower`` (exclusive) and
+``:upper`` (inclusive) bound to the chunk's range. Each chunk commits in its
+own transaction together with a checkpoint row, so locks are held for one
+chunk at a time and a run that is interrupted continues after the last
+committed chunk when the migration is run again. Because of that, keep a
+backfill in a revision of its own (or after DDL that can safely run twice).
+"""
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import column, delete, func, insert, select, table as sql_table, text, update
+
+import config
+from models import DataMigrationCheckpoint
+
+logger = logging.getLogger("alembic.backfill")
+
+checkpoints = DataMigrationCheckpoint.__table__
+
+
+def run_backfill(
+    engine,
+    name,
+    table,
+    statement,
+    key="id",
+    chunk_size=config.BACKFILL_CHUNK_SIZE,
+    rows_per_second=config.BACKFILL_ROWS_PER_SECOND,
+):
+    """Apply ``statement`` to ``table`` in chunks of ``chunk_size`` rows,
+    ordered by the integer column ``key``. Returns the rows covered by this
+    run; 0 when the checkpoint says ``name`` already finished."""
+    statement = text(statement) if isinstance(statement, str) else statement
+    key_column = column(key)
+    source = sql_table(table, key_column)
+    with engine.connect() as connection:
+        with connection.begin():
+            checkpoint = connection.execute(select(checkpoints).where(checkpoints.c.name == name)).first()
+            if checkpoint is None:
+                connection.execute(insert(checkpoints).values(name=name))
+            elif checkpoint.finished_at is not None:
+                logger.info("%s: already done", name)
+                return 0
+            lower = checkpoint.last_key if checkpoint is not None else None
+            if lower is None:
+                lower = connection.scalar(select(func.min(key_column) - 1).select_from(source))
+            total = 0
+            if lower is not None:
+                total = connection.scalar(select(func.count()).select_from(source).where(key_column > lower))
+        if lower is not None and checkpoint is not None:
+            logger.info("%s: resuming after %s %s", name, key, lower)
+
+        done = 0
+        started = time.monotonic()
+        while True:
+            with connection.begin():
+                keys = select(key_column).select_from(source)
+                if lower is not None:
+                    keys = keys.where(key_column > lower)
+                keys = keys.order_by(key_column).limit(chunk_size).subquery()
+                count, upper = connection.execute(select(func.count(), func.max(keys.c[key]))).one()
+                if not count:
+                    connection.execute(
+                        update(checkpoints).where(checkpoints.c.name == name).values(finished_at=datetime.utcnow())
+                    )
+                    break
+                connection.execute(statement, {"lower": lower, "upper": upper})
+                connection.execute(
+                    update(checkpoints)
+                    .where(checkpoints.c.name == name)
+                    .values(last_key=upper, rows=checkpoints.c.rows + count)
+                )
+            lower = upper
+            done += count
+            elapsed = time.monotonic() - started
+            logger.info(
+                "%s: %d/%d rows (%.0f%%), %.0f rows/s",
+                name, done, max(total, done), 100 * done / max(total, done), done / elapsed if elapsed else 0,
+            )
+            if rows_per_second:
+                # Stay under the target rate averaged over the run
+                pause = done / rows_per_second - elapsed
+                if pause > 0:
+                    time.sleep(pause)
+    logger.info("%s: done, %d rows", name, done)
+    return done
+
+
+def backfill(name, table, statement, **options):
+    """``run_backfill`` for use inside a revision's ``upgrade()``. The
+    revision's transaction is committed first, so that chunks can commit on
+    their own."""
+    from alembic import op
+
+    context = op.get_context()
+    if context.as_sql:
+        raise RuntimeError(f"Backfill {name} needs a database connection and cannot run in --sql mode")
+    with context.autocommit_block():
+        return run_backfill(op.get_bind().engine, name, table, statement, **options)
+
+
+def forget_backfill(name):
+    """Drop the checkpoint of ``name``, for a revision's ``downgrade()``, so
+    the backfill runs again on the next upgrade."""
+    from alembic import op
+
+    op.execute(delete(checkpoints).where(checkpoints.c.name == name))
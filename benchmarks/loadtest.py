@@ -0,0 +1,233 @@
+"""Replay a JSONL request trace against the app and report latency per route.
+
+In-process, against a freshly seeded database:
+
+    python -m benchmarks.loadtest --users 10000 --requests 5000 --concurrency 32 --out run.json
+
+Over HTTP, against a server started on a database seeded with
+``python -m benchmarks.seed``:
+
+    python -m benchmarks.loadtest --url http://localhost:8000 --user-ids 2:10002 --role-ids 1:21
+
+Each trace line is ``{"method", "path", "params"?, "json"?, "weight"?}``.
+``{user_id}`` and ``{role_id}`` are filled from the seeded id ranges and
+``{n}`` with a counter that is unique per request. When lines carry a
+``weight`` the trace is a mix that ``--requests`` requests are sampled
+from; otherwise it is replayed line by line.
+
+Pass ``--baseline`` with an earlier ``--out`` file to flag routes whose p95
+latency or throughput got worse by more than ``--threshold``.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from benchmarks.cli import positive_int
+
+DEFAULT_TRACE = Path(__file__).parent / "traces" / "sample.jsonl"
+PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+
+def load_trace(path):
+    with open(path) as trace:
+        return [json.loads(line) for line in trace if line.strip()]
+
+
+def _fill(value, env):
+    if isinstance(value, str):
+        whole = PLACEHOLDER.fullmatch(value)
+        if whole:
+            return env[whole.group(1)]
+        return PLACEHOLDER.sub(lambda match: str(env[match.group(1)]), value)
+    if isinstance(value, dict):
+        return {key: _fill(item, env) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_fill(item, env) for item in value]
+    return value
+
+
+def build_requests(trace, count, user_ids, role_ids, rng_seed=0):
+    """Expand the trace into concrete requests, deterministically."""
+    rng = random.Random(rng_seed)
+    if any("weight" in entry for entry in trace):
+        entries = rng.choices(trace, weights=[entry.get("weight", 1) for entry in trace], k=count)
+    else:
+        entries = trace
+    requests = []
+    for n, entry in enumerate(entries):
+        env = {"n": n, "user_id": rng.randrange(*user_ids), "role_id": rng.randrange(*role_ids)}
+        requests.append({
+            "route": f"{entry['method']} {entry['path']}",
+            "method": entry["method"],
+            "url": _fill(entry["path"], env),
+            "params": _fill(entry.get("params"), env),
+            "json": _fill(entry.get("json"), env),
+        })
+    return requests
+
+
+async def replay(client, requests, concurrency):
+    samples = {}
+    pending = iter(requests)
+
+    async def worker():
+        for request in pending:
+            start = time.perf_counter()
+            try:
+                response = await client.request(
+                    request["method"], request["url"], params=request["params"], json=request["json"]
+                )
+                ok = response.status_code < 500
+            except httpx.HTTPError:
+                ok = False
+            samples.setdefault(request["route"], []).append((time.perf_counter() - start, ok))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples, time.perf_counter() - start
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+def report(samples, elapsed):
+    routes = {
+        route: summarize([latency for latency, _ in values], sum(not ok for _, ok in values), elapsed)
+        for route, values in sorted(samples.items())
+    }
+    everything = list(itertools.chain.from_iterable(samples.values()))
+    total = summarize([latency for latency, _ in everything], sum(not ok for _, ok in everything), elapsed)
+    return {"routes": routes, "total": total, "elapsed_s": elapsed}
+
+
+def compare(result, baseline, threshold):
+    """Routes whose p95 grew or whose throughput fell by more than ``threshold``."""
+    regressions = []
+    for route, current in result["routes"].items():
+        before = baseline["routes"].get(route)
+        if before is None:
+            continue
+        if current["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            regressions.append(f"{route}: p95 {before['p95_ms']:.2f} -> {current['p95_ms']:.2f} ms")
+        if current["rps"] < before["rps"] * (1 - threshold):
+            regressions.append(f"{route}: throughput {before['rps']:.0f} -> {current['rps']:.0f} req/s")
+    return regressions
+
+
+def print_table(result):
+    print(f"{'route':<36} {'count':>7} {'err':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+    for route, row in list(result["routes"].items()) + [("TOTAL", result["total"])]:
+        print(
+            f"{route:<36} {row['count']:>7} {row['errors']:>5} {row['p50_ms']:>8.2f} "
+            f"{row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['rps']:>8.0f}"
+        )
+
+
+def _id_range(text):
+    start, stop = text.split(":")
+    return [int(start), int(stop)]
+
+
+async def run_in_process(requests, concurrency):
+    from main import app
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            return await replay(client, requests, concurrency)
+
+
+async def run_over_http(url, requests, concurrency):
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits) as client:
+        return await replay(client, requests, concurrency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a request trace and report latency per route.")
+    parser.add_argument("--trace", default=str(DEFAULT_TRACE))
+    parser.add_argument("--requests", type=positive_int, default=2000, help="requests to sample from a weighted trace")
+    parser.add_argument("--concurrency", type=positive_int, default=16)
+    parser.add_argument("--url", help="replay over HTTP against this server instead of in-process")
+    parser.add_argument("--db", help="SQLite file to seed for the in-process run (default: a temp file)")
+    parser.add_argument("--users", type=positive_int, default=10000)
+    parser.add_argument("--roles", type=positive_int, default=20)
+    parser.add_argument("--roles-per-user", type=positive_int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--user-ids", type=_id_range, help="start:stop of existing user ids (HTTP mode)")
+    parser.add_argument("--role-ids", type=_id_range, help="start:stop of existing role ids (HTTP mode)")
+    parser.add_argument("--out", help="write the results as JSON")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+
+    if args.url and not (args.user_ids and args.role_ids):
+        parser.error("--url needs --user-ids and --role-ids")
+    trace = load_trace(args.trace)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if not args.url:
+            # The app modules read DATABASE_URL when first imported, so point
+            # it at the benchmark database before importing any of them
+            os.environ["DATABASE_URL"] = f"sqlite:///{args.db or Path(tmp) / 'bench.db'}"
+        from benchmarks.seed import Dataset, seed
+
+        dataset = Dataset(args.users, args.roles, args.roles_per_user, args.seed)
+        if args.url:
+            ranges = {"user_ids": args.user_ids, "role_ids": args.role_ids}
+        else:
+            ranges = seed(os.environ["DATABASE_URL"], dataset)
+
+        requests = build_requests(trace, args.requests, ranges["user_ids"], ranges["role_ids"], args.seed)
+        if args.url:
+            samples, elapsed = asyncio.run(run_over_http(args.url, requests, args.concurrency))
+        else:
+            samples, elapsed = asyncio.run(run_in_process(requests, args.concurrency))
+
+    result = report(samples, elapsed)
+    result["meta"] = {
+        "trace": args.trace,
+        "mode": "http" if args.url else "in-process",
+        "concurrency": args.concurrency,
+        "dataset": vars(dataset),
+    }
+    print_table(result)
+
+    if args.out:
+        Path(args.out).write_text(json.dumps(result, indent=2))
+    if args.baseline:
+        regressions = compare(result, json.loads(Path(args.baseline).read_text()), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
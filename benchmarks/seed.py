@@ -0,0 +1,99 @@
+"""Create a migrated SQLite database filled with synthetic users, roles and
+role assignments.
+
+    python -m benchmarks.seed bench.db --users 100000 --roles 50 --roles-per-user 3
+"""
+import argparse
+import random
+import time
+from dataclasses import dataclass
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import insert
+
+from benchmarks.cli import positive_int
+from database import create_db_engine
+from models import User, Role, UserRole
+
+BATCH_SIZE = 5000
+
+
+@dataclass
+class Dataset:
+    users: int = 10000
+    roles: int = 20
+    roles_per_user: int = 2
+    seed: int = 0
+
+
+def migrate(url):
+    config = Config("alembic.ini")
+    config.set_main_option("sqlalchemy.url", url)
+    command.upgrade(config, "head")
+
+
+def _batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def seed(url, dataset: Dataset):
+    """Migrate ``url`` and fill it with ``dataset``. Returns the id ranges the
+    load test can draw from."""
+    migrate(url)
+    rng = random.Random(dataset.seed)
+    engine = create_db_engine(url)
+    with engine.begin() as connection:
+        first_role = connection.execute(
+            insert(Role).returning(Role.id, sort_by_parameter_order=True),
+            [{"name": f"bench role {i}"} for i in range(dataset.roles)],
+        ).scalars().all()[0]
+        role_ids = range(first_role, first_role + dataset.roles)
+
+        first_user = None
+        for batch in _batches(
+            {"name": f"bench user {i}", "email": f"bench{i}@example.com", "age": rng.randint(18, 90)}
+            for i in range(dataset.users)
+        ):
+            ids = connection.execute(insert(User).returning(User.id, sort_by_parameter_order=True), batch).scalars().all()
+            if first_user is None:
+                first_user = ids[0]
+        user_ids = range(first_user, first_user + dataset.users) if dataset.users else range(0)
+
+        per_user = min(dataset.roles_per_user, dataset.roles)
+        for batch in _batches(
+            {"user_id": user_id, "role_id": role_id}
+            for user_id in user_ids
+            for role_id in rng.sample(role_ids, per_user)
+        ):
+            connection.execute(insert(UserRole), batch)
+    engine.dispose()
+    return {"user_ids": [user_ids.start, user_ids.stop], "role_ids": [role_ids.start, role_ids.stop]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed a benchmark database.")
+    parser.add_argument("path", help="SQLite file to create")
+    parser.add_argument("--users", type=positive_int, default=Dataset.users)
+    parser.add_argument("--roles", type=positive_int, default=Dataset.roles)
+    parser.add_argument("--roles-per-user", type=positive_int, default=Dataset.roles_per_user)
+    parser.add_argument("--seed", type=int, default=Dataset.seed)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    ranges = seed(
+        f"sqlite:///{args.path}",
+        Dataset(args.users, args.roles, args.roles_per_user, args.seed),
+    )
+    print(f"seeded {args.path} in {time.perf_counter() - start:.1f}s: {ranges}")
+
+
+if __name__ == "__main__":
+    main()
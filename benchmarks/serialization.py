@@ -0,0 +1,89 @@
+"""Compare the two list serialization paths at growing row counts.
+
+    python -m benchmarks.serialization --sizes 1000 10000 100000
+
+"pydantic" is what the list endpoints do by default: load ORM objects,
+validate them into the response model and encode the result. "fast" is
+SERIALIZATION_MODE=fast: select the response columns as tuples and encode
+them with orjson.
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from benchmarks.cli import positive_int
+from database import Base, create_db_engine
+from models import User
+from pagination import Page
+from schemas import UserResponse
+from serialization import model_columns, row_dicts
+
+PageOfUsers = Page[UserResponse]
+
+
+def seed(engine, rows):
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            insert(User),
+            [{"name": f"user {i}", "email": f"user{i}@example.com", "age": i % 90} for i in range(rows)],
+        )
+
+
+def pydantic_path(db):
+    users = db.scalars(select(User).order_by(User.id)).all()
+    page = PageOfUsers.model_validate({"items": users, "next_cursor": None})
+    return json.dumps(jsonable_encoder(page)).encode()
+
+
+def pydantic_json_path(db):
+    # FastAPI's own path when a response_model is set: validate, then dump
+    # straight to JSON bytes
+    users = db.scalars(select(User).order_by(User.id)).all()
+    return PageOfUsers.model_validate({"items": users, "next_cursor": None}).model_dump_json().encode()
+
+
+def fast_path(db):
+    rows = db.execute(select(*model_columns(User, UserResponse)).order_by(User.id))
+    return orjson.dumps({"items": row_dicts(rows), "next_cursor": None})
+
+
+PATHS = {"pydantic": pydantic_path, "pydantic_json": pydantic_json_path, "fast": fast_path}
+
+
+def best_of(engine, path, repeat):
+    timings = []
+    for _ in range(repeat):
+        with Session(engine) as db:
+            start = time.perf_counter()
+            path(db)
+            timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=positive_int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=positive_int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} " + " ".join(f"{name:>14}" for name in PATHS) + "   speedup")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            engine = create_db_engine(f"sqlite:///{Path(tmp) / f'bench_{size}.db'}")
+            seed(engine, size)
+            results = {name: best_of(engine, path, args.repeat) for name, path in PATHS.items()}
+            engine.dispose()
+            cells = " ".join(f"{results[name] * 1000:>11.1f} ms" for name in PATHS)
+            print(f"{size:>8} {cells}   {results['pydantic'] / results['fast']:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
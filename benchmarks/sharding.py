@@ -0,0 +1,56 @@
+"""Measure user-creation throughput as the number of SQLite shards grows.
+
+    python -m benchmarks.sharding --shards 1 2 4 8 --users 2000 --writers 8
+
+Each run migrates K fresh database files and has ``--writers`` threads call
+the sharded create-user handler. A create first looks the email up on all K
+shards in parallel, since emails are unique across shards, then commits the
+user on one shard. SQLite allows one writer per file, so only the commits
+spread over K write locks; the email lookup is paid on every shard and grows
+with K. The numbers are end-to-end creates, lookup included.
+"""
+import argparse
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import database
+import sharding
+from benchmarks.cli import positive_int
+from database import create_db_engine
+from schemas import UserCreate
+from sharded_routes import create_user
+
+
+def run(shard_count, users, writers, directory):
+    urls = [f"sqlite:///{Path(directory) / f'k{shard_count}_shard{i}.db'}" for i in range(shard_count)]
+    sharding.migrate(urls)
+    database.shards = sharding.ShardSet([create_db_engine(url) for url in urls])
+    payloads = [UserCreate(name=f"user {i}", email=f"k{shard_count}_{i}@example.com", age=i % 90) for i in range(users)]
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=writers) as pool:
+            list(pool.map(create_user, payloads))
+        return time.perf_counter() - start
+    finally:
+        for engine in database.shards.engines:
+            engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=positive_int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--users", type=positive_int, default=2000)
+    parser.add_argument("--writers", type=positive_int, default=8)
+    args = parser.parse_args()
+
+    print(f"{'shards':>6} {'seconds':>9} {'users/s':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for shard_count in args.shards:
+            seconds = run(shard_count, args.users, args.writers, tmp)
+            print(f"{shard_count:>6} {seconds:>9.2f} {args.users / seconds:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
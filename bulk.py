@@ -0,0 +1,124 @@
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import User, Role, UserRole
+
+MAX_BULK_ITEMS = 10000
+# Keep IN (...) lists well below SQLite's bound-parameter limit
+LOOKUP_CHUNK_SIZE = 500
+
+
+def dialect_insert(db, table):
+    # ON CONFLICT needs the dialect-specific insert construct
+    if db.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def _chunks(values, size=LOOKUP_CHUNK_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _existing(db, column, values):
+    found = set()
+    for chunk in _chunks(values):
+        found.update(db.scalars(select(column).where(column.in_(chunk))))
+    return found
+
+
+def check_size(items):
+    if len(items) > MAX_BULK_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_ITEMS} items per request")
+
+
+def _summary(results):
+    counts = {"created": 0, "updated": 0, "conflict": 0}
+    for result in results:
+        counts[result["status"]] += 1
+    return {**counts, "results": results}
+
+
+def _first_occurrences(values, results):
+    # Later duplicates inside the same batch are reported as conflicts
+    first = {}
+    for index, value in enumerate(values):
+        if value in first:
+            results[index] = {"index": index, "status": "conflict", "id": None}
+        else:
+            first[value] = index
+    return first
+
+
+def upsert_users(db, users):
+    """Insert new users and update existing ones, matched by email."""
+    results = [None] * len(users)
+    first = _first_occurrences([user.email for user in users], results)
+    if first:
+        existing = _existing(db, User.email, list(first))
+        table = User.__table__
+        stmt = dialect_insert(db, table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.email],
+            set_={"name": stmt.excluded.name, "age": stmt.excluded.age, "version": table.c.version + 1},
+        ).returning(table.c.id, table.c.email)
+        rows = db.execute(
+            stmt,
+            [{"name": users[i].name, "email": users[i].email, "age": users[i].age} for i in first.values()],
+        )
+        for user_id, email in rows:
+            index = first[email]
+            status = "updated" if email in existing else "created"
+            results[index] = {"index": index, "status": status, "id": user_id}
+    db.commit()
+    return _summary(results)
+
+
+def create_roles(db, roles):
+    """Insert roles whose name is not taken yet; existing names are conflicts."""
+    results = [None] * len(roles)
+    first = _first_occurrences([role.name for role in roles], results)
+    if first:
+        table = Role.__table__
+        stmt = (
+            dialect_insert(db, table)
+            .on_conflict_do_nothing(index_elements=[table.c.name])
+            .returning(table.c.id, table.c.name)
+        )
+        rows = db.execute(stmt, [{"name": name} for name in first])
+        for role_id, name in rows:
+            index = first.pop(name)
+            results[index] = {"index": index, "status": "created", "id": role_id}
+    for index in first.values():
+        results[index] = {"index": index, "status": "conflict", "id": None}
+    db.commit()
+    return _summary(results)
+
+
+def assign_roles(db, assignments):
+    """Insert role assignments; pairs naming an unknown user or role, or
+    already assigned, are conflicts."""
+    results = [None] * len(assignments)
+    users = _existing(db, User.id, list({item.user_id for item in assignments}))
+    roles = _existing(db, Role.id, list({item.role_id for item in assignments}))
+    first = _first_occurrences([(item.user_id, item.role_id) for item in assignments], results)
+    for pair, index in list(first.items()):
+        if pair[0] not in users or pair[1] not in roles:
+            del first[pair]
+            results[index] = {"index": index, "status": "conflict", "id": None}
+    if first:
+        table = UserRole.__table__
+        stmt = (
+            dialect_insert(db, table)
+            .on_conflict_do_nothing(index_elements=[table.c.user_id, table.c.role_id])
+            .returning(table.c.id, table.c.user_id, table.c.role_id)
+        )
+        rows = db.execute(stmt, [{"user_id": user_id, "role_id": role_id} for user_id, role_id in first])
+        for assignment_id, user_id, role_id in rows:
+            index = first.pop((user_id, role_id))
+            results[index] = {"index": index, "status": "created", "id": assignment_id}
+    for index in first.values():
+        results[index] = {"index": index, "status": "conflict", "id": None}
+    db.commit()
+    return _summary(results)
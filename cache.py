@@ -0,0 +1,224 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+import config
+from singleflight import SingleFlight
+
+MISSING = object()
+
+
+class CacheBackend(ABC):
+    """Storage used by ``Cache``. Values are plain JSON-compatible data, so a
+    shared store (Redis, memcached, ...) can implement this interface for
+    multi-process deployments."""
+
+    @abstractmethod
+    def get(self, key):
+        """Return the stored value or ``MISSING``."""
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        ...
+
+    @abstractmethod
+    def delete(self, key):
+        ...
+
+    @abstractmethod
+    def delete_prefix(self, prefix):
+        ...
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+    @abstractmethod
+    def __len__(self):
+        ...
+
+
+class MemoryBackend(CacheBackend):
+    """Per-process LRU store with per-entry expiry."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Cache:
+    """Read-through cache with hit/miss counters. Concurrent misses on the
+    same key share one load."""
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.flights = SingleFlight()
+        # Guards the counters and the generation; handlers run on the
+        # threadpool, where ``+=`` on an attribute is not atomic
+        self._lock = threading.Lock()
+        # Bumped by every invalidation; a load that overlapped one is
+        # returned to its callers but not stored
+        self._generation = 0
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value, self.ttl)
+
+    def get_or_load(self, key, load, fill=True):
+        """``fill=False`` is for loads that may return stale data, such as
+        replica reads: they use a cached value but neither join a flight
+        nor store what they load, so the cache only ever holds primary
+        reads."""
+        value = self.get(key)
+        if value is MISSING:
+            if not fill:
+                return load()
+            value = self.flights.do(key, lambda: self._load(key, load))
+        return value
+
+    async def get_or_load_async(self, key, load):
+        value = self.get(key)
+        if value is MISSING:
+            value = await self.flights.do_async(key, lambda: self._load_async(key, load))
+        return value
+
+    def _load(self, key, load):
+        generation = self._generation
+        value = load()
+        if generation == self._generation:
+            self.set(key, value)
+        return value
+
+    async def _load_async(self, key, load):
+        generation = self._generation
+        value = await load()
+        if generation == self._generation:
+            self.set(key, value)
+        return value
+
+    def _bump_generation(self):
+        with self._lock:
+            self._generation += 1
+
+    def invalidate(self, *keys):
+        self._bump_generation()
+        for key in keys:
+            self.backend.delete(key)
+            self.flights.forget(key)
+
+    def invalidate_prefix(self, prefix):
+        self._bump_generation()
+        self.backend.delete_prefix(prefix)
+        self.flights.forget_prefix(prefix)
+
+    def clear(self):
+        self._bump_generation()
+        self.backend.clear()
+        self.flights.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "coalesced": self.flights.coalesced,
+            "entries": len(self.backend),
+        }
+
+
+cache = Cache(MemoryBackend(config.CACHE_MAX_ENTRIES), config.CACHE_TTL_SECONDS)
+
+
+# Cache keys shared by the sync and async handlers
+def user_key(user_id):
+    return f"user:{user_id}"
+
+def role_key(role_id):
+    return f"role:{role_id}"
+
+def role_name_key(name):
+    return f"role_name:{name}"
+
+def roles_page_key(version, cursor, limit):
+    # Keyed on the collection version so writes from other processes also
+    # move readers onto a fresh entry
+    return f"roles:{version}:{cursor or ''}:{limit}"
+
+def user_roles_key(user_id, etag=""):
+    # Keyed on the ETag, which is derived from the collection versions, so
+    # the cached body always matches the ETag sent with it
+    return f"user_roles:{user_id}:{etag}"
+
+
+def invalidate_user(user_id):
+    # The joined /user_roles/{user_id} rows carry the user's name
+    cache.invalidate(user_key(user_id))
+    cache.invalidate_prefix(user_roles_key(user_id))
+
+def invalidate_roles(role_id=None, name=None):
+    cache.invalidate_prefix("roles:")
+    if role_id is not None:
+        cache.invalidate(role_key(role_id))
+        # Any user's joined assignments may carry this role's name
+        cache.invalidate_prefix("user_roles:")
+    if name is not None:
+        cache.invalidate(role_name_key(name))
+
+def invalidate_role_names():
+    # Renames via UPDATE ... RETURNING only return the new name
+    cache.invalidate_prefix("role_name:")
+
+def invalidate_assignments(user_id):
+    cache.invalidate_prefix(user_roles_key(user_id))
@@ -0,0 +1,78 @@
+import asyncio
+
+import orjson
+from sqlalchemy import select
+
+import config
+import database
+from models import ChangeLog
+from schemas import Change
+from serialization import model_columns, row_dicts
+
+DEFAULT_CHANGES_LIMIT = 500
+MAX_CHANGES_LIMIT = 5000
+
+
+def changes_stmt(since, limit):
+    return (
+        select(*model_columns(ChangeLog, Change))
+        .where(ChangeLog.seq > since)
+        .order_by(ChangeLog.seq)
+        .limit(limit)
+    )
+
+
+def changes_page(rows, since):
+    items = row_dicts(rows)
+    return {"items": items, "last_seq": items[-1]["seq"] if items else since}
+
+
+def load_changes(since, limit):
+    # A short session per poll; a stream can stay open for hours
+    with database.SessionLocal() as db:
+        return row_dicts(db.execute(changes_stmt(since, limit)))
+
+
+async def load_changes_async(since, limit):
+    async with database.AsyncSessionLocal() as db:
+        return row_dicts(await db.execute(changes_stmt(since, limit)))
+
+
+def last_event_id(header, since):
+    """Resume after the Last-Event-ID a reconnecting client sends back."""
+    try:
+        return max(int(header), 0) if header else since
+    except ValueError:
+        return since
+
+
+async def stream_changes(
+    fetch,
+    since,
+    is_disconnected,
+    batch_size=config.CHANGES_BATCH_SIZE,
+    poll_interval=config.CHANGES_POLL_INTERVAL,
+    heartbeat=config.CHANGES_HEARTBEAT_SECONDS,
+):
+    """Server-sent events for the changes after ``since``.
+
+    ``fetch(since, limit)`` is awaited for the next rows. Each event carries
+    up to ``batch_size`` changes as a JSON array, with the last seq as its
+    id. Polling every ``poll_interval`` lets bursts collect into one event,
+    and a comment is sent after ``heartbeat`` seconds without events so
+    proxies keep idle connections open."""
+    loop = asyncio.get_running_loop()
+    last_sent = loop.time()
+    while not await is_disconnected():
+        rows = await fetch(since, batch_size)
+        if rows:
+            since = rows[-1]["seq"]
+            yield b"id: %d\nevent: changes\ndata: %s\n\n" % (since, orjson.dumps(rows))
+            last_sent = loop.time()
+            if len(rows) == batch_size:
+                # Still catching up; no need to wait
+                continue
+        elif loop.time() - last_sent >= heartbeat:
+            yield b": heartbeat\n\n"
+            last_sent = loop.time()
+        await asyncio.sleep(poll_interval)
@@ -0,0 +1,80 @@
+import os
+
+# Settings are read from the environment so deployments can change them
+# without editing code.
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")
+
+# "sync" serves requests with the threadpool handlers in main.py, "async"
+# swaps in the async handlers from async_routes.py (needs aiosqlite, or
+# asyncpg for a Postgres DATABASE_URL).
+DB_MODE = os.getenv("DB_MODE", "sync")
+
+# Connection pool settings (ignored for in-memory SQLite)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+
+# PRAGMAs applied to every new SQLite connection
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Negative values are KiB, so the default is a 64 MiB page cache
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))
+# SQLite ignores foreign keys, ON DELETE CASCADE included, unless each
+# connection turns them on
+SQLITE_FOREIGN_KEYS = os.getenv("SQLITE_FOREIGN_KEYS", "true").lower() in ("1", "true", "yes")
+
+# Read-through cache for role and user lookups (cache.py)
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+
+# In-memory role index behind /users/{user_id}/has_role (permissions.py).
+# Entries older than this are reloaded from the database on their next check.
+PERMISSION_TTL_SECONDS = float(os.getenv("PERMISSION_TTL_SECONDS", "60"))
+
+# "pydantic" validates list responses through the response models, "fast"
+# builds them from plain column tuples and encodes them with orjson
+SERIALIZATION_MODE = os.getenv("SERIALIZATION_MODE", "pydantic")
+
+# Add a Server-Timing header (app, db and serialization time) to responses
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+
+# Opt-in write-behind for POST /user_roles (write_behind.py): assignments are
+# queued and written in group commits of up to WRITE_BEHIND_MAX_ROWS rows or
+# every WRITE_BEHIND_MAX_DELAY_MS, whichever comes first. Requests get a 503
+# while WRITE_BEHIND_QUEUE_SIZE assignments are already waiting.
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "500"))
+WRITE_BEHIND_MAX_DELAY_MS = float(os.getenv("WRITE_BEHIND_MAX_DELAY_MS", "5"))
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", "10000"))
+
+# Change feed (changes.py). /changes/stream sends up to CHANGES_BATCH_SIZE
+# changes per event, polls the log every CHANGES_POLL_INTERVAL seconds and
+# sends a heartbeat after CHANGES_HEARTBEAT_SECONDS without one.
+CHANGES_BATCH_SIZE = int(os.getenv("CHANGES_BATCH_SIZE", "500"))
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "0.5"))
+CHANGES_HEARTBEAT_SECONDS = float(os.getenv("CHANGES_HEARTBEAT_SECONDS", "15"))
+
+# Chunked data migrations (backfill.py): rows per committed chunk, and a
+# rows/second ceiling so a backfill leaves room for live traffic (0 = no limit)
+BACKFILL_CHUNK_SIZE = int(os.getenv("BACKFILL_CHUNK_SIZE", "1000"))
+BACKFILL_ROWS_PER_SECOND = float(os.getenv("BACKFILL_ROWS_PER_SECOND", "0"))
+
+# Read replicas (replicas.py, DB_MODE=sync only). GET and HEAD requests are
+# spread round-robin over the healthy replicas; a client that wrote within
+# the last REPLICA_PIN_SECONDS reads from the primary. Clients are told apart
+# by the X-Client-Id header, falling back to their address.
+DATABASE_REPLICA_URLS = [url for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_PIN_SECONDS = float(os.getenv("REPLICA_PIN_SECONDS", "2"))
+REPLICA_HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", "5"))
+# For local SQLite replicas: copy the primary into them with the backup API
+# every this many seconds (0 disables)
+REPLICA_SYNC_INTERVAL = float(os.getenv("REPLICA_SYNC_INTERVAL", "0"))
+
+# Sharded mode (sharding.py): users and their role assignments are spread
+# over these databases, roles are copied to all of them, and everything else
+# lives on the first. Empty means one database at DATABASE_URL.
+SHARD_URLS = [url for url in os.getenv("SHARD_URLS", "").split(",") if url.strip()]
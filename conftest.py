@@ -0,0 +1,105 @@
+import os
+import sqlite3
+from contextlib import closing
+
+import pytest
+from alembic import command
+from alembic.config import Config
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+# The app's own database is never used by the tests; keep it in memory so
+# parallel workers do not share a file. Set before main is imported.
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from main import app  # noqa: E402
+from database import get_db, create_db_engine  # noqa: E402
+from cache import cache  # noqa: E402
+from metrics import registry  # noqa: E402
+from permissions import permissions  # noqa: E402
+
+
+def clone_database(source_path, target):
+    """Copy the SQLite database at ``source_path`` into ``target`` (a path,
+    or an open sqlite3 connection) with the backup API."""
+    with closing(sqlite3.connect(source_path)) as source:
+        if isinstance(target, sqlite3.Connection):
+            source.backup(target)
+        else:
+            with closing(sqlite3.connect(target)) as destination:
+                source.backup(destination)
+
+
+@pytest.fixture(scope="session")
+def template_database(tmp_path_factory):
+    """A database migrated to head once per test session. Under
+    pytest-xdist every worker has its own temporary directory, so its own
+    template."""
+    path = tmp_path_factory.mktemp("template") / "template.db"
+    config = Config("alembic.ini")
+    config.set_main_option("sqlalchemy.url", f"sqlite:///{path}")
+    command.upgrade(config, "head")
+    return path
+
+
+@pytest.fixture(scope="session")
+def test_engine(template_database, tmp_path_factory):
+    """Engine on this worker's copy of the template. Tests share it and
+    isolate themselves through ``db_session``'s transaction."""
+    path = tmp_path_factory.mktemp("worker") / "test.db"
+    clone_database(template_database, path)
+    engine = create_db_engine(f"sqlite:///{path}")
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def memory_engine(template_database):
+    """A private in-memory copy of the template, for tests that need to
+    commit for real."""
+    engine = create_db_engine("sqlite://", poolclass=StaticPool)
+    with engine.connect() as connection:
+        clone_database(template_database, connection.connection.driver_connection)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db_session(test_engine):
+    """Session inside a transaction that is rolled back after the test."""
+    connection = test_engine.connect()
+    # pysqlite defers BEGIN until the first DML statement, which would make
+    # the session's SAVEPOINTs top-level transactions; begin explicitly
+    driver_connection = connection.connection.driver_connection
+    driver_connection.isolation_level = None
+    transaction = connection.begin()
+    connection.exec_driver_sql("BEGIN")
+    # Commits and rollbacks inside the app only release or roll back a
+    # savepoint, so handlers that roll back on IntegrityError keep the
+    # test's earlier writes
+    session = sessionmaker(autocommit=False, autoflush=False)(bind=connection, join_transaction_mode="create_savepoint")
+
+    yield session
+
+    session.close()
+    transaction.rollback()
+    driver_connection.isolation_level = ""
+    connection.close()
+
+
+@pytest.fixture
+def client(db_session):
+    """Test client whose requests use ``db_session``."""
+    def override_get_db():
+        yield db_session
+
+    app.dependency_overrides[get_db] = override_get_db
+    cache.clear()
+    registry.clear()
+    permissions.clear()
+
+    with TestClient(app) as client:
+        yield client
+
+    app.dependency_overrides.clear()
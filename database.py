@@ -1,15 +1,143 @@
-from sqlalchemy import create_engine
+from fastapi import Depends, Request
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-DATABASE_URL = "sqlite:///./test.db" # Replace with your actual database URL
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+import config
+from config import DATABASE_URL, DB_MODE
+from replicas import READ_METHODS, ReplicaSet, WritePins, client_key
+from sharding import ShardSet
+
+
+def _is_memory_sqlite(url) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def engine_kwargs(url: str, pooled: bool = True) -> dict:
+    """Pool and driver options for ``url``, taken from config."""
+    url = make_url(url)
+    kwargs = {}
+    if url.get_backend_name() == "sqlite":
+        kwargs["connect_args"] = {"check_same_thread": False}
+    if pooled and not _is_memory_sqlite(url):
+        kwargs.update(
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_POOL_TIMEOUT,
+            pool_recycle=config.DB_POOL_RECYCLE,
+            pool_pre_ping=config.DB_POOL_PRE_PING,
+        )
+    return kwargs
+
+
+def apply_sqlite_pragmas(sync_engine):
+    """Tune every new SQLite connection: WAL for concurrent readers, a busy
+    timeout instead of immediate "database is locked" errors, larger page
+    and mmap caches, and enforced foreign keys."""
+    in_memory = _is_memory_sqlite(sync_engine.url)
+
+    @event.listens_for(sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not in_memory:
+            cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size={config.SQLITE_CACHE_SIZE}")
+        if config.SQLITE_FOREIGN_KEYS:
+            cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+def create_db_engine(url: str, **kwargs):
+    options = engine_kwargs(url, pooled="poolclass" not in kwargs)
+    engine = create_engine(url, **{**options, **kwargs})
+    if engine.dialect.name == "sqlite":
+        apply_sqlite_pragmas(engine)
+    return engine
+
+
+engine = create_db_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
-# Dependency to get DB session
-def get_db():
-    db = SessionLocal()
+# Empty unless DATABASE_REPLICA_URLS is set
+replicas = ReplicaSet([create_db_engine(url) for url in config.DATABASE_REPLICA_URLS])
+write_pins = WritePins()
+# Empty unless SHARD_URLS is set
+shards = ShardSet([create_db_engine(url) for url in config.SHARD_URLS])
+
+
+def _shard_index(request):
+    # Routes about one user carry it in the path; the rest use shard 0
+    try:
+        return shards.index_for_user(int(request.path_params["user_id"]))
+    except (KeyError, ValueError):
+        return 0
+
+# Dependency to get DB session. In sharded mode it is the session of the
+# shard the request is about. With replicas configured, reads go to a
+# replica unless the client wrote within the pin window; everything else
+# goes to the primary.
+def get_db(request: Request):
+    db = None
+    writes = False
+    if shards:
+        db = shards.session(_shard_index(request))
+    elif replicas:
+        client = client_key(request)
+        if request.method in READ_METHODS:
+            if not write_pins.pinned(client):
+                db = replicas.session()
+        else:
+            writes = True
+            write_pins.pin(client)
+    if db is None:
+        db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+        if writes:
+            # Count the window from the end of the write as well
+            write_pins.pin(client)
+
+
+def async_url(url: str) -> str:
+    """Map a sync database URL onto its async driver (aiosqlite or asyncpg)."""
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("postgresql:") or url.startswith("postgres:"):
+        return "postgresql+asyncpg:" + url.split(":", 1)[1]
+    return url
+
+
+def create_async_db_engine(url: str, **kwargs):
+    # Imported lazily so the sync mode does not need the async drivers
+    from sqlalchemy.ext.asyncio import create_async_engine
+    url = async_url(url)
+    options = engine_kwargs(url, pooled="poolclass" not in kwargs)
+    async_engine = create_async_engine(url, **{**options, **kwargs})
+    if async_engine.dialect.name == "sqlite":
+        apply_sqlite_pragmas(async_engine.sync_engine)
+    return async_engine
+
+
+def make_async_sessionmaker(async_engine):
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+    return async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+async_engine = create_async_db_engine(DATABASE_URL) if DB_MODE == "async" else None
+AsyncSessionLocal = make_async_sessionmaker(async_engine) if async_engine is not None else None
+
+# Dependency for the async session factory. Cache loads open their own
+# sessions from it, since a single-flight load may outlive its request.
+def get_async_sessionmaker():
+    return AsyncSessionLocal
+
+# Dependency to get an async DB session
+async def get_async_db(sessions=Depends(get_async_sessionmaker)):
+    async with sessions() as db:
+        yield db
@@ -0,0 +1,35 @@
+import hashlib
+
+from fastapi import Request, Response
+from sqlalchemy import select
+
+from models import CollectionVersion
+
+
+def make_etag(*parts) -> str:
+    """Strong ETag derived from a resource name and its version(s)."""
+    digest = hashlib.sha1(":".join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest[:24]}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison, so ignore any W/ prefix
+    candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag in candidates
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def collection_versions_stmt(*names):
+    return (
+        select(CollectionVersion.version)
+        .where(CollectionVersion.name.in_(names))
+        .order_by(CollectionVersion.name)
+    )
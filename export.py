@@ -0,0 +1,101 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+from sqlalchemy import select
+
+from models import User, Role, UserRole, Location
+
+# Tables that may be dumped through /export/{table} and ViewRows.py
+EXPORT_TABLES = {
+    "users": User.__table__,
+    "roles": Role.__table__,
+    "user_roles": UserRole.__table__,
+    "locations": Location.__table__,
+}
+
+CHUNK_SIZE = 1000
+
+
+def iter_rows(db, table, chunk_size=CHUNK_SIZE):
+    """Yield the rows of ``table`` in primary-key order, ``chunk_size`` at a time."""
+    stmt = select(table).order_by(*table.primary_key.columns)
+    result = db.execute(
+        stmt, execution_options={"yield_per": chunk_size, "stream_results": True}
+    )
+    try:
+        for rows in result.partitions():
+            yield rows
+    finally:
+        result.close()
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+class NdjsonEncoder:
+    media_type = "application/x-ndjson"
+
+    def __init__(self, table):
+        self.table = table
+
+    def header(self):
+        return ""
+
+    def encode(self, rows):
+        return "".join(
+            json.dumps(dict(row._mapping), default=_json_default) + "\n" for row in rows
+        )
+
+
+class CsvEncoder:
+    media_type = "text/csv"
+
+    def __init__(self, table):
+        self.table = table
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def _flush(self):
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text
+
+    def header(self):
+        self.writer.writerow(self.table.columns.keys())
+        return self._flush()
+
+    def encode(self, rows):
+        self.writer.writerows(rows)
+        return self._flush()
+
+
+FORMATS = {
+    "ndjson": NdjsonEncoder,
+    "csv": CsvEncoder,
+}
+
+
+def stream_table(db, table_name, fmt, chunk_size=CHUNK_SIZE):
+    """Yield text chunks for ``table_name`` encoded as ``fmt``."""
+    table = EXPORT_TABLES[table_name]
+    encoder = FORMATS[fmt](table)
+    yield encoder.header()
+    for rows in iter_rows(db, table, chunk_size):
+        yield encoder.encode(rows)
+
+
+async def stream_table_async(db, table_name, fmt, chunk_size=CHUNK_SIZE):
+    """Async counterpart of ``stream_table`` for an ``AsyncSession``."""
+    table = EXPORT_TABLES[table_name]
+    encoder = FORMATS[fmt](table)
+    yield encoder.header()
+    stmt = select(table).order_by(*table.primary_key.columns)
+    result = await db.stream(stmt, execution_options={"yield_per": chunk_size})
+    async for rows in result.partitions():
+        yield encoder.encode(rows)
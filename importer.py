@@ -0,0 +1,114 @@
+import codecs
+import csv
+import json
+import time
+
+from fastapi import HTTPException
+
+from bulk import dialect_insert
+from models import Location
+
+IMPORT_BATCH_SIZE = 5000
+# Longest line accepted, in characters. A body without newlines would
+# otherwise be buffered whole as one partial line.
+IMPORT_MAX_LINE_LENGTH = 64 * 1024
+
+
+def _line_too_long(max_length):
+    return HTTPException(status_code=413, detail=f"Line longer than {max_length} characters")
+
+
+async def iter_lines(chunks, max_length=None):
+    """Split a byte stream into text lines without holding more than the
+    current partial line. Lines longer than ``max_length`` raise a 413."""
+    max_length = max_length or IMPORT_MAX_LINE_LENGTH
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            if len(line) > max_length:
+                raise _line_too_long(max_length)
+            yield line.rstrip("\r")
+        if len(pending) > max_length:
+            raise _line_too_long(max_length)
+    pending += decoder.decode(b"", final=True)
+    if len(pending) > max_length:
+        raise _line_too_long(max_length)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def iter_ndjson_values(lines, field):
+    async for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+        yield record.get(field) if isinstance(record, dict) else None
+
+
+async def iter_csv_values(lines, field):
+    # One record per line: quoted values spanning lines are not supported
+    column = None
+    async for line in lines:
+        if not line.strip():
+            continue
+        row = next(csv.reader([line]))
+        if column is None:
+            if field not in row:
+                raise HTTPException(status_code=400, detail=f"CSV header must include a {field} column")
+            column = row.index(field)
+            continue
+        yield row[column] if column < len(row) else None
+
+
+PARSERS = {"ndjson": iter_ndjson_values, "csv": iter_csv_values}
+
+
+def insert_locations(db, names):
+    """Insert one batch in its own transaction; names already present are
+    skipped. Returns how many rows were inserted."""
+    table = Location.__table__
+    stmt = (
+        dialect_insert(db, table)
+        .on_conflict_do_nothing(index_elements=[table.c.location])
+        .returning(table.c.id)
+    )
+    inserted = len(db.execute(stmt, [{"location": name} for name in names]).all())
+    db.commit()
+    return inserted
+
+
+async def import_locations(chunks, fmt, insert_batch, batch_size=None):
+    """Stream ``chunks`` (an async iterator of bytes) into the locations
+    table. ``insert_batch`` is an async callable taking a list of names and
+    returning the number inserted."""
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+    start = time.perf_counter()
+    rows = inserted = invalid = 0
+    batch = []
+    async for value in PARSERS[fmt](iter_lines(chunks), "location"):
+        rows += 1
+        if not isinstance(value, str) or not value.strip():
+            invalid += 1
+            continue
+        batch.append(value.strip())
+        if len(batch) >= batch_size:
+            inserted += await insert_batch(batch)
+            batch = []
+    if batch:
+        inserted += await insert_batch(batch)
+    seconds = time.perf_counter() - start
+    return {
+        "rows": rows,
+        "inserted": inserted,
+        "ignored": rows - invalid - inserted,
+        "invalid": invalid,
+        "seconds": seconds,
+        "rows_per_second": rows / seconds if seconds else 0.0,
+    }
@@ -1,192 +1,347 @@
-from fastapi import FastAPI, HTTPException, Depends
+import asyncio
+import itertools
+from contextlib import AsyncExitStack, asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
-from pydantic import BaseModel
+import database
 from database import engine, Base, SessionLocal
-from models import User, Role, UserRole
-from typing import Optional
-from datetime import datetime 
+from models import User, Location
+from typing import Literal
 from database import get_db
+from replicas import is_replica
+from config import DB_MODE, WRITE_BEHIND, REPLICA_SYNC_INTERVAL, SHARD_URLS
+from routing import replace_routes
+from schemas import (
+    UserCreate, UserResponse, RoleCreate, RoleResponse, UserRoleCreate,
+    UserRoleResponse, UserRoleResponsejoin, RoleCheck, RoleStats,
+    LocationCreate, LocationResponse, ImportResponse, BulkResponse, ChangesResponse,
+)
+from pagination import Page, PageParams
+from export import EXPORT_TABLES, FORMATS, stream_table
+import bulk
+import services
+from importer import import_locations, insert_locations
+from search import DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT
+from cache import cache, user_key, role_key, roles_page_key, user_roles_key
+from etag import make_etag, is_not_modified, not_modified
+from serialization import FAST_SERIALIZATION, FastJSONResponse
+from metrics import InstrumentedRoute, MetricsMiddleware, instrument_engines, registry
+import write_behind
+from permissions import permissions, assignment_rows
+from changes import DEFAULT_CHANGES_LIMIT, MAX_CHANGES_LIMIT, load_changes, last_event_id, stream_changes
+
+async def sync_replicas_periodically(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(database.replicas.sync_from, database.engine)
+        except Exception:
+            # A busy primary or replica is retried on the next tick
+            continue
+
+
+def build_permission_index():
+    if database.shards:
+        permissions.build(itertools.chain.from_iterable(
+            database.shards.fan_out(lambda db: assignment_rows(db).all())
+        ))
+    else:
+        with database.SessionLocal() as db:
+            permissions.build(assignment_rows(db).yield_per(10000))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    try:
+        await run_in_threadpool(build_permission_index)
+    except OperationalError:
+        # Not migrated yet; users are loaded on their first check instead
+        pass
+    async with AsyncExitStack() as stack:
+        # The write-behind queue flushes everything pending before shutdown
+        if WRITE_BEHIND:
+            await stack.enter_async_context(write_behind.writer.serving())
+        # Local SQLite replicas are refreshed from the primary
+        if database.replicas and REPLICA_SYNC_INTERVAL > 0:
+            task = asyncio.create_task(sync_replicas_periodically(REPLICA_SYNC_INTERVAL))
+            stack.callback(task.cancel)
+        yield
 
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = InstrumentedRoute
+app.add_middleware(MetricsMiddleware)
+instrument_engines()
+registry.counter("cache_hits_total", "Read-through cache hits.", lambda: cache.hits)
+registry.counter("cache_misses_total", "Read-through cache misses.", lambda: cache.misses)
+registry.counter(
+    "singleflight_coalesced_total", "Cache misses that waited for an identical in-flight load.",
+    lambda: cache.flights.coalesced,
+)
+registry.counter("permission_loads_total", "Users loaded into the role index from the database.", lambda: permissions.loads)
+if WRITE_BEHIND:
+    registry.counter("write_behind_batches_total", "Group commits by the write-behind queue.", lambda: write_behind.writer.batches)
+    registry.counter("write_behind_rows_total", "Assignments written in group commits by the write-behind queue.", lambda: write_behind.writer.rows)
+    registry.counter(
+        "write_behind_single_writes_total",
+        "Assignments written one per commit after their group commit failed.",
+        lambda: write_behind.writer.single_writes,
+    )
 
 
 
 
 
 
-# Pydantic models for validation
-class UserCreate(BaseModel):
-    name: str
-    email: str
-    age: int
-
-class UserResponse(BaseModel):
-    id: int
-    name: str
-    email: str
-    age:  Optional[int]
-
-    class Config:
-        from_attributes = True
-
-class RoleCreate(BaseModel):
-    name: str
-
-class RoleResponse(BaseModel):
-    id: int
-    name: str
-
-    class Config:
-        from_attributes = True
-
-class UserRoleCreate(BaseModel):
-    user_id: int
-    role_id: int
-
-class UserRoleResponse(BaseModel):
-    id: int
-    user_id: int
-    role_id: int
-    assigned_at: datetime
-
-    class Config:
-        from_attributes = True
-
-
-class UserRoleResponsejoin(BaseModel):
-    assignment_id: int
-    user_id: int
-    user_name: str
-    role_id: int
-    role_name: str
-    assigned_at: datetime
-
-    class Config:
-        from_attributes = True
-
 # Create a new user
 @app.post("/users", response_model=UserResponse)
 def create_user(user: UserCreate, db: Session = Depends(get_db)):
-    # Check if email exists
-    existing_user = db.query(User).filter(User.email == user.email).first()
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    
-    new_user = User(name=user.name, email=user.email,age = user.age)
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-    return new_user
+    return services.create_user(db, user)
+
+# Create or update many users in one transaction, matched by email
+@app.post("/users/bulk", response_model=BulkResponse)
+def bulk_upsert_users(users: list[UserCreate], db: Session = Depends(get_db)):
+    return services.upsert_users(db, users)
 
 @app.put("/users/{user_id}",response_model=UserResponse)
 def insert_users(user_id: int,user: UserCreate, db: Session = Depends(get_db)):
-    existing_user = db.query(User).filter(User.id == user_id).first()
-    if not existing_user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    existing_user.name = user.name
-    existing_user.email = user.email
-    existing_user.age = user.age
-    db.commit()
-    db.refresh(existing_user)
-    return existing_user
+    return services.update_user(db, user_id, user)
 
 @app.delete("/users/{user_id}")
 def insert_users(user_id: int,db: Session = Depends(get_db)):
-    existing_user = db.query(User).filter(User.id == user_id).first()
-    if not existing_user:
-        raise HTTPException(status_code=404, detail="User not found")
-    db.delete(existing_user)
-    db.commit()
-    return {"message": "User deleted successfully"}
-
-# Get all users
-@app.get("/users", response_model=list[UserResponse])
-def get_users(db: Session = Depends(get_db)):
-    return db.query(User).all()
+    return services.delete_user(db, user_id)
+
+# Get users, one page at a time
+@app.get("/users", response_model=Page[UserResponse])
+def get_users(request: Request, response: Response, page: PageParams = Depends(), db: Session = Depends(get_db)):
+    etag = services.collection_etag(db, "users", page)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return services.list_page(db, User, UserResponse, page, headers={"ETag": etag})
+
+# Ranked name search; registered before /users/{user_id}
+@app.get("/users/search", response_model=list[UserResponse])
+def search_users(
+    q: str = Query(min_length=1),
+    limit: int = Query(DEFAULT_SEARCH_LIMIT, ge=1, le=MAX_SEARCH_LIMIT),
+    db: Session = Depends(get_db),
+):
+    return services.search(db, "users", q, limit)
 
 # Get a user by ID
 @app.get("/users/{user_id}", response_model=UserResponse)
-def get_user(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    return user
+def get_user(user_id: int, request: Request, response: Response, db: Session = Depends(get_db)):
+    entry = cache.get_or_load(user_key(user_id), lambda: services.load_user(db, user_id), fill=not is_replica(db))
+    if is_not_modified(request, entry["etag"]):
+        return not_modified(entry["etag"])
+    response.headers["ETag"] = entry["etag"]
+    return entry["body"]
+
+# Authorization check served from the in-memory role index; the database is
+# only read when the user's entry is missing or stale
+@app.get("/users/{user_id}/has_role/{role_id}", response_model=RoleCheck)
+def has_role(user_id: int, role_id: int, db: Session = Depends(get_db)):
+    [check] = services.check_roles(db, [(user_id, role_id)])
+    return check
 
 
 @app.post("/roles", response_model= RoleResponse)
 def post_role(role: RoleCreate, db: Session = Depends(get_db)):
-    existing_role = db.query(Role).filter(Role.name == role.name).first()
-    if  existing_role:
-        raise HTTPException(status_code=404, detail="role exists")
-    
-    new_role = Role(name = role.name)
-    db.add(new_role)
-    db.commit()
-    db.refresh(new_role)
-    return new_role
-
-@app.get("/roles", response_model=list[RoleResponse])
-def get_roles(db: Session = Depends(get_db)):
-    return db.query(Role).all()
+    return services.create_role(db, role)
+
+@app.post("/roles/bulk", response_model=BulkResponse)
+def bulk_create_roles(roles: list[RoleCreate], db: Session = Depends(get_db)):
+    return services.create_roles(db, roles)
+
+@app.get("/roles", response_model=Page[RoleResponse])
+def get_roles(request: Request, response: Response, page: PageParams = Depends(), db: Session = Depends(get_db)):
+    version = services.roles_version(db)
+    etag = make_etag("roles", version, page.cursor, page.limit)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    result = cache.get_or_load(
+        roles_page_key(version, page.cursor, page.limit), lambda: services.load_roles_page(db, page), fill=not is_replica(db)
+    )
+    if FAST_SERIALIZATION:
+        return FastJSONResponse(result, headers={"ETag": etag})
+    return result
+
+# Registered before /roles/{role_id} so "stats" is not read as an id
+@app.get("/roles/stats", response_model=list[RoleStats])
+def get_role_stats(
+    request: Request,
+    response: Response,
+    source: Literal["aggregate", "counter"] = "aggregate",
+    db: Session = Depends(get_db),
+):
+    etag = services.role_stats_etag(db, source)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return services.role_stats(db, source)
 
 @app.get("/roles/{role_id}", response_model=RoleResponse)
 def get_role(role_id: int, db: Session = Depends(get_db)):
-    role = db.query(Role).filter(Role.id == role_id).first()
-    if not role:
-        raise HTTPException(status_code=404, detail="Role not found")
-    return role
+    return cache.get_or_load(role_key(role_id), lambda: services.load_role(db, role_id), fill=not is_replica(db))
+
+@app.get("/roles/{role_id}/users", response_model=Page[UserResponse])
+def get_role_users(role_id: int, page: PageParams = Depends(), db: Session = Depends(get_db)):
+    return services.role_users(db, role_id, page)
 
 @app.put("/roles/{role_id}",response_model=RoleResponse)
 def update_role(role_id : int, role : RoleCreate, db: Session = Depends(get_db)):
-    existing_role = db.query(Role).filter(Role.id == role_id).first()
-    if not existing_role:
-        raise HTTPException(status_code=404, detail="Role not found")
-    
-    existing_role.name = role.name
-    db.commit()
-    db.refresh(existing_role)
-    return existing_role
+    return services.update_role(db, role_id, role)
 
 @app.delete("/roles/{role_id}")
 def delete_role(role_id: int, db: Session = Depends(get_db)):
-    existing_role = db.query(Role).filter(Role.id == role_id).first()
-    if not existing_role:
-        raise HTTPException(status_code=404, detail="Role not found")
-    db.delete(existing_role)
-    db.commit()
-    return {"message": "Role deleted successfully"}
+    return services.delete_role(db, role_id)
 
 
 @app.post("/user_roles", response_model=UserRoleResponse)
 def assign_role_to_user(user_role: UserRoleCreate, db: Session = Depends(get_db)):
-    new_user_role = UserRole(user_id=user_role.user_id, role_id=user_role.role_id)
-    db.add(new_user_role)
-    db.commit()
-    db.refresh(new_user_role)
-    return new_user_role
+    return services.assign_role(db, user_role.user_id, user_role.role_id)
 
-@app.get("/user_roles", response_model=list[UserRoleResponse])
-def get_user_roles(db: Session = Depends(get_db)):
-    return db.query(UserRole).all()
+@app.post("/user_roles/bulk", response_model=BulkResponse)
+def bulk_assign_roles(user_roles: list[UserRoleCreate], db: Session = Depends(get_db)):
+    return services.assign_roles(db, user_roles)
 
-@app.get("/user_roles/{user_id}", response_model=list[UserRoleResponsejoin])
+@app.get("/user_roles", response_model=Page[UserRoleResponse])
+def get_user_roles(request: Request, response: Response, page: PageParams = Depends(), db: Session = Depends(get_db)):
+    etag = services.collection_etag(db, "user_roles", page)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return services.list_assignments(db, page, headers={"ETag": etag})
 
-def get_roles_for_user(user_id: int, db: Session = Depends(get_db)):
-    user_roles = db.query(UserRole).filter(UserRole.user_id == user_id).all()
-    response = []
-    for ur in user_roles:
-        role = db.query(Role).filter(Role.id == ur.role_id).first()
-        user = db.query(User).filter(User.id == ur.user_id).first()
-        response.append(
-            UserRoleResponsejoin(
-                assignment_id=ur.id,
-                user_id=user.id,
-                user_name=user.name,
-                role_id=role.id,
-                role_name=role.name,
-                assigned_at = ur.assigned_at
-            )
-        )
-    return response
+@app.get("/user_roles/{user_id}", response_model=list[UserRoleResponsejoin])
+def get_roles_for_user(user_id: int, request: Request, response: Response, db: Session = Depends(get_db)):
+    etag = services.user_roles_etag(db, user_id)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return cache.get_or_load(
+        user_roles_key(user_id, etag), lambda: services.load_user_roles(db, user_id), fill=not is_replica(db)
+    )
+
+
+@app.delete("/user_roles/{user_id}/{role_id}")
+def unassign_role(user_id: int, role_id: int, db: Session = Depends(get_db)):
+    return services.unassign_role(db, user_id, role_id)
+
+# Batch form of /users/{user_id}/has_role/{role_id}; answers come back in
+# request order
+@app.post("/user_roles/check", response_model=list[RoleCheck])
+def check_roles(checks: list[UserRoleCreate], db: Session = Depends(get_db)):
+    bulk.check_size(checks)
+    return services.check_roles(db, [(check.user_id, check.role_id) for check in checks])
+
+
+@app.post("/locations", response_model=LocationResponse)
+def create_location(location: LocationCreate, db: Session = Depends(get_db)):
+    return services.create_location(db, location)
+
+# Stream an NDJSON or CSV upload into the table in batched transactions.
+# The endpoint is async so the body can be read incrementally; the batches
+# run on the threadpool like any sync handler.
+@app.post("/locations/import", response_model=ImportResponse)
+async def import_locations_upload(
+    request: Request, format: Literal["ndjson", "csv"] = "ndjson", db: Session = Depends(get_db)
+):
+    async def insert_batch(names):
+        return await run_in_threadpool(insert_locations, db, names)
+    return await import_locations(request.stream(), format, insert_batch)
+
+@app.get("/locations", response_model=Page[LocationResponse])
+def get_locations(page: PageParams = Depends(), db: Session = Depends(get_db)):
+    return services.list_page(db, Location, LocationResponse, page)
+
+# Ranked location search; registered before /locations/{location_id}
+@app.get("/locations/search", response_model=list[LocationResponse])
+def search_locations(
+    q: str = Query(min_length=1),
+    limit: int = Query(DEFAULT_SEARCH_LIMIT, ge=1, le=MAX_SEARCH_LIMIT),
+    db: Session = Depends(get_db),
+):
+    return services.search(db, "locations", q, limit)
+
+@app.get("/locations/{location_id}", response_model=LocationResponse)
+def get_location(location_id: int, db: Session = Depends(get_db)):
+    return services.get_location(db, location_id)
+
+@app.put("/locations/{location_id}", response_model=LocationResponse)
+def update_location(location_id: int, location: LocationCreate, db: Session = Depends(get_db)):
+    return services.update_location(db, location_id, location)
+
+@app.delete("/locations/{location_id}")
+def delete_location(location_id: int, db: Session = Depends(get_db)):
+    return services.delete_location(db, location_id)
+
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    return cache.stats()
+
+
+# Prometheus text exposition of the per-route histograms
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return registry.render()
+
+
+# Stream a whole table as NDJSON or CSV without loading it into memory
+@app.get("/export/{table}")
+def export_table(table: str, format: Literal["ndjson", "csv"] = "ndjson", db: Session = Depends(get_db)):
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail="Table not found")
+    media_type = FORMATS[format].media_type
+    return StreamingResponse(
+        stream_table(db, table, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'},
+    )
+
+
+# Change feed: catch up with /changes?since=<seq>, then tail /changes/stream
+# instead of re-polling the list endpoints
+@app.get("/changes", response_model=ChangesResponse)
+def get_changes(
+    since: int = Query(0, ge=0),
+    limit: int = Query(DEFAULT_CHANGES_LIMIT, ge=1, le=MAX_CHANGES_LIMIT),
+    db: Session = Depends(get_db),
+):
+    return services.list_changes(db, since, limit)
+
+@app.get("/changes/stream")
+def stream_change_feed(request: Request, since: int = Query(0, ge=0)):
+    since = last_event_id(request.headers.get("last-event-id"), since)
+    return StreamingResponse(
+        stream_changes(lambda after, limit: run_in_threadpool(load_changes, after, limit), since, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+# Serve the same API from async handlers when DB_MODE=async
+if DB_MODE == "async":
+    if database.replicas:
+        # get_async_db has no replica routing; fail instead of silently
+        # sending every read to the primary
+        raise RuntimeError("DATABASE_REPLICA_URLS needs DB_MODE=sync")
+    from async_routes import router as async_router
+    replace_routes(app.router, async_router)
+
+# Queue role assignments into group commits when WRITE_BEHIND is on
+if WRITE_BEHIND:
+    replace_routes(app.router, write_behind.router)
+
+# Spread users and their role assignments over SHARD_URLS
+if SHARD_URLS:
+    if DB_MODE == "async" or WRITE_BEHIND:
+        raise RuntimeError("SHARD_URLS needs DB_MODE=sync and WRITE_BEHIND off")
+    from sharded_routes import router as sharded_router
+    replace_routes(app.router, sharded_router)
@@ -0,0 +1,261 @@
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from fastapi import Response
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import config
+
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+class Histogram:
+    # Observations are only made by MetricsMiddleware on the event loop
+    # thread, so updates need no lock; readers may see a torn snapshot.
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """In-memory histograms keyed by metric name and labels."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.help = {}
+        self.counters = {}
+        self.on_clear = []
+        self.lock = threading.Lock()
+
+    def histogram(self, name, labels, bounds):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(bounds))
+        return histogram
+
+    def counter(self, name, help_text, read):
+        """Register a callable whose current value is exported as a counter."""
+        self.counters[name] = (help_text, read)
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+        for callback in self.on_clear:
+            callback()
+
+    def render(self) -> str:
+        lines = []
+        by_name = {}
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            by_name.setdefault(name, []).append((labels, histogram))
+        for name, series in by_name.items():
+            lines.append(f"# HELP {name} {self.help.get(name, '')}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series:
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                counts = list(histogram.counts)
+                total, count = histogram.sum, histogram.count
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.bounds + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{name}_bucket{{{label_text},le="{le}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{label_text}}} {total}")
+                lines.append(f"{name}_count{{{label_text}}} {count}")
+        for name, (help_text, read) in sorted(self.counters.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+registry.help.update({
+    "http_request_duration_seconds": "Wall time per request.",
+    "http_request_db_seconds": "Time spent executing SQL per request.",
+    "http_request_sql_statements": "SQL statements executed per request.",
+    "http_response_rows": "Rows in the response body.",
+    "http_response_serialization_seconds": "Time from the endpoint returning to the response starting.",
+})
+
+
+# (method, route) -> histograms, so a request costs one dict lookup. Shared
+# by every MetricsMiddleware, since they all record into ``registry``.
+_route_series = {}
+registry.on_clear.append(_route_series.clear)
+
+
+def route_histograms(method, route):
+    labels = (("method", method), ("route", route))
+    return (
+        registry.histogram("http_request_duration_seconds", labels, TIME_BUCKETS),
+        registry.histogram("http_request_db_seconds", labels, TIME_BUCKETS),
+        registry.histogram("http_request_sql_statements", labels, COUNT_BUCKETS),
+        registry.histogram("http_response_rows", labels, COUNT_BUCKETS),
+        registry.histogram("http_response_serialization_seconds", labels, TIME_BUCKETS),
+    )
+
+
+class RequestStats:
+    __slots__ = ("db_seconds", "statements", "rows", "endpoint_done", "render_seconds")
+
+    def __init__(self):
+        self.db_seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.endpoint_done = None
+        self.render_seconds = 0.0
+
+
+# Set by the middleware; sync handlers see it too because the threadpool
+# runs them in a copy of the request's context
+current_stats: ContextVar = ContextVar("current_stats", default=None)
+
+
+def count_rows(content):
+    if isinstance(content, list):
+        return len(content)
+    if isinstance(content, dict) and isinstance(content.get("items"), list):
+        return len(content["items"])
+    return 1 if content is not None else 0
+
+
+def record_render(content, seconds):
+    """Called by response classes that encode their own body."""
+    stats = current_stats.get()
+    if stats is not None:
+        stats.rows = count_rows(content)
+        stats.render_seconds += seconds
+
+
+# The start time lives on the statement's execution context, so a statement
+# that raises leaves nothing behind on the connection
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_stats.get() is not None and context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats.get()
+    if stats is not None:
+        start = getattr(context, "_metrics_start", None)
+        if start is not None:
+            stats.db_seconds += time.perf_counter() - start
+        stats.statements += 1
+
+
+def instrument_engines():
+    """Time every SQL statement of every engine, sync or async."""
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _finish_endpoint(result):
+    stats = current_stats.get()
+    if stats is not None:
+        stats.endpoint_done = time.perf_counter()
+        if not isinstance(result, Response):
+            stats.rows = count_rows(result)
+    return result
+
+
+def _timed_endpoint(endpoint):
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            return _finish_endpoint(await endpoint(*args, **kwargs))
+    elif inspect.isgeneratorfunction(endpoint) or inspect.isasyncgenfunction(endpoint):
+        return endpoint
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            return _finish_endpoint(endpoint(*args, **kwargs))
+    return wrapper
+
+
+class InstrumentedRoute(APIRoute):
+    """APIRoute that marks when the endpoint returns, so the time FastAPI
+    then spends validating and encoding the response can be measured."""
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, _timed_endpoint(endpoint), **kwargs)
+
+
+class MetricsMiddleware:
+    """Records per-route wall time, DB time, statement count, rows and
+    serialization time, and optionally adds a Server-Timing header."""
+
+    def __init__(self, app, server_timing=None):
+        self.app = app
+        self.server_timing = config.SERVER_TIMING if server_timing is None else server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = current_stats.set(stats)
+        start = time.perf_counter()
+        response_start = None
+
+        async def send_wrapper(message):
+            nonlocal response_start
+            if message["type"] == "http.response.start":
+                response_start = time.perf_counter()
+                if self.server_timing:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", self._server_timing(stats, start, response_start).encode())
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_stats.reset(token)
+            self._record(scope, stats, start, response_start)
+
+    @staticmethod
+    def _serialization_seconds(stats, response_start):
+        seconds = stats.render_seconds
+        if stats.endpoint_done is not None and response_start is not None:
+            seconds += max(response_start - stats.endpoint_done, 0.0)
+        return seconds
+
+    def _server_timing(self, stats, start, response_start):
+        return (
+            f"app;dur={(response_start - start) * 1000:.3f}, "
+            f'db;dur={stats.db_seconds * 1000:.3f};desc="{stats.statements} queries", '
+            f"ser;dur={self._serialization_seconds(stats, response_start) * 1000:.3f}"
+        )
+
+    def _record(self, scope, stats, start, response_start):
+        route = scope.get("route")
+        key = (scope["method"], route.path if route is not None else "unmatched")
+        series = _route_series.get(key)
+        if series is None:
+            series = _route_series[key] = route_histograms(*key)
+        duration, db, statements, rows, serialization = series
+        duration.observe(time.perf_counter() - start)
+        db.observe(stats.db_seconds)
+        statements.observe(stats.statements)
+        rows.observe(stats.rows)
+        serialization.observe(self._serialization_seconds(stats, response_start))
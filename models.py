@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, ForeignKey, DateTime, String
+from sqlalchemy import Column, Integer, ForeignKey, DateTime, String, Index, JSON, text
 from sqlalchemy.orm import relationship
 from database import Base  
 from datetime import datetime 
@@ -9,25 +9,79 @@ class User(Base):
    name = Column(String, index=True)
    email = Column(String, unique=True, index=True)
    age = Column(Integer) # New column added
-   
-   
+   version = Column(Integer, nullable=False, server_default="1")
+
+   __mapper_args__ = {"version_id_col": version}
+
+   role_assignments = relationship("UserRole", back_populates="user", passive_deletes="all")
 
 class Role(Base):
     __tablename__ = "roles"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True)
+    version = Column(Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
+
+    user_assignments = relationship("UserRole", back_populates="role", passive_deletes="all")
 
 
 class UserRole(Base):
     __tablename__ = "user_roles"
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    role_id = Column(Integer, ForeignKey('roles.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    role_id = Column(Integer, ForeignKey('roles.id', ondelete='CASCADE'), nullable=False)
     assigned_at = Column(DateTime, default=datetime.utcnow)  # Example additional column
 
+    __table_args__ = (
+        Index("ix_user_roles_user_id_role_id", "user_id", "role_id", unique=True),
+        Index("ix_user_roles_role_id_user_id", "role_id", "user_id"),
+    )
+
+    user = relationship("User", back_populates="role_assignments")
+    role = relationship("Role", back_populates="user_assignments")
+
 
 
 class Location(Base):
     __tablename__ = "locations"
     id = Column(Integer, primary_key=True, index=True)
     location = Column(String, unique=True, index=True)
+
+
+class CollectionVersion(Base):
+    # Bumped by triggers on every write to the named table
+    __tablename__ = "collection_versions"
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, server_default="1")
+
+
+class RoleMemberCount(Base):
+    # Maintained by triggers on user_roles
+    __tablename__ = "role_member_counts"
+    role_id = Column(Integer, primary_key=True)
+    users = Column(Integer, nullable=False, server_default="0")
+
+
+class ChangeLog(Base):
+    # Append-only; written by triggers on users, roles, user_roles and
+    # locations in the same transaction as the change
+    __tablename__ = "changes"
+    seq = Column(Integer, primary_key=True)
+    table_name = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)
+    data = Column(JSON)
+    changed_at = Column(DateTime, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
+
+    __table_args__ = {"sqlite_autoincrement": True}
+
+
+class DataMigrationCheckpoint(Base):
+    # One row per backfill (backfill.py): the last key committed and when
+    # the run finished
+    __tablename__ = "data_migration_checkpoints"
+    name = Column(String, primary_key=True)
+    last_key = Column(Integer)
+    rows = Column(Integer, nullable=False, server_default="0")
+    finished_at = Column(DateTime)
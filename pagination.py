@@ -0,0 +1,58 @@
+import base64
+import binascii
+from typing import Generic, Optional, TypeVar
+
+from fastapi import HTTPException, Query
+from pydantic import BaseModel
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+T = TypeVar("T")
+
+
+class Page(BaseModel, Generic[T]):
+    items: list[T]
+    next_cursor: Optional[str] = None
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+class PageParams:
+    """Query parameters shared by every paginated endpoint."""
+
+    def __init__(
+        self,
+        cursor: Optional[str] = None,
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    ):
+        self.cursor = cursor
+        self.after = decode_cursor(cursor) if cursor else None
+        self.limit = limit
+
+
+def paginate(stmt, key, params: PageParams):
+    # Keyset pagination: seek past the last key instead of using OFFSET, and
+    # fetch one extra row to know whether another page exists.
+    if params.after is not None:
+        stmt = stmt.where(key > params.after)
+    return stmt.order_by(key).limit(params.limit + 1)
+
+
+def make_page(rows, params: PageParams, key=lambda row: row.id) -> dict:
+    rows = list(rows)
+    next_cursor = None
+    if len(rows) > params.limit:
+        rows = rows[: params.limit]
+        next_cursor = encode_cursor(key(rows[-1]))
+    return {"items": rows, "next_cursor": next_cursor}
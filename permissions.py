@@ -0,0 +1,117 @@
+import threading
+import time
+
+from sqlalchemy import select
+
+import config
+from models import UserRole
+
+
+EMPTY = frozenset()
+
+
+class PermissionIndex:
+    """The role ids of each user as a frozenset, so a check is a dict lookup
+    and a set lookup. Memory grows with the assignments held, not with the
+    largest role id.
+
+    Writes made through this process update entries in place. An entry older
+    than ``ttl`` is reloaded on its next check, which picks up writes from
+    other processes; users without an entry are loaded on their first."""
+
+    def __init__(self, ttl=config.PERMISSION_TTL_SECONDS):
+        self.ttl = ttl
+        self.loads = 0
+        self._entries = {}  # user_id -> (role_ids, loaded_at)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def build(self, rows):
+        """Replace the index with the given ``(user_id, role_id)`` rows."""
+        roles = {}
+        for user_id, role_id in rows:
+            roles.setdefault(user_id, set()).add(role_id)
+        now = time.monotonic()
+        with self._lock:
+            self._generation += 1
+            self._entries = {user_id: (frozenset(value), now) for user_id, value in roles.items()}
+
+    def check(self, pairs, load):
+        """Answer ``(user_id, role_id)`` pairs in order. ``load(user_ids)``
+        returns ``{user_id: role_ids}`` for the users whose entry is missing or
+        stale; it is not called when every entry is fresh."""
+        now = time.monotonic()
+        roles = {}
+        stale = []
+        for user_id in {user_id for user_id, _ in pairs}:
+            entry = self._entries.get(user_id)
+            if entry is None or now - entry[1] > self.ttl:
+                stale.append(user_id)
+            else:
+                roles[user_id] = entry[0]
+        if stale:
+            generation = self._generation
+            loaded = load(stale)
+            with self._lock:
+                self.loads += len(stale)
+                # A write that landed during the load may be missing from
+                # it; answer from the load but do not keep it
+                keep = generation == self._generation
+                for user_id in stale:
+                    roles[user_id] = frozenset(loaded.get(user_id, EMPTY))
+                    if keep:
+                        self._entries[user_id] = (roles[user_id], now)
+        return [role_id in roles[user_id] for user_id, role_id in pairs]
+
+    def grant(self, user_id, role_id):
+        with self._lock:
+            self._generation += 1
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries[user_id] = (entry[0] | {role_id}, entry[1])
+
+    def revoke(self, user_id, role_id):
+        with self._lock:
+            self._generation += 1
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries[user_id] = (entry[0] - {role_id}, entry[1])
+
+    def forget(self, *user_ids):
+        """Drop entries so the next check reloads them."""
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def drop_role(self, role_id):
+        # Role ids can be reused once the highest one is deleted
+        with self._lock:
+            self._generation += 1
+            for user_id, (value, loaded_at) in self._entries.items():
+                if role_id in value:
+                    self._entries[user_id] = (value - {role_id}, loaded_at)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries = {}
+            self.loads = 0
+
+
+def assignment_rows(db):
+    return db.execute(select(UserRole.user_id, UserRole.role_id))
+
+
+def user_role_ids(db, user_ids):
+    roles = {}
+    rows = db.execute(select(UserRole.user_id, UserRole.role_id).where(UserRole.user_id.in_(user_ids)))
+    for user_id, role_id in rows:
+        roles.setdefault(user_id, set()).add(role_id)
+    return roles
+
+
+permissions = PermissionIndex()
@@ -0,0 +1,89 @@
+from sqlalchemy import delete, func, insert, select, update
+
+from bulk import dialect_insert
+from models import User, Role, UserRole, RoleMemberCount
+
+# Statements shared by the endpoint functions in services.py and the sharded
+# handlers in sharded_routes.py
+
+
+def roles_for_user_stmt(user_id):
+    # One joined query instead of a Role and a User lookup per assignment;
+    # the filter is served by ix_user_roles_user_id_role_id
+    return (
+        select(
+            UserRole.id.label("assignment_id"),
+            User.id.label("user_id"),
+            User.name.label("user_name"),
+            Role.id.label("role_id"),
+            Role.name.label("role_name"),
+            UserRole.assigned_at,
+        )
+        .join(UserRole.user)
+        .join(UserRole.role)
+        .where(UserRole.user_id == user_id)
+        .order_by(UserRole.id)
+    )
+
+
+# Single-statement writes. The returned rows carry every column, so handlers
+# can answer without a refresh after the commit.
+def insert_returning(model, **values):
+    return insert(model).values(**values).returning(*model.__table__.c)
+
+
+def update_returning(model, row_id, **values):
+    # Bulk UPDATE bypasses the mapper, so bump the version column here
+    version = model.__mapper__.version_id_col
+    if version is not None:
+        values[version.key] = version + 1
+    return update(model).where(model.id == row_id).values(**values).returning(*model.__table__.c)
+
+
+def delete_returning(model, row_id, *columns):
+    return delete(model).where(model.id == row_id).returning(*(columns or (model.id,)))
+
+
+def assign_role_stmt(db, user_id, role_id):
+    # Returns no row when the pair is already assigned; callers then load
+    # the existing assignment with assignment_stmt
+    return (
+        dialect_insert(db, UserRole)
+        .values(user_id=user_id, role_id=role_id)
+        .on_conflict_do_nothing(index_elements=["user_id", "role_id"])
+        .returning(UserRole)
+    )
+
+
+def assignment_stmt(user_id, role_id):
+    return select(UserRole).where(UserRole.user_id == user_id, UserRole.role_id == role_id)
+
+
+def unassign_role_stmt(user_id, role_id):
+    return delete(UserRole).where(UserRole.user_id == user_id, UserRole.role_id == role_id)
+
+
+def role_users_stmt(role_id, *columns):
+    # Page on UserRole.user_id so ix_user_roles_role_id_user_id serves both
+    # the filter and the ordering
+    return (
+        select(*(columns or (User,)))
+        .join(UserRole, UserRole.user_id == User.id)
+        .where(UserRole.role_id == role_id)
+    )
+
+
+def role_stats_stmt(source):
+    if source == "counter":
+        # Reads the trigger-maintained counters: one row per role
+        users = func.coalesce(RoleMemberCount.users, 0)
+        stmt = select(Role.id.label("role_id"), Role.name, users.label("users")).outerjoin(
+            RoleMemberCount, RoleMemberCount.role_id == Role.id
+        )
+    else:
+        stmt = (
+            select(Role.id.label("role_id"), Role.name, func.count(UserRole.id).label("users"))
+            .outerjoin(UserRole, UserRole.role_id == Role.id)
+            .group_by(Role.id, Role.name)
+        )
+    return stmt.order_by(Role.id)
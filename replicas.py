@@ -0,0 +1,119 @@
+import itertools
+import threading
+import time
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+import config
+
+READ_METHODS = frozenset({"GET", "HEAD"})
+
+
+class Replica:
+    def __init__(self, engine, health_interval):
+        self.engine = engine
+        # Tagged so readers can tell a possibly lagging session apart
+        self.sessionmaker = sessionmaker(autocommit=False, autoflush=False, bind=engine, info={"replica": True})
+        self.health_interval = health_interval
+        self.reads = 0
+        self._healthy = True
+        self._next_check = 0.0
+        # Guards reads and _next_check; requests pick replicas from the
+        # threadpool
+        self._lock = threading.Lock()
+
+    def healthy(self):
+        # Checked at most once per interval, by whichever request claims the
+        # check first; the others use the last answer instead of waiting
+        now = time.monotonic()
+        with self._lock:
+            due = now >= self._next_check
+            if due:
+                self._next_check = now + self.health_interval
+        if due:
+            try:
+                with self.engine.connect() as connection:
+                    connection.execute(text("SELECT 1"))
+                self._healthy = True
+            except Exception:
+                self._healthy = False
+        return self._healthy
+
+    def count_read(self):
+        with self._lock:
+            self.reads += 1
+
+
+class ReplicaSet:
+    """Read replicas picked round-robin, skipping unhealthy ones."""
+
+    def __init__(self, engines, health_interval=config.REPLICA_HEALTH_INTERVAL):
+        self.replicas = [Replica(engine, health_interval) for engine in engines]
+        self._next = itertools.cycle(self.replicas) if self.replicas else None
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def session(self):
+        """A session on the next healthy replica, or None if there is none."""
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = next(self._next)
+            if replica.healthy():
+                replica.count_read()
+                return replica.sessionmaker()
+        return None
+
+    def sync_from(self, primary_engine):
+        """Copy the primary into every SQLite replica with the backup API.
+        Meant for local testing; real replicas are kept in sync by the
+        database server."""
+        for replica in self.replicas:
+            if not replica.healthy():
+                continue
+            source = primary_engine.raw_connection()
+            try:
+                target = replica.engine.raw_connection()
+                try:
+                    source.driver_connection.backup(target.driver_connection)
+                finally:
+                    target.close()
+            finally:
+                source.close()
+
+
+class WritePins:
+    """Clients that wrote recently, and until when they read from the
+    primary."""
+
+    def __init__(self, seconds=config.REPLICA_PIN_SECONDS):
+        self.seconds = seconds
+        self._until = {}
+        self._lock = threading.Lock()
+
+    def pin(self, client):
+        now = time.monotonic()
+        with self._lock:
+            self._until[client] = now + self.seconds
+            # Drop expired pins once the map grows, so it stays proportional
+            # to the clients that wrote within the window
+            if len(self._until) > 1024:
+                self._until = {key: until for key, until in self._until.items() if until >= now}
+
+    def pinned(self, client):
+        with self._lock:
+            until = self._until.get(client)
+        return until is not None and until > time.monotonic()
+
+
+def is_replica(db):
+    return db.info.get("replica", False)
+
+
+def client_key(request):
+    client_id = request.headers.get("x-client-id")
+    if client_id:
+        return client_id
+    return request.client.host if request.client else ""
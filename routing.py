@@ -0,0 +1,10 @@
+def replace_routes(app_router, router):
+    """Swap routes of ``app_router`` for the ones in ``router`` with the same
+    path and methods, keeping the original route order."""
+    replacements = {
+        (route.path, frozenset(route.methods)): route for route in router.routes
+    }
+    app_router.routes[:] = [
+        replacements.get((route.path, frozenset(getattr(route, "methods", None) or ())), route)
+        for route in app_router.routes
+    ]
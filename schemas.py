@@ -0,0 +1,109 @@
+from pydantic import BaseModel
+from typing import Literal, Optional
+from datetime import datetime
+
+# Pydantic models for validation
+class UserCreate(BaseModel):
+    name: str
+    email: str
+    age: int
+
+class UserResponse(BaseModel):
+    id: int
+    name: str
+    email: str
+    age:  Optional[int]
+
+    class Config:
+        from_attributes = True
+
+class RoleCreate(BaseModel):
+    name: str
+
+class RoleResponse(BaseModel):
+    id: int
+    name: str
+
+    class Config:
+        from_attributes = True
+
+class UserRoleCreate(BaseModel):
+    user_id: int
+    role_id: int
+
+class RoleCheck(BaseModel):
+    user_id: int
+    role_id: int
+    has_role: bool
+
+class UserRoleResponse(BaseModel):
+    id: int
+    user_id: int
+    role_id: int
+    assigned_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class UserRoleResponsejoin(BaseModel):
+    assignment_id: int
+    user_id: int
+    user_name: str
+    role_id: int
+    role_name: str
+    assigned_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class RoleStats(BaseModel):
+    role_id: int
+    name: str
+    users: int
+
+    class Config:
+        from_attributes = True
+
+class LocationCreate(BaseModel):
+    location: str
+
+class LocationResponse(BaseModel):
+    id: int
+    location: Optional[str]
+
+    class Config:
+        from_attributes = True
+
+class BulkItemResult(BaseModel):
+    index: int
+    status: Literal["created", "updated", "conflict"]
+    id: Optional[int] = None
+
+class BulkResponse(BaseModel):
+    created: int
+    updated: int
+    conflict: int
+    results: list[BulkItemResult]
+
+class Change(BaseModel):
+    seq: int
+    table_name: str
+    row_id: int
+    op: Literal["insert", "update", "delete"]
+    # The row after inserts and updates, None for deletes
+    data: Optional[dict] = None
+    changed_at: datetime
+
+class ChangesResponse(BaseModel):
+    items: list[Change]
+    # Pass as ?since= to get the changes after these
+    last_seq: int
+
+class ImportResponse(BaseModel):
+    rows: int
+    inserted: int
+    ignored: int
+    invalid: int
+    seconds: float
+    rows_per_second: float
@@ -0,0 +1,71 @@
+import re
+
+from sqlalchemy import case, column, select, table, text
+
+from models import User, Location
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+# name -> (model, searched column), matching the FTS5 tables created by
+# migration bec8a5ffca1d
+SEARCHABLE = {
+    "users": (User, User.name),
+    "locations": (Location, Location.location),
+}
+
+# Whether a database has the FTS tables, keyed by engine URL. The migration
+# skips them when SQLite lacks FTS5, so this is fixed for a process.
+_fts_tables = {}
+
+
+def fts_available(db, name="users"):
+    bind = db.get_bind()
+    key = (str(bind.engine.url), name)
+    if key not in _fts_tables:
+        found = bind.dialect.name == "sqlite" and db.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {"name": f"{name}_fts"},
+        ).first() is not None
+        _fts_tables[key] = found
+    return _fts_tables[key]
+
+
+def fts_query(q):
+    # Quote every token so FTS5 operators in user input are taken literally,
+    # and prefix-match each one for type-ahead: "jo sm" -> "jo"* "sm"*
+    return " ".join(f'"{token}"*' for token in TOKEN.findall(q))
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def search_stmt(name, q, limit, use_fts, *columns):
+    """Best matches first; None when ``q`` has nothing to search for."""
+    model, searched = SEARCHABLE[name]
+    stmt = select(*(columns or (model,)))
+    if use_fts:
+        query = fts_query(q)
+        if not query:
+            return None
+        fts = table(f"{name}_fts", column("rowid"), column("rank"), column(f"{name}_fts"))
+        return (
+            stmt.join(fts, fts.c.rowid == model.id)
+            .where(fts.c[f"{name}_fts"].op("MATCH")(query))
+            .order_by(fts.c.rank)
+            .limit(limit)
+        )
+    q = q.strip()
+    if not q:
+        return None
+    # Without FTS5: substring match, values starting with the query first
+    pattern = _escape_like(q)
+    prefix_first = case((searched.ilike(f"{pattern}%", escape="\\"), 0), else_=1)
+    return (
+        stmt.where(searched.ilike(f"%{pattern}%", escape="\\"))
+        .order_by(prefix_first, searched, model.id)
+        .limit(limit)
+    )
@@ -0,0 +1,28 @@
+import time
+
+import orjson
+from fastapi.responses import JSONResponse
+
+from config import SERIALIZATION_MODE
+from metrics import record_render
+
+FAST_SERIALIZATION = SERIALIZATION_MODE == "fast"
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response encoded with orjson, which handles datetimes natively."""
+
+    def render(self, content) -> bytes:
+        start = time.perf_counter()
+        body = orjson.dumps(content)
+        record_render(content, time.perf_counter() - start)
+        return body
+
+
+def model_columns(model, schema):
+    """The ORM columns backing each field of a response schema."""
+    return [getattr(model, name) for name in schema.model_fields]
+
+
+def row_dicts(rows):
+    return [row._asdict() for row in rows]
@@ -0,0 +1,293 @@
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+import bulk
+from models import User, Role, UserRole, Location
+from schemas import UserResponse, RoleResponse, UserRoleResponse, UserRoleResponsejoin, LocationResponse
+from pagination import Page, paginate, make_page
+from search import fts_available, search_stmt
+from queries import (
+    roles_for_user_stmt, assign_role_stmt, assignment_stmt, unassign_role_stmt,
+    role_users_stmt, role_stats_stmt, insert_returning, update_returning, delete_returning,
+)
+from cache import (
+    MISSING, cache, role_name_key, invalidate_user, invalidate_roles, invalidate_role_names, invalidate_assignments,
+)
+from etag import make_etag, collection_versions_stmt
+from serialization import FAST_SERIALIZATION, FastJSONResponse, model_columns, row_dicts
+from permissions import permissions, user_role_ids
+from changes import changes_stmt, changes_page
+
+# Endpoint logic shared by the sync handlers in main.py and the async ones
+# in async_routes.py. Every function takes a sync Session first, so the
+# async handlers run them with AsyncSession.run_sync. Cached reads are split
+# into an ETag part and a load part: the handlers own the cache lookup,
+# since the async one has to wait on the single flight without blocking
+# the event loop.
+
+MODELS = {"users": (User, UserResponse), "locations": (Location, LocationResponse)}
+
+
+def collection_etag(db, name, page):
+    version = db.scalar(collection_versions_stmt(name))
+    return make_etag(name, version, page.cursor, page.limit)
+
+
+def list_page(db, model, schema, page, key=None, headers=None):
+    key = key if key is not None else model.id
+    if FAST_SERIALIZATION:
+        rows = db.execute(paginate(select(*model_columns(model, schema)), key, page))
+        return FastJSONResponse(make_page(row_dicts(rows), page, key=lambda row: row["id"]), headers=headers)
+    return make_page(db.scalars(paginate(select(model), key, page)).all(), page)
+
+
+def search(db, table, q, limit):
+    model, schema = MODELS[table]
+    columns = model_columns(model, schema) if FAST_SERIALIZATION else ()
+    stmt = search_stmt(table, q, limit, fts_available(db, table), *columns)
+    if stmt is None:
+        return []
+    if FAST_SERIALIZATION:
+        return FastJSONResponse(row_dicts(db.execute(stmt)))
+    return db.scalars(stmt).all()
+
+
+def create_user(db, user):
+    # One INSERT ... RETURNING; the unique email index rejects duplicates
+    # without a racy lookup first
+    try:
+        new_user = db.execute(insert_returning(User, **user.model_dump())).one()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Email already registered")
+    return new_user
+
+
+def upsert_users(db, users):
+    bulk.check_size(users)
+    result = bulk.upsert_users(db, users)
+    for item in result["results"]:
+        if item["status"] == "updated":
+            invalidate_user(item["id"])
+    return result
+
+
+def update_user(db, user_id, user):
+    try:
+        updated_user = db.execute(update_returning(User, user_id, **user.model_dump())).first()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Email already registered")
+    if not updated_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    invalidate_user(user_id)
+    return updated_user
+
+
+def delete_user(db, user_id):
+    deleted = db.execute(delete_returning(User, user_id)).first()
+    if not deleted:
+        raise HTTPException(status_code=404, detail="User not found")
+    db.commit()
+    invalidate_user(user_id)
+    permissions.forget(user_id)
+    return {"message": "User deleted successfully"}
+
+
+def load_user(db, user_id):
+    user = db.get(User, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {
+        "etag": make_etag("user", user.id, user.version),
+        "body": UserResponse.model_validate(user).model_dump(mode="json"),
+    }
+
+
+def check_roles(db, pairs):
+    # The role index only reads the database for missing or stale users
+    granted = permissions.check(pairs, lambda user_ids: user_role_ids(db, user_ids))
+    return [
+        {"user_id": user_id, "role_id": role_id, "has_role": answer}
+        for (user_id, role_id), answer in zip(pairs, granted)
+    ]
+
+
+def create_role(db, role):
+    if cache.get(role_name_key(role.name)) is not MISSING:
+        raise HTTPException(status_code=404, detail="role exists")
+    try:
+        new_role = db.execute(insert_returning(Role, name=role.name)).one()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=404, detail="role exists")
+    invalidate_roles()
+    cache.set(role_name_key(new_role.name), new_role.id)
+    return new_role
+
+
+def create_roles(db, roles):
+    bulk.check_size(roles)
+    result = bulk.create_roles(db, roles)
+    invalidate_roles()
+    return result
+
+
+def roles_version(db):
+    # A single-row lookup, so an unchanged collection is answered before
+    # the page query runs
+    return db.scalar(collection_versions_stmt("roles"))
+
+
+def load_roles_page(db, page):
+    if FAST_SERIALIZATION:
+        rows = db.execute(paginate(select(*model_columns(Role, RoleResponse)), Role.id, page))
+        return make_page(row_dicts(rows), page, key=lambda row: row["id"])
+    rows = db.scalars(paginate(select(Role), Role.id, page)).all()
+    return Page[RoleResponse].model_validate(make_page(rows, page)).model_dump(mode="json")
+
+
+def role_stats_etag(db, source):
+    versions = db.scalars(collection_versions_stmt("roles", "user_roles")).all()
+    return make_etag("role_stats", source, *versions)
+
+
+def role_stats(db, source):
+    return db.execute(role_stats_stmt(source)).all()
+
+
+def load_role(db, role_id):
+    role = db.get(Role, role_id)
+    if not role:
+        raise HTTPException(status_code=404, detail="Role not found")
+    return RoleResponse.model_validate(role).model_dump(mode="json")
+
+
+def role_users(db, role_id, page):
+    if FAST_SERIALIZATION:
+        rows = db.execute(paginate(role_users_stmt(role_id, *model_columns(User, UserResponse)), UserRole.user_id, page))
+        result = make_page(row_dicts(rows), page, key=lambda row: row["id"])
+    else:
+        result = make_page(db.scalars(paginate(role_users_stmt(role_id), UserRole.user_id, page)).all(), page)
+    # Only an empty first page needs to tell "no members" from "no such role"
+    if not result["items"] and page.after is None and db.get(Role, role_id) is None:
+        raise HTTPException(status_code=404, detail="Role not found")
+    return FastJSONResponse(result) if FAST_SERIALIZATION else result
+
+
+def update_role(db, role_id, role):
+    try:
+        updated_role = db.execute(update_returning(Role, role_id, name=role.name)).first()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=404, detail="role exists")
+    if not updated_role:
+        raise HTTPException(status_code=404, detail="Role not found")
+    invalidate_roles(role_id)
+    invalidate_role_names()
+    return updated_role
+
+
+def delete_role(db, role_id):
+    deleted = db.execute(delete_returning(Role, role_id, Role.name)).first()
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Role not found")
+    db.commit()
+    invalidate_roles(role_id, deleted.name)
+    permissions.drop_role(role_id)
+    return {"message": "Role deleted successfully"}
+
+
+def assign_role(db, user_id, role_id):
+    # Assigning the same role twice returns the existing assignment
+    try:
+        assignment = db.scalar(assign_role_stmt(db, user_id, role_id))
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=404, detail="User or role not found")
+    if assignment is None:
+        assignment = db.scalar(assignment_stmt(user_id, role_id))
+    db.commit()
+    invalidate_assignments(user_id)
+    permissions.grant(user_id, role_id)
+    return assignment
+
+
+def assign_roles(db, user_roles):
+    bulk.check_size(user_roles)
+    result = bulk.assign_roles(db, user_roles)
+    user_ids = {item.user_id for item in user_roles}
+    for user_id in user_ids:
+        invalidate_assignments(user_id)
+    permissions.forget(*user_ids)
+    return result
+
+
+def list_assignments(db, page, headers=None):
+    return list_page(db, UserRole, UserRoleResponse, page, headers=headers)
+
+
+def user_roles_etag(db, user_id):
+    versions = db.scalars(collection_versions_stmt("users", "roles", "user_roles")).all()
+    return make_etag("user_roles", user_id, *versions)
+
+
+def load_user_roles(db, user_id):
+    rows = db.execute(roles_for_user_stmt(user_id)).all()
+    return [UserRoleResponsejoin.model_validate(row).model_dump(mode="json") for row in rows]
+
+
+def unassign_role(db, user_id, role_id):
+    result = db.execute(unassign_role_stmt(user_id, role_id))
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail="Assignment not found")
+    db.commit()
+    invalidate_assignments(user_id)
+    permissions.revoke(user_id, role_id)
+    return {"message": "Role unassigned successfully"}
+
+
+def create_location(db, location):
+    try:
+        new_location = db.execute(insert_returning(Location, location=location.location)).one()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Location already exists")
+    return new_location
+
+
+def get_location(db, location_id):
+    location = db.get(Location, location_id)
+    if not location:
+        raise HTTPException(status_code=404, detail="Location not found")
+    return location
+
+
+def update_location(db, location_id, location):
+    try:
+        updated_location = db.execute(update_returning(Location, location_id, location=location.location)).first()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Location already exists")
+    if not updated_location:
+        raise HTTPException(status_code=404, detail="Location not found")
+    return updated_location
+
+
+def delete_location(db, location_id):
+    if not db.execute(delete_returning(Location, location_id)).first():
+        raise HTTPException(status_code=404, detail="Location not found")
+    db.commit()
+    return {"message": "Location deleted successfully"}
+
+
+def list_changes(db, since, limit):
+    result = changes_page(db.execute(changes_stmt(since, limit)), since)
+    return FastJSONResponse(result) if FAST_SERIALIZATION else result
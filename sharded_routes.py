@@ -0,0 +1,305 @@
+from typing import Literal
+
+from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import database
+from database import get_db
+from models import User, Role, UserRole
+from schemas import (
+    UserCreate, UserResponse, RoleCreate, RoleResponse, UserRoleCreate,
+    UserRoleResponse, RoleCheck, RoleStats,
+)
+from pagination import Page, PageParams, paginate
+from export import EXPORT_TABLES, FORMATS, stream_table
+import bulk
+import services
+from bulk import dialect_insert
+from queries import (
+    assignment_stmt, role_users_stmt, role_stats_stmt, insert_returning, update_returning,
+    delete_returning,
+)
+from cache import (
+    MISSING, cache, role_name_key, invalidate_roles, invalidate_role_names, invalidate_assignments,
+)
+from serialization import FAST_SERIALIZATION, FastJSONResponse, model_columns, row_dicts
+from sharding import next_id, merge_pages
+from permissions import permissions, user_role_ids
+from metrics import InstrumentedRoute
+
+# Handlers that replace the ones in main.py when SHARD_URLS is set. Routes
+# about a single user are mostly not here: get_db already hands them the
+# session of that user's shard. These cover creating and updating users
+# (emails are unique across shards), everything that spans users (fanned
+# out to all shards in parallel) and role writes (applied to every shard).
+router = APIRouter(route_class=InstrumentedRoute)
+
+SHARDED_TABLES = {"users", "user_roles"}
+
+
+def _not_sharded():
+    raise HTTPException(status_code=501, detail="Not available in sharded mode")
+
+
+def _page_response(result):
+    return FastJSONResponse(result) if FAST_SERIALIZATION else result
+
+
+def _email_taken(email, user_id=None):
+    # The unique index only covers one shard, and an update may have moved
+    # an email away from the shard it hashes to, so look everywhere
+    def lookup(db):
+        stmt = select(User.id).where(User.email == email)
+        if user_id is not None:
+            stmt = stmt.where(User.id != user_id)
+        return db.scalar(stmt)
+    return any(found is not None for found in database.shards.fan_out(lookup))
+
+
+def _write_shards(fn, indexes):
+    """Run ``fn(session)`` on the given shards in parallel. Returns the
+    results in shard order (None where it failed) and the failed indexes."""
+    def attempt(db):
+        try:
+            return fn(db), False
+        except Exception:
+            db.rollback()
+            return None, True
+    outcomes = database.shards.fan_out(attempt, indexes)
+    failed = [index for index, (_, error) in zip(indexes, outcomes) if error]
+    return [result for result, _ in outcomes], failed
+
+
+def _copy_role(role_id, name):
+    # An upsert, so a retry repairs shards that missed an earlier copy
+    def copy(db):
+        table = Role.__table__
+        db.execute(
+            dialect_insert(db, table)
+            .values(id=role_id, name=name)
+            .on_conflict_do_update(index_elements=[table.c.id], set_={"name": name})
+        )
+        db.commit()
+    return copy
+
+
+def _copy_failed(role_id, failed, retry):
+    # Shard 0 has the change but some copies do not; the role writes are
+    # idempotent, so repeating the request brings those shards up to date
+    raise HTTPException(
+        status_code=503,
+        detail=f"Role {role_id} was not written to shards {failed}; retry with {retry}",
+    )
+
+
+@router.post("/users", response_model=UserResponse)
+def create_user(user: UserCreate):
+    shards = database.shards
+    if _email_taken(user.email):
+        raise HTTPException(status_code=400, detail="Email already registered")
+    index = shards.index_for_email(user.email)
+    with shards.session(index) as db:
+        try:
+            new_user = db.execute(
+                insert_returning(User, id=next_id(db, User, index, len(shards)), **user.model_dump())
+            ).one()
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            # Only the unique email index means a duplicate; anything else,
+            # such as an id collision, is a server error
+            if db.scalar(select(User.id).where(User.email == user.email)) is None:
+                raise
+            raise HTTPException(status_code=400, detail="Email already registered")
+    return new_user
+
+@router.put("/users/{user_id}", response_model=UserResponse)
+def update_user(user_id: int, user: UserCreate):
+    # Concurrent writes can still race past the check, as in create_user
+    shards = database.shards
+    if _email_taken(user.email, user_id):
+        raise HTTPException(status_code=400, detail="Email already registered")
+    with shards.session(shards.index_for_user(user_id)) as db:
+        return services.update_user(db, user_id, user)
+
+@router.post("/users/bulk")
+def bulk_upsert_users():
+    _not_sharded()
+
+@router.get("/users", response_model=Page[UserResponse])
+def get_users(page: PageParams = Depends()):
+    def load(db):
+        return row_dicts(db.execute(paginate(select(*model_columns(User, UserResponse)), User.id, page)))
+    return _page_response(merge_pages(database.shards.fan_out(load), page, key=lambda row: row["id"]))
+
+@router.get("/users/search")
+def search_users():
+    # bm25 ranks from different shards are not comparable
+    _not_sharded()
+
+
+@router.post("/roles", response_model=RoleResponse)
+def post_role(role: RoleCreate):
+    if cache.get(role_name_key(role.name)) is not MISSING:
+        raise HTTPException(status_code=404, detail="role exists")
+    shards = database.shards
+    # Shard 0 assigns the id and guards the name; the other shards copy it
+    with shards.session(0) as db:
+        try:
+            new_role = db.execute(insert_returning(Role, name=role.name)).one()
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            raise HTTPException(status_code=404, detail="role exists")
+    _, failed = _write_shards(_copy_role(new_role.id, new_role.name), range(1, len(shards)))
+    invalidate_roles()
+    if failed:
+        _copy_failed(new_role.id, failed, f"PUT /roles/{new_role.id}")
+    cache.set(role_name_key(new_role.name), new_role.id)
+    return new_role
+
+@router.post("/roles/bulk")
+def bulk_create_roles():
+    _not_sharded()
+
+@router.get("/roles/stats", response_model=list[RoleStats])
+def get_role_stats(source: Literal["aggregate", "counter"] = "aggregate"):
+    totals = {}
+    for rows in database.shards.fan_out(lambda db: row_dicts(db.execute(role_stats_stmt(source)))):
+        for row in rows:
+            totals.setdefault(row["role_id"], {**row, "users": 0})["users"] += row["users"]
+    return [totals[role_id] for role_id in sorted(totals)]
+
+@router.get("/roles/{role_id}/users", response_model=Page[UserResponse])
+def get_role_users(role_id: int, page: PageParams = Depends()):
+    shards = database.shards
+
+    def load(db):
+        stmt = role_users_stmt(role_id, *model_columns(User, UserResponse))
+        return row_dicts(db.execute(paginate(stmt, UserRole.user_id, page)))
+    result = merge_pages(shards.fan_out(load), page, key=lambda row: row["id"])
+    if not result["items"] and page.after is None:
+        with shards.session(0) as db:
+            if db.get(Role, role_id) is None:
+                raise HTTPException(status_code=404, detail="Role not found")
+    return _page_response(result)
+
+@router.put("/roles/{role_id}", response_model=RoleResponse)
+def update_role(role_id: int, role: RoleCreate):
+    shards = database.shards
+    with shards.session(0) as db:
+        try:
+            updated_role = db.execute(update_returning(Role, role_id, name=role.name)).first()
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            raise HTTPException(status_code=404, detail="role exists")
+    if not updated_role:
+        raise HTTPException(status_code=404, detail="Role not found")
+    _, failed = _write_shards(_copy_role(role_id, role.name), range(1, len(shards)))
+    invalidate_roles(role_id)
+    invalidate_role_names()
+    if failed:
+        _copy_failed(role_id, failed, f"PUT /roles/{role_id}")
+    return updated_role
+
+@router.delete("/roles/{role_id}")
+def delete_role(role_id: int):
+    def delete(db):
+        deleted = db.execute(delete_returning(Role, role_id, Role.name)).first()
+        db.commit()
+        return deleted
+    # A retry after a partial failure finds the role on the shards it is
+    # still on, so any shard's row counts
+    results, failed = _write_shards(delete, range(len(database.shards)))
+    deleted = next((row for row in results if row), None)
+    invalidate_roles(role_id, deleted.name if deleted else None)
+    permissions.drop_role(role_id)
+    if failed:
+        _copy_failed(role_id, failed, f"DELETE /roles/{role_id}")
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Role not found")
+    return {"message": "Role deleted successfully"}
+
+
+@router.post("/user_roles", response_model=UserRoleResponse)
+def assign_role_to_user(user_role: UserRoleCreate):
+    shards = database.shards
+    index = shards.index_for_user(user_role.user_id)
+    with shards.session(index) as db:
+        # Assignment ids follow the same id % K rule, so merged listings
+        # never show two rows with one id
+        try:
+            assignment = db.scalar(
+                dialect_insert(db, UserRole)
+                .values(id=next_id(db, UserRole, index, len(shards)), user_id=user_role.user_id, role_id=user_role.role_id)
+                .on_conflict_do_nothing(index_elements=["user_id", "role_id"])
+                .returning(UserRole)
+            )
+        except IntegrityError:
+            db.rollback()
+            raise HTTPException(status_code=404, detail="User or role not found")
+        if assignment is None:
+            assignment = db.scalar(assignment_stmt(user_role.user_id, user_role.role_id))
+        response = UserRoleResponse.model_validate(assignment)
+        db.commit()
+    invalidate_assignments(user_role.user_id)
+    permissions.grant(user_role.user_id, user_role.role_id)
+    return response
+
+@router.post("/user_roles/check", response_model=list[RoleCheck])
+def check_roles(checks: list[UserRoleCreate]):
+    bulk.check_size(checks)
+    shards = database.shards
+    pairs = [(check.user_id, check.role_id) for check in checks]
+
+    def load(user_ids):
+        # Each shard only has rows for its own users, so every shard involved
+        # can be asked about all of them
+        indexes = sorted({shards.index_for_user(user_id) for user_id in user_ids})
+        roles = {}
+        for part in shards.fan_out(lambda db: user_role_ids(db, user_ids), indexes):
+            roles.update(part)
+        return roles
+    granted = permissions.check(pairs, load)
+    return [
+        {"user_id": user_id, "role_id": role_id, "has_role": answer}
+        for (user_id, role_id), answer in zip(pairs, granted)
+    ]
+
+@router.post("/user_roles/bulk")
+def bulk_assign_roles():
+    _not_sharded()
+
+@router.get("/user_roles", response_model=Page[UserRoleResponse])
+def get_user_roles(page: PageParams = Depends()):
+    def load(db):
+        stmt = paginate(select(*model_columns(UserRole, UserRoleResponse)), UserRole.id, page)
+        return row_dicts(db.execute(stmt))
+    return _page_response(merge_pages(database.shards.fan_out(load), page, key=lambda row: row["id"]))
+
+
+@router.get("/export/{table}")
+def export_table(table: str, format: Literal["ndjson", "csv"] = "ndjson", db: Session = Depends(get_db)):
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail="Table not found")
+    if table in SHARDED_TABLES:
+        _not_sharded()
+    return StreamingResponse(
+        stream_table(db, table, format),
+        media_type=FORMATS[format].media_type,
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'},
+    )
+
+
+@router.get("/changes")
+def get_changes():
+    # Every shard numbers its own log
+    _not_sharded()
+
+@router.get("/changes/stream")
+def stream_change_feed():
+    _not_sharded()
@@ -0,0 +1,130 @@
+"""Sharded mode: users and user_roles spread over several databases.
+
+Create the shard schemas once with
+
+    SHARD_URLS=sqlite:///./shard0.db,sqlite:///./shard1.db python -m sharding
+"""
+import heapq
+import itertools
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import Sequence, create_engine, func, select, text
+from sqlalchemy.orm import sessionmaker
+
+from pagination import make_page
+
+
+class ShardSet:
+    """K databases holding disjoint sets of users.
+
+    A user's id says where it lives: ids are minted so that ``id % K`` is the
+    shard index. New users go to the shard picked by a hash of their email.
+    Role assignments live with their user; roles are copied to every shard so
+    joins stay local; other tables live on shard 0."""
+
+    def __init__(self, engines):
+        self.engines = engines
+        self.sessionmakers = [sessionmaker(autocommit=False, autoflush=False, bind=engine) for engine in engines]
+        self._pool = ThreadPoolExecutor(max_workers=len(engines)) if engines else None
+
+    def __len__(self):
+        return len(self.engines)
+
+    def __bool__(self):
+        return bool(self.engines)
+
+    def index_for_user(self, user_id):
+        return user_id % len(self)
+
+    def index_for_email(self, email):
+        # crc32 rather than hash() so placement survives restarts
+        return zlib.crc32(email.encode()) % len(self)
+
+    def session(self, index):
+        return self.sessionmakers[index]()
+
+    def fan_out(self, fn, indexes=None):
+        """Run ``fn(session)`` on every shard (or the given ones) in
+        parallel; results come back in shard order."""
+        def run(index):
+            with self.session(index) as db:
+                return fn(db)
+        return list(self._pool.map(run, range(len(self)) if indexes is None else indexes))
+
+
+# Tables whose ids say which shard a row lives on
+SHARDED_ID_TABLES = ("users", "user_roles")
+
+
+def _id_sequence(table):
+    return f"{table}_shard_id_seq"
+
+
+def _first_id(highest, index, shard_count):
+    # The smallest id above ``highest`` with ``id % shard_count == index``
+    return highest - (highest - index) % shard_count + shard_count
+
+
+def next_id(db, model, index, shard_count):
+    """Expression for the next id on shard ``index``, evaluated inside the
+    INSERT.
+
+    On SQLite it is the smallest id above the table's maximum with
+    ``id % shard_count == index``; the database write lock keeps concurrent
+    inserts from reading the same maximum, and MAX over the primary key is a
+    single index probe. Other databases let two inserts read the same
+    maximum, so they draw from a sequence that ``migrate`` creates with a
+    step of ``shard_count``."""
+    dialect = db.get_bind().dialect.name
+    if dialect == "sqlite":
+        highest = func.coalesce(func.max(model.id), index)
+        return select(_first_id(highest, index, shard_count)).scalar_subquery()
+    if dialect == "postgresql":
+        return Sequence(_id_sequence(model.__tablename__)).next_value()
+    raise NotImplementedError(f"shard ids are not defined for {dialect}")
+
+
+def merge_pages(pages, params, key):
+    """Merge per-shard pages, each sorted by ``key`` and fetched with
+    ``paginate``, into one page of the global order."""
+    rows = list(itertools.islice(heapq.merge(*pages, key=key), params.limit + 1))
+    return make_page(rows, params, key=key)
+
+
+def migrate(urls):
+    """Upgrade every shard to the latest schema, then drop rows the
+    migrations seeded on shards they do not belong to (the default admin
+    user is created on each one). Shards copied from one existing database
+    keep the users placed on them and those users' assignments."""
+    for index, url in enumerate(urls):
+        alembic_config = Config("alembic.ini")
+        alembic_config.set_main_option("sqlalchemy.url", url)
+        command.upgrade(alembic_config, "head")
+        engine = create_engine(url)
+        params = {"count": len(urls), "index": index}
+        with engine.begin() as connection:
+            connection.execute(text("DELETE FROM user_roles WHERE user_id % :count != :index"), params)
+            connection.execute(text("DELETE FROM users WHERE id % :count != :index"), params)
+            # Assignment ids must follow the same rule as user ids so the ids
+            # next_id mints never collide with rows on other shards and merged
+            # listings stay unique. Going through negative ids keeps every
+            # intermediate id free.
+            if connection.execute(text("SELECT 1 FROM user_roles WHERE id % :count != :index LIMIT 1"), params).first():
+                connection.execute(text("UPDATE user_roles SET id = -id"))
+                connection.execute(text("UPDATE user_roles SET id = -id * :count + :index"), params)
+            if engine.dialect.name == "postgresql":
+                for table in SHARDED_ID_TABLES:
+                    highest = connection.execute(text(f"SELECT coalesce(max(id), :index) FROM {table}"), params).scalar()
+                    connection.execute(text(
+                        f"CREATE SEQUENCE IF NOT EXISTS {_id_sequence(table)} "
+                        f"START WITH {_first_id(highest, index, len(urls))} INCREMENT BY {len(urls)}"
+                    ))
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    from config import SHARD_URLS
+    migrate(SHARD_URLS)
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs one load per key at a time; callers that arrive while it is in
+    flight wait for it and share its result (or exception).
+
+    Only the load is coalesced: every caller gets the same object back and
+    still encodes its own response from it.
+
+    ``do`` serves the sync handlers on the threadpool, ``do_async`` the
+    async handlers on the event loop; the two keep separate in-flight maps."""
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key, fn):
+        task = self._tasks.get(key)
+        if task is None:
+            # A task of its own, so a cancelled leader does not fail the
+            # requests waiting on it. ``fn`` must therefore not use anything
+            # scoped to the leader's request, such as its session.
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # Waiters re-raise the error themselves; retrieving it here keeps
+        # asyncio from reporting it as never retrieved when they were all
+        # cancelled first
+        if not task.cancelled():
+            task.exception()
+
+    def forget(self, key):
+        """Make later callers start a fresh load instead of joining one that
+        may have read data from before a write."""
+        with self._lock:
+            self._calls.pop(key, None)
+        self._tasks.pop(key, None)
+
+    def forget_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._calls if key.startswith(prefix)]:
+                del self._calls[key]
+        for key in [key for key in self._tasks if key.startswith(prefix)]:
+            del self._tasks[key]
+
+    def clear(self):
+        with self._lock:
+            self._calls.clear()
+        self._tasks.clear()
+        self.coalesced = 0
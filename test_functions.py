@@ -1,90 +1,16 @@
+from sqlalchemy.orm import Session
 import pytest
-from fastapi.testclient import TestClient
-from main import app, SessionLocal, engine
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from models import User, Role, UserRole
-# from database import Base  # Assuming you have Base defined in your database module
-from alembic import command
-from alembic.config import Config
-from sqlalchemy.ext.declarative import declarative_base
-
-# Setup the Test Database
-TEST_DATABASE_URL = "sqlite:///./unittest.db"  # Use a different DB for testing
-
-@pytest.fixture(scope="module")
-def alembic_config():
-    """Provide the Alembic configuration for migrations."""
-    config = Config("alembic.ini")
-    config.set_main_option("sqlalchemy.url", TEST_DATABASE_URL)  # Use test DB URL
-    return config
-
-@pytest.fixture(scope="module")
-def engine_create():
-    """Create and drop tables in the test database."""
-    engine = create_engine(TEST_DATABASE_URL)
-    Base = declarative_base()
-    Base.metadata.create_all(bind=engine)  # Ensure tables are created explicitly before migrations
-    yield engine
-    Base.metadata.drop_all(bind=engine)  # Clean up after tests
-
-@pytest.fixture(scope="module")
-def connection(engine):
-    """Create a database connection."""
-    connection = engine.connect()
-    yield connection
-    connection.close()
-
-@pytest.fixture(scope="function", autouse=True)
-def migrate_db(engine, alembic_config):
-    """Run migrations before each test and ensure the database is in the correct state."""
-    alembic_config.attributes["connection"] = engine.connect()  # Pass the engine connection to Alembic
-    command.stamp(alembic_config, "head")  # Stamp the current revision in the database
-    command.upgrade(alembic_config, "head")  # Apply all migrations
-    yield
-    command.downgrade(alembic_config, "base")  # Downgrade to base after each test
-
-
-@pytest.fixture(scope="function")
-def db_session(connection):
-    """Provide a new database session for each test."""
-    transaction = connection.begin()  # Start a transaction
-    SessionLocal = sessionmaker(bind=connection)  # Use the test engine for session
-    session = SessionLocal()
-
-    yield session
-
-    session.close()  # Close the session
-    transaction.rollback()  # Rollback the transaction
-
-
-@pytest.fixture
-def client(db_session):
-    """Create a test client that uses the test database session."""
-    # Override the dependency for getting the database session
-    def override_get_db():
-        yield db_session
-
-    # Apply the override to the FastAPI app
-    app.dependency_overrides[SessionLocal] = override_get_db
-
-    # Create the test client
-    with TestClient(app) as client:
-        yield client
-
-    # Clear the overrides after the test
-    app.dependency_overrides.clear()
 
+# Database fixtures (template_database, db_session, client, ...) live in
+# conftest.py: migrations run once per session and every test works on a
+# copy of the result.
 
 
 @pytest.fixture
-def db():
-    # Test database session
-    db = SessionLocal()
-    try:
+def db(memory_engine):
+    # Test database session on a private, committed-to copy
+    with Session(memory_engine) as db:
         yield db
-    finally:
-        db.close()
 
 
 
@@ -1,63 +1,30 @@
+import json
 import pytest
+from contextlib import contextmanager
 from fastapi.testclient import TestClient
 from main import app
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
-from alembic import command
-from alembic.config import Config
-from sqlalchemy.ext.declarative import declarative_base
-from database import Base, get_db
-
-# Setup the Test Database
-TEST_DATABASE_URL = "sqlite:///./unittest.db"  # Use a different DB for testing
-
-# Create a new engine and session for the test database
-TestEngine = create_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False})
-TestSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=TestEngine)
-
-@pytest.fixture(scope="module")
-def alembic_config():
-    """Provide the Alembic configuration for migrations."""
-    config = Config("alembic.ini")
-    config.set_main_option("sqlalchemy.url", TEST_DATABASE_URL)  # Use test DB URL
-    return config
-
-@pytest.fixture(scope="module")
-def apply_migrations(alembic_config):
-    """Apply migrations to the test database."""
-    command.upgrade(alembic_config, "head")  # Apply all migrations
-    yield
-    command.downgrade(alembic_config, "base")  # Downgrade to base after tests
-
-@pytest.fixture(scope="function")
-def db_session(apply_migrations):
-    """Provide a new database session for each test."""
-    connection = TestEngine.connect()
-    transaction = connection.begin()  # Start a transaction
-    session = TestSessionLocal(bind=connection)  # Use the test engine for session
-
-    yield session
-
-    session.close()  # Close the session
-    transaction.rollback()  # Rollback the transaction
-    connection.close()
-
-@pytest.fixture
-def client(db_session):
-    """Create a test client that uses the test database session."""
-    # Override the dependency for getting the database session
-    def override_get_db():
-        yield db_session
+from database import Base, create_db_engine
+from cache import cache
+from permissions import permissions
 
-    # Apply the override to the FastAPI app
-    app.dependency_overrides[get_db] = override_get_db
+@contextmanager
+def count_queries():
+    """Collect the SQL statements sent to any database."""
+    statements = []
 
-    # Create the test client
-    with TestClient(app) as client:
-        yield client
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # Savepoints come from the db_session fixture, not the handlers
+        if not statement.startswith(("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")):
+            statements.append(statement)
 
-    # Clear the overrides after the test
-    app.dependency_overrides.clear()
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
 
 # Test POST user creation
 def test_create_user(client):
@@ -75,9 +42,9 @@ def test_get_users(client):
     client.post("/users", json={"name": "Jane Doe", "email": "jane@example.com", "age": 28})
     response = client.get("/users")
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert len(data) > 0
-    assert data[0]["name"] == "Jane Doe"
+    assert "Jane Doe" in [user["name"] for user in data]
 
 def test_get_user(client):
     response = client.post("/users", json={"name": "John Smith", "email": "johnsmith@example.com", "age": 25})
@@ -118,10 +85,33 @@ def test_get_roles(client):
     response = client.post("/roles", json={"name": "Admin"})
     response = client.get("/roles")
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert len(data) > 0
     assert data[0]["name"] == "Admin"
 
+def test_get_roles_paginated(client):
+    for i in range(5):
+        client.post("/roles", json={"name": f"Role {i}"})
+    names = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/roles", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page["items"]) <= 2
+        names += [role["name"] for role in page["items"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert names == [f"Role {i}" for i in range(5)]
+
+def test_pagination_limits(client):
+    assert client.get("/users", params={"limit": 100000}).status_code == 422
+    assert client.get("/users", params={"cursor": "not-a-cursor"}).status_code == 400
+
 def test_put_role(client):
     response = client.post("/roles", json={"name": "Admin"})
     role_id = response.json()["id"]
@@ -146,4 +136,989 @@ def test_assign_role(client):
     role_id = response_role.json()["id"]
     response_assign = client.post(f"/user_roles", json={"user_id": user_id, "role_id": role_id})
     assert response_assign.status_code == 200
-    assert response_assign.json()["user_id"] == user_id
\ No newline at end of file
+    assert response_assign.json()["user_id"] == user_id
+
+def test_assign_role_is_idempotent(client):
+    user_id = client.post("/users", json={"name": "Twice", "email": "twice@example.com", "age": 25}).json()["id"]
+    role_id = client.post("/roles", json={"name": "Admin"}).json()["id"]
+    first = client.post("/user_roles", json={"user_id": user_id, "role_id": role_id})
+    second = client.post("/user_roles", json={"user_id": user_id, "role_id": role_id})
+    assert second.status_code == 200
+    assert second.json()["id"] == first.json()["id"]
+    assert len(client.get(f"/user_roles/{user_id}").json()) == 1
+
+    response = client.post("/user_roles/bulk", json=[{"user_id": user_id, "role_id": role_id}])
+    assert [result["status"] for result in response.json()["results"]] == ["conflict"]
+
+def test_role_users_and_stats(client):
+    role_ids = [client.post("/roles", json={"name": name}).json()["id"] for name in ("Admin", "Editor", "Empty")]
+    user_ids = [
+        client.post("/users", json={"name": f"Member {i}", "email": f"member{i}@example.com", "age": 30}).json()["id"]
+        for i in range(3)
+    ]
+    client.post("/user_roles/bulk", json=[{"user_id": user_id, "role_id": role_ids[0]} for user_id in user_ids])
+    client.post("/user_roles", json={"user_id": user_ids[0], "role_id": role_ids[1]})
+
+    first = client.get(f"/roles/{role_ids[0]}/users", params={"limit": 2}).json()
+    second = client.get(f"/roles/{role_ids[0]}/users", params={"limit": 2, "cursor": first["next_cursor"]}).json()
+    assert [user["id"] for user in first["items"] + second["items"]] == user_ids
+    assert second["next_cursor"] is None
+    assert client.get(f"/roles/{role_ids[2]}/users").json()["items"] == []
+    assert client.get("/roles/999999/users").status_code == 404
+
+    expected = {role_ids[0]: 3, role_ids[1]: 1, role_ids[2]: 0}
+    for source in ("aggregate", "counter"):
+        stats = client.get("/roles/stats", params={"source": source}).json()
+        assert {row["role_id"]: row["users"] for row in stats} == expected
+
+    assert client.delete(f"/user_roles/{user_ids[0]}/{role_ids[0]}").status_code == 200
+    assert client.delete(f"/user_roles/{user_ids[0]}/{role_ids[0]}").status_code == 404
+    for source in ("aggregate", "counter"):
+        stats = client.get("/roles/stats", params={"source": source}).json()
+        assert {row["role_id"]: row["users"] for row in stats}[role_ids[0]] == 2
+
+def test_cascading_deletes(client):
+    role_ids = [client.post("/roles", json={"name": name}).json()["id"] for name in ("Shared", "Other")]
+    user_ids = [
+        client.post("/users", json={"name": f"Holder {i}", "email": f"holder{i}@example.com", "age": 30}).json()["id"]
+        for i in range(50)
+    ]
+    client.post("/user_roles/bulk", json=[{"user_id": user_id, "role_id": role_ids[0]} for user_id in user_ids])
+    client.post("/user_roles", json={"user_id": user_ids[0], "role_id": role_ids[1]})
+    assert client.get(f"/user_roles/{user_ids[0]}").json()[0]["role_name"] == "Shared"
+
+    # One statement removes the role and all 50 assignments
+    with count_queries() as statements:
+        assert client.delete(f"/roles/{role_ids[0]}").status_code == 200
+    assert len(statements) == 1
+    assert [role["role_id"] for role in client.get(f"/user_roles/{user_ids[0]}").json()] == [role_ids[1]]
+    stats = client.get("/roles/stats", params={"source": "counter"}).json()
+    assert {row["role_id"]: row["users"] for row in stats} == {role_ids[1]: 1}
+
+    assert client.delete(f"/users/{user_ids[0]}").status_code == 200
+    assert client.get("/user_roles").json()["items"] == []
+    assert client.get(f"/roles/{role_ids[1]}/users").json()["items"] == []
+
+    response = client.post("/user_roles", json={"user_id": user_ids[0], "role_id": role_ids[1]})
+    assert (response.status_code, response.json()["detail"]) == (404, "User or role not found")
+    assert client.post("/user_roles", json={"user_id": user_ids[1], "role_id": role_ids[1]}).status_code == 200
+
+def test_role_check_index(client, db_session, monkeypatch):
+    from models import UserRole
+    from permissions import assignment_rows
+
+    role_ids = [client.post("/roles", json={"name": name}).json()["id"] for name in ("Reader", "Writer", "Admin")]
+    user_id = client.post("/users", json={"name": "Checked", "email": "checked@example.com", "age": 30}).json()["id"]
+    client.post("/user_roles", json={"user_id": user_id, "role_id": role_ids[0]})
+
+    # The first check loads the user; later ones and writes through the API
+    # never reach the database
+    assert client.get(f"/users/{user_id}/has_role/{role_ids[0]}").json()["has_role"] is True
+    with count_queries() as statements:
+        assert client.get(f"/users/{user_id}/has_role/{role_ids[0]}").json() == {
+            "user_id": user_id, "role_id": role_ids[0], "has_role": True,
+        }
+        assert client.get(f"/users/{user_id}/has_role/{role_ids[1]}").json()["has_role"] is False
+    assert statements == []
+    client.post("/user_roles", json={"user_id": user_id, "role_id": role_ids[1]})
+    client.delete(f"/user_roles/{user_id}/{role_ids[0]}")
+    checks = [{"user_id": user_id, "role_id": role_id} for role_id in role_ids] + [{"user_id": 999999, "role_id": role_ids[0]}]
+    with count_queries() as statements:
+        response = client.post("/user_roles/check", json=checks[:3])
+    assert statements == []
+    assert [item["has_role"] for item in response.json()] == [False, True, False]
+    assert [item["has_role"] for item in client.post("/user_roles/check", json=checks).json()] == [False, True, False, False]
+    # No role has a negative id; the check answers instead of failing
+    assert client.get(f"/users/{user_id}/has_role/-1").json()["has_role"] is False
+    assert client.post("/user_roles/check", json=[{"user_id": user_id, "role_id": -1}]).json()[0]["has_role"] is False
+    # Nor does an id far above any role cost memory in proportion to it
+    assert client.get(f"/users/{user_id}/has_role/{10**12}").json()["has_role"] is False
+
+    # Writes from elsewhere show up once the entry is stale
+    db_session.add(UserRole(user_id=user_id, role_id=role_ids[2]))
+    db_session.flush()
+    assert client.get(f"/users/{user_id}/has_role/{role_ids[2]}").json()["has_role"] is False
+    monkeypatch.setattr(permissions, "ttl", 0)
+    assert client.get(f"/users/{user_id}/has_role/{role_ids[2]}").json()["has_role"] is True
+    monkeypatch.undo()
+
+    client.delete(f"/roles/{role_ids[1]}")
+    assert client.get(f"/users/{user_id}/has_role/{role_ids[1]}").json()["has_role"] is False
+    permissions.build(assignment_rows(db_session))
+    with count_queries() as statements:
+        assert client.get(f"/users/{user_id}/has_role/{role_ids[2]}").json()["has_role"] is True
+    assert statements == []
+
+def test_change_feed(client, db_session):
+    import asyncio
+    from changes import changes_stmt, stream_changes
+    from serialization import row_dicts
+
+    since = client.get("/changes").json()["last_seq"]
+    user_id = client.post("/users", json={"name": "Fed", "email": "fed@example.com", "age": 30}).json()["id"]
+    client.put(f"/users/{user_id}", json={"name": "Fed", "email": "fed@example.com", "age": 31})
+    role_id = client.post("/roles", json={"name": "Fed role"}).json()["id"]
+    assignment = client.post("/user_roles", json={"user_id": user_id, "role_id": role_id}).json()
+    client.delete(f"/roles/{role_id}")
+
+    changes = client.get("/changes", params={"since": since}).json()
+    assert [(item["table_name"], item["op"]) for item in changes["items"]] == [
+        ("users", "insert"), ("users", "update"), ("roles", "insert"), ("user_roles", "insert"),
+        ("user_roles", "delete"), ("roles", "delete"),
+    ]
+    assert changes["items"][1]["data"] == {"id": user_id, "name": "Fed", "email": "fed@example.com", "age": 31, "version": 2}
+    assert changes["items"][3]["data"]["assigned_at"] == assignment["assigned_at"]
+    assert changes["items"][-1]["data"] is None
+    assert changes["last_seq"] == changes["items"][-1]["seq"]
+    first = client.get("/changes", params={"since": since, "limit": 2}).json()
+    rest = client.get("/changes", params={"since": first["last_seq"]}).json()
+    assert first["items"] + rest["items"] == changes["items"]
+    assert client.get("/changes", params={"since": changes["last_seq"]}).json() == {"items": [], "last_seq": changes["last_seq"]}
+
+    async def fetch(after, limit):
+        return row_dicts(db_session.execute(changes_stmt(after, limit)))
+
+    async def read_events(polls):
+        async def is_disconnected():
+            polls.pop()
+            return not polls
+        stream = stream_changes(fetch, since, is_disconnected, batch_size=4, poll_interval=0, heartbeat=0)
+        return [event async for event in stream]
+
+    events = asyncio.run(read_events([None] * 4))
+    # Two batches back to back, then a heartbeat once there is nothing new
+    assert [event.split(b"\n")[0] for event in events] == [
+        b"id: %d" % changes["items"][3]["seq"], b"id: %d" % changes["last_seq"], b": heartbeat",
+    ]
+    assert len(json.loads(events[0].split(b"\n")[2].removeprefix(b"data: "))) == 4
+
+def test_search(client, db_session):
+    from models import Location
+    from search import search_stmt
+
+    for name in ("John Smith", "Johnny Walker", "Alice Johnson", "Bob"):
+        client.post("/users", json={"name": name, "email": f"{name.split()[0].lower()}@example.com", "age": 30})
+    db_session.add_all([Location(location="Berlin"), Location(location="Bern"), Location(location="Oslo")])
+    db_session.commit()
+
+    names = [user["name"] for user in client.get("/users/search", params={"q": "joh"}).json()]
+    assert sorted(names) == ["Alice Johnson", "John Smith", "Johnny Walker"]
+    assert [user["name"] for user in client.get("/users/search", params={"q": "jo sm"}).json()] == ["John Smith"]
+    assert client.get("/users/search", params={"q": "\"*"}).json() == []
+    assert client.get("/users/search", params={"q": ""}).status_code == 422
+    locations = client.get("/locations/search", params={"q": "ber"}).json()
+    assert sorted(location["location"] for location in locations) == ["Berlin", "Bern"]
+
+    # LIKE fallback for databases without FTS5
+    assert [user.name for user in db_session.scalars(search_stmt("users", "john", 10, False))] == [
+        "John Smith", "Johnny Walker", "Alice Johnson",
+    ]
+    assert db_session.scalars(search_stmt("users", "100%", 10, False)).all() == []
+
+def test_location_crud(client):
+    response = client.post("/locations", json={"location": "Berlin"})
+    assert response.status_code == 200
+    location_id = response.json()["id"]
+    assert client.post("/locations", json={"location": "Berlin"}).status_code == 400
+    client.post("/locations", json={"location": "Paris"})
+
+    assert client.put(f"/locations/{location_id}", json={"location": "Paris"}).status_code == 400
+    assert client.put(f"/locations/{location_id}", json={"location": "Bern"}).json()["location"] == "Bern"
+    assert client.get(f"/locations/{location_id}").json() == {"id": location_id, "location": "Bern"}
+    assert [item["location"] for item in client.get("/locations").json()["items"]] == ["Bern", "Paris"]
+    assert client.delete(f"/locations/{location_id}").status_code == 200
+    assert client.get(f"/locations/{location_id}").status_code == 404
+
+def test_location_without_name(client, db_session):
+    from models import Location
+    # The column is nullable, so rows written outside the API may lack a name
+    location = Location(location=None)
+    db_session.add(location)
+    db_session.commit()
+    assert client.get(f"/locations/{location.id}").json() == {"id": location.id, "location": None}
+    assert client.get("/locations").json()["items"] == [{"id": location.id, "location": None}]
+
+def test_location_import(client, monkeypatch):
+    import importer
+    monkeypatch.setattr(importer, "IMPORT_BATCH_SIZE", 2)
+    client.post("/locations", json={"location": "Oslo"})
+
+    def chunked(text, size=7):
+        data = text.encode()
+        for start in range(0, len(data), size):
+            yield data[start:start + size]
+
+    ndjson = "".join(json.dumps({"location": name}) + "\n" for name in ["Oslo", "Rome", "Lima", "Rome", "Kyiv"])
+    response = client.post("/locations/import", content=chunked(ndjson + "not json\n{}\n"))
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["rows"], data["inserted"], data["ignored"], data["invalid"]) == (7, 3, 2, 2)
+    assert data["rows_per_second"] > 0
+
+    csv_body = "id,location\n1,Lima\n2,\"Quito, Ecuador\"\n"
+    response = client.post("/locations/import", params={"format": "csv"}, content=chunked(csv_body))
+    assert (response.json()["inserted"], response.json()["ignored"]) == (1, 1)
+    assert client.get("/locations/search", params={"q": "quito"}).json()[0]["location"] == "Quito, Ecuador"
+    assert client.post("/locations/import", params={"format": "csv"}, content="name\nLima\n").status_code == 400
+
+    # A line over the limit is rejected instead of buffered without bound
+    monkeypatch.setattr(importer, "IMPORT_MAX_LINE_LENGTH", 32)
+    response = client.post("/locations/import", content=chunked(json.dumps({"location": "x" * 64})))
+    assert response.status_code == 413
+    assert client.post("/locations/import", content=chunked(ndjson)).status_code == 200
+
+def test_single_statement_writes(client):
+    def statements_for(method, url, **kwargs):
+        with count_queries() as statements:
+            response = client.request(method, url, **kwargs)
+        return response, len(statements)
+
+    response, count = statements_for("POST", "/users", json={"name": "One", "email": "one@example.com", "age": 30})
+    assert (response.status_code, count) == (200, 1)
+    user_id = response.json()["id"]
+    response, count = statements_for("POST", "/users", json={"name": "Two", "email": "one@example.com", "age": 30})
+    assert (response.status_code, count) == (400, 1)
+    response, count = statements_for("PUT", f"/users/{user_id}", json={"name": "Uno", "email": "one@example.com", "age": 31})
+    assert (response.status_code, count) == (200, 1)
+    assert response.json()["name"] == "Uno"
+    assert statements_for("PUT", "/users/999999", json={"name": "X", "email": "x@example.com", "age": 1})[0].status_code == 404
+
+    response, count = statements_for("POST", "/roles", json={"name": "Writer"})
+    assert (response.status_code, count) == (200, 1)
+    role_id = response.json()["id"]
+    client.post("/roles", json={"name": "Reader"})
+    response, count = statements_for("PUT", f"/roles/{role_id}", json={"name": "Reader"})
+    assert (response.status_code, response.json()["detail"], count) == (404, "role exists", 1)
+    response, count = statements_for("PUT", f"/roles/{role_id}", json={"name": "Author"})
+    assert (response.status_code, count) == (200, 1)
+    # The rename frees the old name for a new role
+    assert client.post("/roles", json={"name": "Writer"}).status_code == 200
+
+    response, count = statements_for("DELETE", f"/roles/{role_id}")
+    assert (response.status_code, count) == (200, 1)
+    response, count = statements_for("DELETE", f"/users/{user_id}")
+    assert (response.status_code, count) == (200, 1)
+    assert client.get(f"/users/{user_id}").status_code == 404
+
+def test_user_roles_query_plans(db_session, test_engine):
+    from sqlalchemy import select
+    from models import UserRole
+    from queries import roles_for_user_stmt
+
+    def plan(stmt):
+        sql = str(stmt.compile(test_engine, compile_kwargs={"literal_binds": True}))
+        return " | ".join(row[-1] for row in db_session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}"))
+
+    assert "ix_user_roles_user_id_role_id" in plan(roles_for_user_stmt(1))
+    assert "ix_user_roles_role_id_user_id" in plan(select(UserRole.user_id).where(UserRole.role_id == 1))
+
+def test_get_roles_for_user(client):
+    response = client.post("/users", json={"name": "Alice", "email": "alice@example.com", "age": 26})
+    user_id = response.json()["id"]
+    role_ids = [client.post("/roles", json={"name": f"Role {i}"}).json()["id"] for i in range(5)]
+
+    client.post("/user_roles", json={"user_id": user_id, "role_id": role_ids[0]})
+    with count_queries() as statements:
+        response = client.get(f"/user_roles/{user_id}")
+    single_assignment_queries = len(statements)
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data) == 1
+    assert data[0]["user_name"] == "Alice"
+    assert data[0]["role_name"] == "Role 0"
+
+    for role_id in role_ids[1:]:
+        client.post("/user_roles", json={"user_id": user_id, "role_id": role_id})
+    with count_queries() as statements:
+        response = client.get(f"/user_roles/{user_id}")
+    assert len(response.json()) == 5
+    assert len(statements) == single_assignment_queries
+
+def test_export_table(client):
+    client.post("/roles", json={"name": "Admin"})
+    client.post("/roles", json={"name": "Editor"})
+
+    response = client.get("/export/roles")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = response.text.splitlines()
+    assert [json.loads(line)["name"] for line in lines] == ["Admin", "Editor"]
+
+    response = client.get("/export/roles", params={"format": "csv"})
+    assert response.status_code == 200
+    assert response.text.splitlines() == ["id,name,version", f"{json.loads(lines[0])['id']},Admin,1", f"{json.loads(lines[1])['id']},Editor,1"]
+
+    assert client.get("/export/secrets").status_code == 404
+
+def test_bulk_upsert_users(client):
+    client.post("/users", json={"name": "Old Name", "email": "existing@example.com", "age": 20})
+    users = [
+        {"name": "New", "email": "new@example.com", "age": 30},
+        {"name": "New Name", "email": "existing@example.com", "age": 21},
+        {"name": "Duplicate", "email": "new@example.com", "age": 40},
+    ]
+    with count_queries() as statements:
+        response = client.post("/users/bulk", json=users)
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["created"], data["updated"], data["conflict"]) == (1, 1, 1)
+    assert [result["status"] for result in data["results"]] == ["created", "updated", "conflict"]
+    assert len(statements) <= 3
+
+    updated = client.get(f"/users/{data['results'][1]['id']}").json()
+    assert updated["name"] == "New Name"
+    assert updated["age"] == 21
+
+def test_bulk_roles_and_assignments(client):
+    client.post("/roles", json={"name": "Admin"})
+    response = client.post("/roles/bulk", json=[{"name": "Admin"}, {"name": "Editor"}, {"name": "Viewer"}])
+    assert response.status_code == 200
+    data = response.json()
+    assert [result["status"] for result in data["results"]] == ["conflict", "created", "created"]
+
+    user_id = client.post("/users", json={"name": "Bulk", "email": "bulk@example.com", "age": 30}).json()["id"]
+    role_ids = [result["id"] for result in data["results"][1:]]
+    assignments = [{"user_id": user_id, "role_id": role_id} for role_id in role_ids]
+    assignments.append({"user_id": user_id, "role_id": 999999})
+    response = client.post("/user_roles/bulk", json=assignments)
+    assert response.status_code == 200
+    data = response.json()
+    assert [result["status"] for result in data["results"]] == ["created", "created", "conflict"]
+    assert sorted(role["role_id"] for role in client.get(f"/user_roles/{user_id}").json()) == sorted(role_ids)
+
+def test_async_routes(tmp_path):
+    import asyncio
+    from fastapi import FastAPI
+    from sqlalchemy.pool import NullPool
+    import services
+    from async_routes import cached_load, router as async_router
+    from database import create_async_db_engine, get_async_sessionmaker, make_async_sessionmaker
+
+    url = f"sqlite:///{tmp_path / 'async.db'}"
+    Base.metadata.create_all(create_engine(url))
+    AsyncTestSession = make_async_sessionmaker(create_async_db_engine(url, poolclass=NullPool))
+
+    async_app = FastAPI()
+    async_app.include_router(async_router)
+    async_app.dependency_overrides[get_async_sessionmaker] = lambda: AsyncTestSession
+    cache.clear()
+    permissions.clear()
+
+    with TestClient(async_app) as client:
+        user_id = client.post("/users", json={"name": "Async", "email": "async@example.com", "age": 30}).json()["id"]
+        role_id = client.post("/roles", json={"name": "Admin"}).json()["id"]
+        assert client.post("/user_roles", json={"user_id": user_id, "role_id": role_id}).status_code == 200
+        assert client.get(f"/users/{user_id}/has_role/{role_id}").json()["has_role"] is True
+        check = client.post("/user_roles/check", json=[{"user_id": user_id, "role_id": role_id + 1}]).json()
+        assert check == [{"user_id": user_id, "role_id": role_id + 1, "has_role": False}]
+
+        data = client.get(f"/user_roles/{user_id}").json()
+        assert data[0]["user_name"] == "Async"
+        assert data[0]["role_name"] == "Admin"
+        response = client.get("/users")
+        assert response.json()["items"][0]["email"] == "async@example.com"
+        assert client.get("/users", headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+        assert client.put(f"/roles/{role_id}", json={"name": "Owner"}).json()["name"] == "Owner"
+        assert client.get("/export/roles", params={"format": "csv"}).text.splitlines() == ["id,name,version", f"{role_id},Owner,2"]
+        assert client.post("/users/bulk", json=[{"name": "B", "email": "b@example.com", "age": 1}]).json()["created"] == 1
+        assert client.delete(f"/users/{user_id}").status_code == 200
+        assert client.get(f"/users/{user_id}").status_code == 404
+
+    async def cancelled_leader():
+        # The load runs on its own session, so it finishes for the waiting
+        # request after the request that started it is gone
+        cache.clear()
+        load = cached_load(AsyncTestSession, services.load_role, role_id)
+        leader = asyncio.ensure_future(cache.get_or_load_async("role:leader", load))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(cache.get_or_load_async("role:leader", load))
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert (await follower)["name"] == "Owner"
+
+    asyncio.run(cancelled_leader())
+    cache.clear()
+
+
+def test_write_behind_assignments(tmp_path, monkeypatch):
+    import asyncio
+    from fastapi import FastAPI
+    import write_behind
+    from sqlalchemy.exc import IntegrityError
+    from write_behind import WriteBehindQueue
+
+    url = f"sqlite:///{tmp_path / 'write_behind.db'}"
+    engine = create_db_engine(url)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    commits = []
+    event.listen(engine, "commit", lambda conn: commits.append(1))
+    with engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO users (id, name, email, age) VALUES (1, 'Queued', 'q@example.com', 30)")
+        connection.exec_driver_sql("INSERT INTO roles (id, name) VALUES (1, 'A'), (2, 'B'), (3, 'C')")
+    commits.clear()
+
+    async def scenario():
+        writer = WriteBehindQueue(Session, max_rows=50, max_delay=0.05, max_pending=100)
+        async with writer.serving():
+            futures = [writer.submit(1, role_id) for role_id in (1, 2, 3, 1, 9)]
+            rows = await asyncio.gather(*futures)
+        assert (writer.batches, len(commits)) == (1, 1)
+        assert [row["role_id"] for row in rows[:4]] == [1, 2, 3, 1]
+        # An unknown role does not fail the rest of the batch
+        assert rows[4] is None
+        assert rows[3]["id"] == rows[0]["id"]
+
+        # A batch that fails in the database is retried row by row, so only
+        # the offending request gets the error
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE TRIGGER reject_role_2 BEFORE INSERT ON user_roles WHEN NEW.role_id = 2 "
+                "BEGIN SELECT RAISE(ABORT, 'rejected'); END"
+            )
+            connection.exec_driver_sql("DELETE FROM user_roles")
+        writer = WriteBehindQueue(Session, max_rows=50, max_delay=0.05, max_pending=100)
+        async with writer.serving():
+            futures = [writer.submit(1, role_id) for role_id in (1, 2, 3)]
+            results = await asyncio.gather(*futures, return_exceptions=True)
+        assert [result["role_id"] for result in (results[0], results[2])] == [1, 3]
+        assert isinstance(results[1], IntegrityError)
+        assert (writer.batches, writer.rows, writer.single_writes) == (0, 0, 2)
+        with engine.begin() as connection:
+            connection.exec_driver_sql("DROP TRIGGER reject_role_2")
+            connection.exec_driver_sql("DELETE FROM user_roles")
+
+        # Backpressure, then a flush of everything accepted on shutdown
+        writer = WriteBehindQueue(Session, max_rows=50, max_delay=10, max_pending=2)
+        await writer.start()
+        accepted = [writer.submit(1, 2), writer.submit(1, 3)]
+        with pytest.raises(asyncio.QueueFull):
+            writer.submit(1, 1)
+        await writer.stop()
+        assert all(future.done() for future in accepted)
+        with pytest.raises(asyncio.QueueFull):
+            writer.submit(1, 1)
+
+        # A writer that dies fails every pending request instead of leaving
+        # it waiting, refuses new work and reports the error on shutdown
+        broken = RuntimeError("broken")
+
+        def fail(pairs):
+            raise broken
+        writer = WriteBehindQueue(Session, max_rows=2, max_delay=10, max_pending=10)
+        writer._write = writer._write_each = fail
+        await writer.start()
+        futures = [writer.submit(1, role_id) for role_id in (1, 2, 3)]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        assert all(result is broken for result in results)
+        with pytest.raises(RuntimeError, match="not running"):
+            writer.submit(1, 1)
+        with pytest.raises(RuntimeError, match="broken"):
+            await writer.stop()
+
+    asyncio.run(scenario())
+
+    writer = WriteBehindQueue(Session, max_rows=50, max_delay=0.001, max_pending=100)
+    monkeypatch.setattr(write_behind, "writer", writer)
+    queued_app = FastAPI(lifespan=lambda app: writer.serving())
+    queued_app.include_router(write_behind.router)
+    with TestClient(queued_app) as client:
+        response = client.post("/user_roles", json={"user_id": 1, "role_id": 3})
+        assert response.status_code == 200
+        assert response.json()["role_id"] == 3
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE TRIGGER reject_role_2 BEFORE INSERT ON user_roles "
+                "BEGIN SELECT RAISE(ABORT, 'rejected'); END"
+            )
+        assert client.post("/user_roles", json={"user_id": 1, "role_id": 2}).status_code == 404
+    response = TestClient(queued_app).post("/user_roles", json={"user_id": 1, "role_id": 3})
+    assert response.status_code == 503
+
+def test_read_replica_routing(tmp_path, monkeypatch):
+    import database
+    from concurrent.futures import ThreadPoolExecutor
+    from replicas import ReplicaSet, WritePins
+
+    primary = create_db_engine(f"sqlite:///{tmp_path / 'primary.db'}")
+    Base.metadata.create_all(primary)
+    replica_engines = [create_db_engine(f"sqlite:///{tmp_path / f'replica{i}.db'}") for i in range(2)]
+    broken = create_db_engine(f"sqlite:///{tmp_path / 'missing' / 'replica.db'}")
+    monkeypatch.setattr(database, "SessionLocal", sessionmaker(bind=primary))
+    monkeypatch.setattr(database, "replicas", ReplicaSet(replica_engines + [broken], health_interval=60))
+    monkeypatch.setattr(database, "write_pins", WritePins(seconds=60))
+    monkeypatch.setattr(app, "dependency_overrides", {})
+    database.replicas.sync_from(primary)
+    cache.clear()
+
+    with TestClient(app) as client:
+        response = client.post("/users", json={"name": "Primary", "email": "p@example.com", "age": 30}, headers={"X-Client-Id": "writer"})
+        assert response.status_code == 200
+        # The writer is pinned to the primary; other clients read a replica
+        # that has not caught up yet
+        assert len(client.get("/users", headers={"X-Client-Id": "writer"}).json()["items"]) == 1
+        assert client.get("/users", headers={"X-Client-Id": "reader"}).json()["items"] == []
+
+        database.replicas.sync_from(primary)
+        assert len(client.get("/users", headers={"X-Client-Id": "reader"}).json()["items"]) == 1
+        client.get("/users", headers={"X-Client-Id": "reader"})
+
+        # A reader that loads from the lagging replica after the writer's
+        # update must not leave its stale copy in the cache for the writer
+        user_id = response.json()["id"]
+        client.put(f"/users/{user_id}", json={"name": "Renamed", "email": "p@example.com", "age": 30}, headers={"X-Client-Id": "writer"})
+        assert client.get(f"/users/{user_id}", headers={"X-Client-Id": "reader"}).json()["name"] == "Primary"
+        assert client.get(f"/users/{user_id}", headers={"X-Client-Id": "writer"}).json()["name"] == "Renamed"
+        # The writer's primary read filled the cache, which readers then use
+        assert client.get(f"/users/{user_id}", headers={"X-Client-Id": "reader"}).json()["name"] == "Renamed"
+    # Round-robin over the two healthy replicas; the broken one is skipped
+    assert [replica.reads for replica in database.replicas.replicas] == [3, 2, 0]
+    cache.clear()
+
+    # Pins and read counts stay consistent when requests on the threadpool
+    # update them at once, including while the pin map is swept
+    pins = WritePins(seconds=0)
+    replica_set = ReplicaSet(replica_engines, health_interval=60)
+
+    def work(worker):
+        for i in range(500):
+            pins.pin(f"{worker}:{i}")
+            pins.pinned(f"{worker}:{i}")
+            replica_set.session().close()
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(work, range(8)))
+    assert sum(replica.reads for replica in replica_set.replicas) == 8 * 500
+
+def test_shard_existing_database(tmp_path):
+    import shutil
+    import sharding
+
+    source = tmp_path / "source.db"
+    sharding.migrate([f"sqlite:///{source}"])
+    engine = create_engine(f"sqlite:///{source}")
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO users (id, name, email, age) VALUES (2, 'B', 'b@example.com', 1), (3, 'C', 'c@example.com', 1)"
+        )
+        connection.exec_driver_sql("INSERT INTO roles (id, name) VALUES (1, 'R'), (2, 'S')")
+        connection.exec_driver_sql(
+            "INSERT INTO user_roles (id, user_id, role_id) VALUES (1, 2, 1), (2, 1, 1), (3, 3, 1), (4, 2, 2)"
+        )
+    engine.dispose()
+    paths = [tmp_path / f"shard{i}.db" for i in range(2)]
+    for path in paths:
+        shutil.copy(source, path)
+    sharding.migrate([f"sqlite:///{path}" for path in paths])
+
+    assignments = set()
+    for index, path in enumerate(paths):
+        engine = create_engine(f"sqlite:///{path}")
+        with engine.connect() as connection:
+            rows = connection.exec_driver_sql("SELECT id, user_id, role_id FROM user_roles").all()
+        engine.dispose()
+        # Every assignment stays with its user, under an id of its shard
+        assert all(user_id % 2 == index and id % 2 == index for id, user_id, _ in rows)
+        assignments.update(rows)
+    assert sorted((user_id, role_id) for _, user_id, role_id in assignments) == [(1, 1), (2, 1), (2, 2), (3, 1)]
+    assert len({id for id, _, _ in assignments}) == 4
+
+def test_sharded_mode(tmp_path, monkeypatch):
+    from fastapi import FastAPI
+    import database
+    import sharding
+    from routing import replace_routes
+    from sqlalchemy.exc import IntegrityError
+    from sharded_routes import router as sharded_router
+
+    urls = [f"sqlite:///{tmp_path / f'shard{i}.db'}" for i in range(3)]
+    sharding.migrate(urls)
+    shards = sharding.ShardSet([create_db_engine(url) for url in urls])
+    monkeypatch.setattr(database, "shards", shards)
+    sharded_app = FastAPI()
+    sharded_app.router.routes.extend(app.router.routes)
+    replace_routes(sharded_app.router, sharded_router)
+    cache.clear()
+
+    with TestClient(sharded_app) as client:
+        user_ids = [
+            client.post("/users", json={"name": f"Sharded {i}", "email": f"s{i}@example.com", "age": 20 + i}).json()["id"]
+            for i in range(8)
+        ]
+        assert client.post("/users", json={"name": "Dup", "email": "s0@example.com", "age": 1}).status_code == 400
+        # Other constraint failures are not reported as a taken email
+        for engine in shards.engines:
+            with engine.begin() as connection:
+                connection.exec_driver_sql(
+                    "CREATE TRIGGER reject_users BEFORE INSERT ON users BEGIN SELECT RAISE(ABORT, 'down'); END"
+                )
+        with pytest.raises(IntegrityError):
+            client.post("/users", json={"name": "New", "email": "new@example.com", "age": 1})
+        for engine in shards.engines:
+            with engine.begin() as connection:
+                connection.exec_driver_sql("DROP TRIGGER reject_users")
+        for index, engine in enumerate(shards.engines):
+            with engine.connect() as connection:
+                assert all(user_id % 3 == index for (user_id,) in connection.exec_driver_sql("SELECT id FROM users"))
+        assert len({user_id % 3 for user_id in user_ids}) > 1
+
+        # The seeded admin (id 1) is kept on shard 1 only
+        first = client.get("/users", params={"limit": 5}).json()
+        second = client.get("/users", params={"limit": 5, "cursor": first["next_cursor"]}).json()
+        assert [user["id"] for user in first["items"] + second["items"]] == sorted([1, *user_ids])
+
+        role_id = client.post("/roles", json={"name": "Everywhere"}).json()["id"]
+        for engine in shards.engines:
+            with engine.connect() as connection:
+                assert connection.exec_driver_sql("SELECT id, name FROM roles").all() == [(role_id, "Everywhere")]
+        for user_id in user_ids[:5]:
+            assert client.post("/user_roles", json={"user_id": user_id, "role_id": role_id}).status_code == 200
+        assert client.get(f"/user_roles/{user_ids[0]}").json()[0]["role_name"] == "Everywhere"
+        assignment_ids = [item["id"] for item in client.get("/user_roles").json()["items"]]
+        assert len(assignment_ids) == len(set(assignment_ids)) == 5
+        members = client.get(f"/roles/{role_id}/users").json()["items"]
+        assert [user["id"] for user in members] == sorted(user_ids[:5])
+        assert client.get("/roles/stats").json() == [{"role_id": role_id, "name": "Everywhere", "users": 5}]
+        checks = [{"user_id": user_id, "role_id": role_id} for user_id in user_ids]
+        assert [item["has_role"] for item in client.post("/user_roles/check", json=checks).json()] == [True] * 5 + [False] * 3
+
+        assert client.put(f"/users/{user_ids[1]}", json={"name": "Moved", "email": "m@example.com", "age": 1}).status_code == 200
+        assert client.get(f"/users/{user_ids[1]}").json()["name"] == "Moved"
+        # Emails stay unique across shards on update too
+        other = next(user_id for user_id in user_ids if user_id % 3 != user_ids[1] % 3)
+        email = client.get(f"/users/{other}").json()["email"]
+        response = client.put(f"/users/{user_ids[1]}", json={"name": "Moved", "email": email, "age": 1})
+        assert response.status_code == 400
+        assert client.delete(f"/users/{user_ids[2]}").status_code == 200
+        assert client.get(f"/users/{user_ids[2]}").status_code == 404
+        assert client.post("/users/bulk", json=[]).status_code == 501
+
+        # A role copy that fails is reported, and repeating the write
+        # brings the shard up to date
+        with shards.engines[2].begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE TRIGGER reject_roles BEFORE INSERT ON roles BEGIN SELECT RAISE(ABORT, 'down'); END"
+            )
+        assert client.post("/roles", json={"name": "Partial"}).status_code == 503
+        with shards.engines[0].connect() as connection:
+            partial_id = connection.exec_driver_sql("SELECT id FROM roles WHERE name = 'Partial'").scalar()
+        with shards.engines[2].begin() as connection:
+            connection.exec_driver_sql("DROP TRIGGER reject_roles")
+        assert client.put(f"/roles/{partial_id}", json={"name": "Partial"}).status_code == 200
+        for engine in shards.engines:
+            with engine.connect() as connection:
+                assert connection.exec_driver_sql(f"SELECT name FROM roles WHERE id = {partial_id}").scalar() == "Partial"
+        assert client.delete(f"/roles/{partial_id}").status_code == 200
+        assert client.delete(f"/roles/{partial_id}").status_code == 404
+    cache.clear()
+
+def test_database_fixtures(memory_engine, template_database):
+    import sqlite3
+    from alembic.script import ScriptDirectory
+    from alembic.config import Config
+
+    head = ScriptDirectory.from_config(Config("alembic.ini")).get_current_head()
+    with memory_engine.begin() as connection:
+        assert connection.exec_driver_sql("SELECT version_num FROM alembic_version").scalar() == head
+        connection.exec_driver_sql("INSERT INTO users (name, email, age) VALUES ('Copy', 'copy@example.com', 1)")
+    with memory_engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT COUNT(*) FROM users WHERE email = 'copy@example.com'").scalar() == 1
+    # Commits stay in the copy
+    with sqlite3.connect(template_database) as template:
+        assert template.execute("SELECT COUNT(*) FROM users WHERE email = 'copy@example.com'").fetchone() == (0,)
+
+def test_backfill_resumes(memory_engine, monkeypatch, caplog):
+    import backfill
+    from sqlalchemy.exc import IntegrityError
+
+    with memory_engine.begin() as connection:
+        connection.exec_driver_sql("DELETE FROM users")
+        for i in range(1, 26):
+            connection.exec_driver_sql(f"INSERT INTO users (id, name, email, age) VALUES ({i}, 'user {i}', 'u{i}@example.com', 1)")
+        # Stands in for a crash in the middle of the second chunk
+        connection.exec_driver_sql(
+            "CREATE TEMP TRIGGER fail_backfill BEFORE UPDATE OF name ON users WHEN NEW.id = 15 "
+            "BEGIN SELECT RAISE(ABORT, 'interrupted'); END"
+        )
+    statement = "UPDATE users SET name = upper(name) WHERE id > :lower AND id <= :upper"
+    with pytest.raises(IntegrityError):
+        backfill.run_backfill(memory_engine, "upper_names", "users", statement, chunk_size=10)
+
+    def state():
+        with memory_engine.connect() as connection:
+            upper = connection.exec_driver_sql("SELECT COUNT(*) FROM users WHERE name = upper(name)").scalar()
+            checkpoint = connection.exec_driver_sql("SELECT last_key, rows, finished_at IS NOT NULL FROM data_migration_checkpoints").one()
+        return upper, tuple(checkpoint)
+    # The first chunk stayed committed along with its checkpoint
+    assert state() == (10, (10, 10, 0))
+
+    with memory_engine.begin() as connection:
+        connection.exec_driver_sql("DROP TRIGGER fail_backfill")
+    pauses = []
+    monkeypatch.setattr(backfill.time, "sleep", pauses.append)
+    with caplog.at_level("INFO", logger="alembic.backfill"):
+        assert backfill.run_backfill(memory_engine, "upper_names", "users", statement, chunk_size=10, rows_per_second=1000) == 15
+    assert state() == (25, (25, 25, 1))
+    assert "upper_names: 15/15 rows (100%)" in caplog.text
+    assert pauses  # throttled to 1000 rows/s
+    assert backfill.run_backfill(memory_engine, "upper_names", "users", statement) == 0
+
+def test_sqlite_pragmas(test_engine):
+    with test_engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+
+
+def test_role_cache(client):
+    role_id = client.post("/roles", json={"name": "Admin"}).json()["id"]
+    assert client.get(f"/roles/{role_id}").json()["name"] == "Admin"
+    with count_queries() as statements:
+        assert client.get(f"/roles/{role_id}").json()["name"] == "Admin"
+        assert client.post("/roles", json={"name": "Admin"}).status_code == 404
+    assert statements == []
+    assert client.get("/cache/stats").json()["hits"] >= 2
+
+    client.put(f"/roles/{role_id}", json={"name": "Owner"})
+    assert client.get(f"/roles/{role_id}").json()["name"] == "Owner"
+    assert client.get("/roles").json()["items"][0]["name"] == "Owner"
+    assert client.post("/roles", json={"name": "Admin"}).status_code == 200
+
+def test_single_flight_loads():
+    import asyncio
+    import gc
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache.clear()
+    loads = []
+    release = threading.Event()
+
+    def load():
+        loads.append(1)
+        release.wait(5)
+        return {"id": 1}
+
+    with ThreadPoolExecutor(8) as pool:
+        futures = [pool.submit(cache.get_or_load, "user:1", load) for _ in range(8)]
+        while cache.flights.coalesced < 7:
+            threading.Event().wait(0.001)
+        release.set()
+        results = [future.result() for future in futures]
+    assert len(loads) == 1
+    assert all(result is results[0] for result in results)
+    assert cache.stats()["coalesced"] == 7
+
+    async def scenario():
+        loads.clear()
+
+        async def load_async():
+            loads.append(1)
+            await asyncio.sleep(0.01)
+            if len(loads) == 1:
+                raise LookupError("not found")
+            return {"id": 2}
+
+        results = await asyncio.gather(*(cache.get_or_load_async("role:2", load_async) for _ in range(5)), return_exceptions=True)
+        assert len(loads) == 1
+        assert all(isinstance(result, LookupError) for result in results)
+        # A failed load is not cached; the next caller loads again
+        assert await cache.get_or_load_async("role:2", load_async) == {"id": 2}
+
+        # Callers arriving after an invalidation do not join the older load
+        first = asyncio.ensure_future(cache.get_or_load_async("role:3", load_async))
+        await asyncio.sleep(0)
+        cache.invalidate("role:3")
+        second = asyncio.ensure_future(cache.get_or_load_async("role:3", load_async))
+        await asyncio.gather(first, second)
+        assert len(loads) == 4
+        assert cache.backend.get("role:3") == {"id": 2}
+
+        # A failed load whose callers were all cancelled is not reported as
+        # an exception nobody retrieved
+        unhandled = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+
+        async def failing():
+            await asyncio.sleep(0)
+            raise LookupError("not found")
+        waiter = asyncio.ensure_future(cache.flights.do_async("role:4", failing))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        del waiter
+        gc.collect()
+        assert unhandled == []
+
+    asyncio.run(scenario())
+    cache.clear()
+
+def test_cache_counters_and_backend():
+    from concurrent.futures import ThreadPoolExecutor
+    from cache import CacheBackend
+
+    with pytest.raises(TypeError):
+        CacheBackend()
+
+    cache.clear()
+    cache.set("role:1", {"id": 1})
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda key: cache.get(key), ["role:1", "role:2"] * 2000))
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (2000, 2000)
+    cache.clear()
+
+def test_user_cache_invalidation(client):
+    user_id = client.post("/users", json={"name": "Cached", "email": "cached@example.com", "age": 40}).json()["id"]
+    assert client.get(f"/users/{user_id}").json()["name"] == "Cached"
+    client.put(f"/users/{user_id}", json={"name": "Renamed", "email": "cached@example.com", "age": 41})
+    assert client.get(f"/users/{user_id}").json()["name"] == "Renamed"
+    client.delete(f"/users/{user_id}")
+    assert client.get(f"/users/{user_id}").status_code == 404
+
+
+def test_conditional_get(client):
+    user_id = client.post("/users", json={"name": "Etag", "email": "etag@example.com", "age": 30}).json()["id"]
+    response = client.get(f"/users/{user_id}")
+    etag = response.headers["etag"]
+    response = client.get(f"/users/{user_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    client.put(f"/users/{user_id}", json={"name": "Etag 2", "email": "etag@example.com", "age": 31})
+    response = client.get(f"/users/{user_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+def test_conditional_get_collections(client):
+    client.post("/roles", json={"name": "Admin"})
+    etag = client.get("/roles").headers["etag"]
+    with count_queries() as statements:
+        response = client.get("/roles", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert len(statements) == 1
+
+    client.post("/roles", json={"name": "Editor"})
+    assert client.get("/roles", headers={"If-None-Match": etag}).status_code == 200
+
+    user_id = client.post("/users", json={"name": "Etag", "email": "etag@example.com", "age": 30}).json()["id"]
+    etag = client.get(f"/user_roles/{user_id}").headers["etag"]
+    assert client.get(f"/user_roles/{user_id}", headers={"If-None-Match": etag}).status_code == 304
+    client.post("/user_roles", json={"user_id": user_id, "role_id": client.get("/roles").json()["items"][0]["id"]})
+    assert client.get(f"/user_roles/{user_id}", headers={"If-None-Match": etag}).status_code == 200
+
+def test_conditional_get_lists(client):
+    user_id = client.post("/users", json={"name": "Etag", "email": "etag@example.com", "age": 30}).json()["id"]
+    role_id = client.post("/roles", json={"name": "Admin"}).json()["id"]
+    for path in ("/users", "/user_roles"):
+        response = client.get(path)
+        etag = response.headers["etag"]
+        with count_queries() as statements:
+            response = client.get(path, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert len(statements) == 1
+        assert client.get(path, params={"limit": 1}, headers={"If-None-Match": etag}).status_code == 200
+
+    etag = client.get("/user_roles").headers["etag"]
+    client.post("/user_roles", json={"user_id": user_id, "role_id": role_id})
+    assert client.get("/user_roles", headers={"If-None-Match": etag}).status_code == 200
+
+def test_user_roles_body_matches_etag(client, db_session):
+    from models import UserRole
+    user_id = client.post("/users", json={"name": "Etag", "email": "etag@example.com", "age": 30}).json()["id"]
+    role_id = client.post("/roles", json={"name": "Admin"}).json()["id"]
+    etag = client.get(f"/user_roles/{user_id}").headers["etag"]
+    # A write from another process skips this process's invalidation
+    db_session.add(UserRole(user_id=user_id, role_id=role_id))
+    db_session.flush()
+    response = client.get(f"/user_roles/{user_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert [row["role_id"] for row in response.json()] == [role_id]
+
+def test_fast_serialization_matches_pydantic(client, monkeypatch):
+    import main
+    import services
+    user_id = client.post("/users", json={"name": "Fast", "email": "fast@example.com", "age": 30}).json()["id"]
+    role_id = client.post("/roles", json={"name": "Admin"}).json()["id"]
+    client.post("/user_roles", json={"user_id": user_id, "role_id": role_id})
+
+    paths = ["/users", "/roles", "/user_roles"]
+    expected = {path: client.get(path).json() for path in paths}
+    schema = client.get("/openapi.json").json()
+    cache.clear()
+    monkeypatch.setattr(main, "FAST_SERIALIZATION", True)
+    monkeypatch.setattr(services, "FAST_SERIALIZATION", True)
+    for path in paths:
+        assert client.get(path).json() == expected[path]
+    assert client.get("/openapi.json").json() == schema
+
+def test_metrics(client):
+    role_id = client.post("/roles", json={"name": "Admin"}).json()["id"]
+    client.get(f"/roles/{role_id}")
+    body = client.get("/metrics").text
+    assert 'http_request_duration_seconds_count{method="GET",route="/roles/{role_id}"} 1' in body
+    assert 'http_request_sql_statements_count{method="POST",route="/roles"} 1' in body
+    assert "cache_hits_total" in body
+
+def test_server_timing_header(test_engine):
+    from fastapi import FastAPI
+    from sqlalchemy.exc import OperationalError
+    from metrics import InstrumentedRoute, MetricsMiddleware, registry
+
+    callbacks = len(registry.on_clear)
+    timed_app = FastAPI()
+    timed_app.router.route_class = InstrumentedRoute
+    timed_app.add_middleware(MetricsMiddleware, server_timing=True)
+
+    @timed_app.get("/ping")
+    def ping():
+        with test_engine.connect() as connection:
+            with pytest.raises(OperationalError):
+                connection.exec_driver_sql("SELECT * FROM missing_table")
+            connection.exec_driver_sql("SELECT 1")
+            assert "query_start" not in connection.info
+        return ["pong"]
+
+    with TestClient(timed_app) as timed_client:
+        header = timed_client.get("/ping").headers["server-timing"]
+    assert header.startswith("app;dur=")
+    assert 'desc="1 queries"' in header
+    assert "ser;dur=" in header
+    # Middleware instances share one series cache instead of each adding a callback
+    assert len(registry.on_clear) == callbacks
+
+def test_seed_and_replay(tmp_path):
+    import argparse
+    import asyncio
+    from benchmarks.cli import positive_int
+    from benchmarks.loadtest import DEFAULT_TRACE, build_requests, load_trace, report, run_in_process
+    from benchmarks.seed import Dataset, seed
+    from database import get_db
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        positive_int("0")
+
+    url = f"sqlite:///{tmp_path / 'bench.db'}"
+    ranges = seed(url, Dataset(users=50, roles=5, roles_per_user=2))
+    assert ranges["user_ids"][1] - ranges["user_ids"][0] == 50
+    assert ranges["role_ids"][1] - ranges["role_ids"][0] == 5
+
+    bench_engine = create_db_engine(url)
+    BenchSession = sessionmaker(autocommit=False, autoflush=False, bind=bench_engine)
+
+    def override_get_db():
+        with BenchSession() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_get_db
+    cache.clear()
+    permissions.clear()
+    try:
+        requests = build_requests(load_trace(DEFAULT_TRACE), 200, ranges["user_ids"], ranges["role_ids"])
+        samples, elapsed = asyncio.run(run_in_process(requests, 4))
+    finally:
+        del app.dependency_overrides[get_db]
+        bench_engine.dispose()
+        cache.clear()
+        permissions.clear()
+    result = report(samples, elapsed)
+    assert result["total"]["count"] == 200
+    assert result["total"]["errors"] == 0
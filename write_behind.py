@@ -0,0 +1,212 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select, tuple_
+from sqlalchemy.exc import IntegrityError
+
+import config
+from bulk import dialect_insert
+from cache import invalidate_assignments
+from database import SessionLocal
+from metrics import InstrumentedRoute
+from permissions import permissions
+from models import User, Role, UserRole
+from schemas import UserRoleCreate, UserRoleResponse
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """Collects role assignments from concurrent requests and writes them in
+    group commits, so a burst of N assignments costs one commit instead of N.
+
+    ``submit`` returns a future that resolves to the assignment row once the
+    batch holding it is committed."""
+
+    def __init__(
+        self,
+        session_factory,
+        max_rows=config.WRITE_BEHIND_MAX_ROWS,
+        max_delay=config.WRITE_BEHIND_MAX_DELAY_MS / 1000,
+        max_pending=config.WRITE_BEHIND_QUEUE_SIZE,
+    ):
+        self.session_factory = session_factory
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.batches = 0
+        self.rows = 0
+        self.single_writes = 0
+        self._queue = None
+        self._task = None
+
+    async def start(self):
+        self._queue = asyncio.Queue(self.max_pending)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop accepting work and wait until everything queued is written.
+        Raises the writer's error if it died, so the lifespan sees it."""
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        if not task.done():
+            await self._queue.put(_STOP)
+        await task
+
+    @asynccontextmanager
+    async def serving(self):
+        await self.start()
+        try:
+            yield
+        finally:
+            await self.stop()
+
+    def submit(self, user_id, role_id):
+        """Raises ``asyncio.QueueFull`` when the queue is full or stopping."""
+        if self._task is None:
+            raise asyncio.QueueFull
+        if self._task.done():
+            # Nothing would ever write the pair
+            cause = None if self._task.cancelled() else self._task.exception()
+            raise RuntimeError("write-behind writer is not running") from cause
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(((user_id, role_id), future))
+        return future
+
+    async def _next_batch(self):
+        item = await self._queue.get()
+        if item is _STOP:
+            return [], True
+        # The first item opens a window of max_delay for others to join
+        batch = [item]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_rows:
+            if not self._queue.empty():
+                item = self._queue.get_nowait()
+            else:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self):
+        batch = []
+        try:
+            stopping = False
+            while not stopping:
+                batch, stopping = await self._next_batch()
+                if batch:
+                    await self._flush(batch)
+        except BaseException as exc:
+            self._fail_pending(batch, exc)
+            raise
+
+    def _fail_pending(self, batch, exc):
+        """Fail the futures of ``batch`` and of everything still queued, so
+        no request waits on a writer that has died."""
+        if not isinstance(exc, Exception):
+            exc = RuntimeError("write-behind writer stopped")
+        items = list(batch)
+        while not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        for item in items:
+            if item is not _STOP and not item[1].done():
+                item[1].set_exception(exc)
+
+    async def _flush(self, batch):
+        pairs = [pair for pair, _ in batch]
+        try:
+            results = await run_in_threadpool(self._write, pairs)
+            # Only group commits count, so rows / batches stays the
+            # rows per commit
+            self.batches += 1
+            self.rows += len(pairs)
+        except Exception as exc:
+            # Write the pairs one at a time so only the offending
+            # requests see the error
+            results = [exc] if len(pairs) == 1 else await run_in_threadpool(self._write_each, pairs)
+            self.single_writes += sum(not isinstance(result, Exception) for result in results)
+        for result, (_, future) in zip(results, batch):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _write_each(self, pairs):
+        """Write each pair in its own transaction; returns a row, None or the
+        exception raised, per pair."""
+        results = []
+        for pair in pairs:
+            try:
+                [result] = self._write([pair])
+            except Exception as exc:
+                result = exc
+            results.append(result)
+        return results
+
+    def _write(self, pairs):
+        """Insert ``pairs`` in one transaction; returns one row per pair, in
+        order. Pairs that are already assigned resolve to the existing row,
+        pairs naming an unknown user or role to None."""
+        table = UserRole.__table__
+        db = self.session_factory()
+        try:
+            # One unknown id would fail the foreign key check for the whole
+            # batch, so leave those pairs out
+            users = set(db.scalars(select(User.id).where(User.id.in_({user_id for user_id, _ in pairs}))))
+            roles = set(db.scalars(select(Role.id).where(Role.id.in_({role_id for _, role_id in pairs}))))
+            unique = [pair for pair in dict.fromkeys(pairs) if pair[0] in users and pair[1] in roles]
+            found = {}
+            if unique:
+                stmt = (
+                    dialect_insert(db, table)
+                    .on_conflict_do_nothing(index_elements=[table.c.user_id, table.c.role_id])
+                    .returning(*table.c)
+                )
+                rows = db.execute(stmt, [{"user_id": user_id, "role_id": role_id} for user_id, role_id in unique])
+                found = {(row.user_id, row.role_id): row for row in rows}
+            missing = [pair for pair in unique if pair not in found]
+            if missing:
+                existing = db.execute(select(*table.c).where(tuple_(table.c.user_id, table.c.role_id).in_(missing)))
+                found.update({(row.user_id, row.role_id): row for row in existing})
+            db.commit()
+        finally:
+            db.close()
+        return [dict(found[pair]._mapping) if pair in found else None for pair in pairs]
+
+
+writer = WriteBehindQueue(SessionLocal)
+
+# Replaces POST /user_roles when WRITE_BEHIND is on
+router = APIRouter(route_class=InstrumentedRoute)
+
+
+@router.post("/user_roles", response_model=UserRoleResponse)
+async def assign_role_to_user(user_role: UserRoleCreate):
+    try:
+        future = writer.submit(user_role.user_id, user_role.role_id)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Too many pending assignments", headers={"Retry-After": "1"})
+    try:
+        assignment = await future
+    except IntegrityError:
+        # A user or role deleted after the batch looked them up
+        raise HTTPException(status_code=404, detail="User or role not found")
+    if assignment is None:
+        raise HTTPException(status_code=404, detail="User or role not found")
+    invalidate_assignments(user_role.user_id)
+    permissions.grant(user_role.user_id, user_role.role_id)
+    return assignment